@@ -0,0 +1,7 @@
+from database import init_db
+
+# chat_members is created and backfilled by init_db (database.backfill_chat_members);
+# this script is kept so existing deploy notes that run it still work.
+
+if __name__ == "__main__":
+    init_db()
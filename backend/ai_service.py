@@ -2,6 +2,9 @@ import re
 from datetime import datetime, timedelta
 from models import IdeaAnalysis
 
+# Bump whenever analyze_text's result for the same text changes (see analysis_cache.py)
+ANALYZER_VERSION = "1"
+
 def analyze_text(text: str) -> IdeaAnalysis:
     text = text.lower()
     
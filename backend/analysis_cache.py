@@ -0,0 +1,146 @@
+import os
+import json
+import asyncio
+import hashlib
+from datetime import datetime, timezone, timedelta
+from async_database import async_db
+from cache import TTLCache, MISSING
+from extraction_service import extraction
+from file_extractor import EXTRACTOR_VERSION
+from ai_service import ANALYZER_VERSION
+from models import IdeaAnalysis
+
+# Extracted text + IdeaAnalysis per document content, in analysis_cache.
+#
+# Keyed by (sha256 of the file, EXTRACTOR_VERSION): the same upload analyzed again, or
+# shared into several chats under another name, skips the parse entirely. Bumping
+# EXTRACTOR_VERSION (or ANALYZER_VERSION, which is checked on read) retires old
+# entries. Entries are evicted least-recently-used first once their total size passes
+# ANALYSIS_CACHE_MAX_MB.
+
+ANALYSIS_CACHE_MAX_MB = int(os.getenv("ANALYSIS_CACHE_MAX_MB", "512"))
+# last_used_at is only rewritten when it is older than this, so hits stay read-only
+TOUCH_INTERVAL = timedelta(minutes=1)
+
+UPSERT_SQL = '''
+    INSERT INTO analysis_cache (sha256, extractor_version, analyzer_version, text, analysis, bytes)
+    VALUES ($1, $2, $3, $4, $5, $6)
+    ON CONFLICT (sha256, extractor_version) DO UPDATE SET
+        analyzer_version = EXCLUDED.analyzer_version,
+        text = EXCLUDED.text,
+        analysis = EXCLUDED.analysis,
+        bytes = EXCLUDED.bytes,
+        last_used_at = now()
+'''
+
+# Everything past the newest max_bytes worth of entries
+EVICT_SQL = '''
+    DELETE FROM analysis_cache c
+    USING (
+        SELECT sha256, extractor_version,
+               sum(bytes) OVER (ORDER BY last_used_at DESC, sha256) AS running
+        FROM analysis_cache
+    ) ranked
+    WHERE c.sha256 = ranked.sha256 AND c.extractor_version = ranked.extractor_version
+      AND ranked.running > $1
+'''
+
+def sha256_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+class AnalysisCache:
+    def __init__(self, max_bytes: int = ANALYSIS_CACHE_MAX_MB * 1024 * 1024):
+        self.max_bytes = max_bytes
+        # (path, size, mtime) -> sha256, so a repeat call doesn't re-read a 50 MB file
+        self.digests = TTLCache("file_digests", maxsize=1000, ttl=3600)
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evicted = 0
+        self.errors = 0
+
+    async def digest(self, path: str):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        key = (path, st.st_size, st.st_mtime_ns)
+        digest = self.digests.get(key)
+        if digest is MISSING:
+            digest = await asyncio.to_thread(sha256_file, path)
+            self.digests.set(key, digest)
+        return digest
+
+    async def get(self, sha256: str):
+        """(text, IdeaAnalysis) for a document, or None."""
+        row = await async_db.fetchrow(
+            "SELECT text, analysis, analyzer_version, last_used_at FROM analysis_cache "
+            "WHERE sha256 = $1 AND extractor_version = $2",
+            sha256, EXTRACTOR_VERSION
+        )
+        if row is None or row["analyzer_version"] != ANALYZER_VERSION:
+            self.misses += 1
+            return None
+        self.hits += 1
+        if row["last_used_at"] < datetime.now(timezone.utc) - TOUCH_INTERVAL:
+            await async_db.execute(
+                "UPDATE analysis_cache SET last_used_at = now() WHERE sha256 = $1 AND extractor_version = $2",
+                sha256, EXTRACTOR_VERSION
+            )
+        return row["text"], IdeaAnalysis(**json.loads(row["analysis"]))
+
+    async def put(self, sha256: str, text: str, analysis: IdeaAnalysis):
+        text = text.replace("\x00", "")  # Postgres text can't hold NUL
+        analysis_json = json.dumps(analysis.dict())
+        size = len(text.encode("utf-8")) + len(analysis_json)
+        if size > self.max_bytes:
+            return
+        async with async_db.transaction() as conn:
+            await conn.execute(UPSERT_SQL, sha256, EXTRACTOR_VERSION, ANALYZER_VERSION, text, analysis_json, size)
+            result = await conn.execute(EVICT_SQL, self.max_bytes)
+        self.stores += 1
+        self.evicted += int(result.split()[-1])
+
+    async def analyze(self, path: str):
+        """
+        Extracted text and analysis of an uploaded file, from the cache when this content
+        was seen before, else from the extraction pool. Returns (text, IdeaAnalysis, sha256).
+        """
+        sha256 = await self.digest(path)
+        if sha256 is not None:
+            try:
+                cached = await self.get(sha256)
+                if cached is not None:
+                    return (*cached, sha256)
+            except Exception as e:
+                self.errors += 1
+                print(f"Analysis cache read failed: {e}")
+
+        text, analysis = await extraction.analyze(path)
+        # Empty text gets analyzed by file name instead, which the content hash doesn't cover
+        if sha256 is not None and text:
+            try:
+                await self.put(sha256, text, analysis)
+            except Exception as e:
+                self.errors += 1
+                print(f"Analysis cache write failed: {e}")
+        return text, analysis, sha256
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "stores": self.stores,
+            "evicted": self.evicted,
+            "errors": self.errors,
+            "digests": self.digests.stats(),
+        }
+
+# Global instance
+analysis_cache = AnalysisCache()
@@ -0,0 +1,110 @@
+import time
+from contextlib import asynccontextmanager
+import asyncpg
+from database import (
+    DATABASE_URL,
+    DB_POOL_MIN_SIZE,
+    DB_POOL_MAX_SIZE,
+    DB_POOL_ACQUIRE_TIMEOUT,
+    DB_POOL_HEALTHCHECK_INTERVAL,
+)
+
+# asyncpg counterpart of database.py for the request path.
+# Sync code (background tasks, migration scripts) keeps using the psycopg2 pool.
+
+def rows_affected(status: str) -> int:
+    # asyncpg returns the command tag, e.g. "UPDATE 1" / "DELETE 0"
+    try:
+        return int(status.split()[-1])
+    except (ValueError, IndexError, AttributeError):
+        return 0
+
+class AsyncDatabase:
+    def __init__(self):
+        self.pool = None
+        self._waiting = 0
+        self._acquired = 0
+        self._timeouts = 0
+        self._acquire_time_total = 0.0
+        self._acquire_time_max = 0.0
+
+    async def connect(self):
+        self.pool = await asyncpg.create_pool(
+            DATABASE_URL,
+            min_size=DB_POOL_MIN_SIZE,
+            max_size=DB_POOL_MAX_SIZE,
+            # Recycle idle sockets so a dead server-side connection is never handed out
+            max_inactive_connection_lifetime=DB_POOL_HEALTHCHECK_INTERVAL * 10,
+        )
+        print("Async Postgres pool ready.")
+
+    async def close(self):
+        if self.pool:
+            await self.pool.close()
+            self.pool = None
+            print("Async Postgres pool closed.")
+
+    @asynccontextmanager
+    async def acquire(self):
+        start = time.monotonic()
+        self._waiting += 1
+        try:
+            conn = await self.pool.acquire(timeout=DB_POOL_ACQUIRE_TIMEOUT)
+        except TimeoutError:
+            self._timeouts += 1
+            raise
+        finally:
+            self._waiting -= 1
+
+        elapsed = time.monotonic() - start
+        self._acquired += 1
+        self._acquire_time_total += elapsed
+        self._acquire_time_max = max(self._acquire_time_max, elapsed)
+        try:
+            yield conn
+        finally:
+            await self.pool.release(conn)
+
+    @asynccontextmanager
+    async def transaction(self):
+        async with self.acquire() as conn:
+            async with conn.transaction():
+                yield conn
+
+    async def fetch(self, query, *args):
+        async with self.acquire() as conn:
+            return await conn.fetch(query, *args)
+
+    async def fetchrow(self, query, *args):
+        async with self.acquire() as conn:
+            return await conn.fetchrow(query, *args)
+
+    async def fetchval(self, query, *args):
+        async with self.acquire() as conn:
+            return await conn.fetchval(query, *args)
+
+    async def execute(self, query, *args):
+        async with self.acquire() as conn:
+            return await conn.execute(query, *args)
+
+    def stats(self):
+        if not self.pool:
+            return {"connected": False}
+        size = self.pool.get_size()
+        idle = self.pool.get_idle_size()
+        return {
+            "connected": True,
+            "min_size": self.pool.get_min_size(),
+            "max_size": self.pool.get_max_size(),
+            "size": size,
+            "in_use": size - idle,
+            "idle": idle,
+            "waiting": self._waiting,
+            "acquired": self._acquired,
+            "timeouts": self._timeouts,
+            "acquire_ms_avg": round(self._acquire_time_total / self._acquired * 1000, 3) if self._acquired else 0.0,
+            "acquire_ms_max": round(self._acquire_time_max * 1000, 3),
+        }
+
+# Global instance
+async_db = AsyncDatabase()
@@ -0,0 +1,104 @@
+"""
+Per-message CPU cost of WebSocket fanout vs room size.
+
+    python benchmarks/bench_fanout.py [--messages 200] [--sizes 10,100,500,1000]
+
+"legacy"  - json.loads the Redis payload, then send_json (json.dumps) per socket
+"encoded" - the published string written with send_text as-is per socket
+"queued"  - the full ConnectionManager path: encoded string through each
+            socket's send queue and writer task (adds the backpressure overhead)
+
+No Redis or real sockets needed.
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from websocket_manager import ConnectionManager, ClientConnection, encode
+
+SAMPLE = {
+    "id": 1718000000123,
+    "text": "Pushed the new build to staging, can someone sanity-check the upload flow? 🚀",
+    "sender": "1717000000000",
+    "time": "10:42 AM",
+    "type": "text",
+    "fileUrl": None,
+    "fileName": None,
+    "fileSize": None,
+    "isPinned": False,
+    "replyTo": {"id": 1717999999000, "text": "any update on staging?", "sender": "Alex"},
+    "chat_id": 42,
+}
+
+
+class NullWebSocket:
+    # Mirrors Starlette: send_json encodes, send_text passes the string through
+    async def accept(self):
+        pass
+
+    async def send_json(self, data):
+        await self.send_text(json.dumps(data, separators=(",", ":"), ensure_ascii=False))
+
+    async def send_text(self, data):
+        pass
+
+
+async def legacy(sockets, payload, messages):
+    for _ in range(messages):
+        data = json.loads(payload)
+        for ws in sockets:
+            await ws.send_json(data)
+
+
+async def encoded(sockets, payload, messages):
+    for _ in range(messages):
+        for ws in sockets:
+            await ws.send_text(payload)
+
+
+async def queued(sockets, payload, messages):
+    # Register sockets directly; connect() would try to subscribe on Redis
+    manager = ConnectionManager(max_queue=messages + 1)
+    manager.active_connections[1] = [
+        ClientConnection(ws, 1, manager, manager.max_queue, manager.policy) for ws in sockets
+    ]
+
+    for _ in range(messages):
+        manager._dispatch(1, payload)
+    # Let every writer drain its queue
+    while any(c.queue for c in manager.active_connections[1]):
+        await asyncio.sleep(0)
+    for client in manager.active_connections[1]:
+        await client.close()
+
+
+def measure(fn, size, messages):
+    sockets = [NullWebSocket() for _ in range(size)]
+    payload = encode(SAMPLE)
+    start = time.process_time()
+    asyncio.run(fn(sockets, payload, messages))
+    return (time.process_time() - start) / messages * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--sizes", default="10,100,500,1000")
+    args = parser.parse_args()
+
+    print("CPU microseconds per message")
+    print(f"{'room':>6} {'legacy':>10} {'encoded':>10} {'speedup':>8} {'queued':>10}")
+    for size in [int(s) for s in args.sizes.split(",")]:
+        old = measure(legacy, size, args.messages)
+        new = measure(encoded, size, args.messages)
+        full = measure(queued, size, args.messages)
+        print(f"{size:>6} {old:>10.1f} {new:>10.1f} {old / new:>7.2f}x {full:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+Firestore sync throughput against the in-memory stand-in (tests/fake_firestore.py).
+
+    python benchmarks/bench_firestore_sync.py [--messages 1000] [--chats 20] [--latency-ms 5]
+
+"legacy"  - the old sync_to_firebase loop: per message a chat lookup query, an add(),
+            a lastMessage update() and a per-row Postgres UPDATE + commit
+"batched" - firestore_sync.apply_messages: cached chat paths, WriteBatch commits and one
+            set-based UPDATE per worker batch
+
+Each simulated Firestore round trip sleeps --latency-ms; each Postgres round trip
+sleeps --pg-latency-ms.
+"""
+import os
+import sys
+import time
+import argparse
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+sys.path.insert(0, os.path.join(HERE, "..", "tests"))
+
+from fake_firestore import FakeFirestore
+from firestore_sync import ChatRefs, SYNC_BATCH_SIZE, apply_messages, message_to_firestore
+
+
+def make_rows(messages, chats):
+    rows = {}
+    for i in range(messages):
+        rows[i] = {
+            "id": i, "chat_id": i % chats, "text": f"message {i}", "sender": "1",
+            "time": "10:00", "type": "text", "ispinned": False, "replyto": None,
+        }
+    return rows
+
+
+def seed(fs, chats):
+    for chat_id in range(chats):
+        fs.collection("chats").document(f"legacy-{chat_id}").set({"id": chat_id})
+    fs.calls = 0
+    fs.commits = 0
+
+
+def legacy(fs, rows, pg_latency):
+    for row in rows.values():
+        for doc in fs.collection("chats").where("id", "==", row["chat_id"]).limit(1).stream():
+            data = message_to_firestore(row)
+            doc.reference.collection("messages").add(data)
+            doc.reference.update({"lastMessage": data.get("text"), "timestamp": data.get("time")})
+            time.sleep(pg_latency)  # UPDATE messages SET synced = TRUE ... ; commit
+
+
+def batched(fs, rows, pg_latency, refs=None):
+    # No refs: cold start, every chat is looked up in Firestore once
+    refs = refs or ChatRefs(fs)
+    events = [{"id": i, "kind": "message", "chat_id": row["chat_id"], "entity_id": i} for i, row in rows.items()]
+    for start in range(0, len(events), SYNC_BATCH_SIZE):
+        chunk = events[start:start + SYNC_BATCH_SIZE]
+        time.sleep(pg_latency)  # SELECT outbox batch
+        time.sleep(pg_latency)  # SELECT messages WHERE id = ANY
+        done, _, failed = apply_messages(fs, chunk, rows, refs.resolve)
+        # A failed sync is fast too; make sure the throughput is for real writes
+        assert not failed and len(done) == len(chunk), failed
+        time.sleep(pg_latency)  # UPDATE ... WHERE id = ANY; DELETE outbox; commit
+
+
+def run(name, fn, messages, chats, latency, pg_latency, **kwargs):
+    fs = FakeFirestore()
+    seed(fs, chats)
+    fs.latency = latency
+    rows = make_rows(messages, chats)
+    start = time.perf_counter()
+    fn(fs, rows, pg_latency, **kwargs)
+    elapsed = time.perf_counter() - start
+    written = sum(1 for path in fs.docs if "/messages/" in path)
+    assert written == messages, f"{name}: {written} of {messages} messages reached Firestore"
+    print(f"{name:>16} {messages / elapsed:>10.0f} msg/s {fs.calls:>8} firestore calls {elapsed:>8.2f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--chats", type=int, default=20)
+    parser.add_argument("--latency-ms", type=float, default=5.0)
+    parser.add_argument("--pg-latency-ms", type=float, default=1.0)
+    args = parser.parse_args()
+
+    latency = args.latency_ms / 1000
+    pg_latency = args.pg_latency_ms / 1000
+    print(f"{args.messages} messages across {args.chats} chats, "
+          f"{args.latency_ms}ms Firestore / {args.pg_latency_ms}ms Postgres round trips")
+    run("legacy", legacy, args.messages, args.chats, latency, pg_latency)
+
+    run("batched (cold)", batched, args.messages, args.chats, latency, pg_latency)
+
+    # Warm: paths already loaded from firestore_chat_refs
+    warm = ChatRefs(None)
+    warm.cache = {chat_id: f"chats/legacy-{chat_id}" for chat_id in range(args.chats)}
+    run("batched (warm)", batched, args.messages, args.chats, latency, pg_latency, refs=warm)
+
+
+if __name__ == "__main__":
+    main()
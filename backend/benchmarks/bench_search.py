@@ -0,0 +1,116 @@
+"""
+Message search latency: ILIKE scan vs the tsvector/GIN index behind /search/messages.
+
+    python benchmarks/bench_search.py [--messages 3000000] [--chats 2000] [--runs 5]
+
+Seeds a throwaway schema (bench_search) with --messages rows of generated text, builds
+the same generated search_vector column and GIN index as database.py, then times
+
+"ilike"    - SELECT ... WHERE text ILIKE '%term%' ORDER BY id DESC LIMIT 50
+"tsvector" - the /search/messages query: websearch_to_tsquery + ts_rank_cd + ts_headline
+
+for a rare, a common and a multi-word query. Needs DATABASE_URL; drops the schema afterwards
+unless --keep is given.
+"""
+import os
+import sys
+import time
+import argparse
+import statistics
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+
+from database import get_db_connection
+
+SCHEMA = "bench_search"
+WORDS = [
+    "deploy", "meeting", "budget", "invoice", "release", "design", "review", "lunch",
+    "server", "client", "roadmap", "sprint", "bug", "feature", "launch", "report",
+]
+QUERIES = [
+    ("rare", "zanzibar", "zanzibar"),
+    ("common", "deploy", "deploy"),
+    ("phrase", "budget review", "budget review"),
+]
+
+ILIKE_SQL = f"""
+    SELECT id, text FROM {SCHEMA}.messages
+    WHERE text ILIKE %s
+    ORDER BY id DESC LIMIT 50
+"""
+
+SEARCH_SQL = f"""
+    SELECT page.id, ts_headline('english', page.text, websearch_to_tsquery('english', %s)) AS snippet
+    FROM (
+        SELECT m.id, m.text, ts_rank_cd(m.search_vector, query) AS rank
+        FROM {SCHEMA}.messages m, websearch_to_tsquery('english', %s) query
+        WHERE m.search_vector @@ query
+        ORDER BY rank DESC, m.id DESC LIMIT 50
+    ) page
+"""
+
+
+def seed(cursor, messages, chats):
+    cursor.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+    cursor.execute(f"CREATE SCHEMA {SCHEMA}")
+    cursor.execute(f"CREATE TABLE {SCHEMA}.messages (id BIGINT PRIMARY KEY, chat_id BIGINT, text TEXT)")
+    words = "ARRAY[" + ", ".join(f"'{w}'" for w in WORDS) + "]"
+    # Four random words per message; one in ~100k mentions "zanzibar"
+    start = time.perf_counter()
+    cursor.execute(f"""
+        INSERT INTO {SCHEMA}.messages
+        SELECT i, i %% %s,
+               concat_ws(' ', w[1 + (random() * 15)::int], w[1 + (random() * 15)::int],
+                         w[1 + (random() * 15)::int], w[1 + (random() * 15)::int],
+                         CASE WHEN random() < 0.00001 THEN 'zanzibar' END)
+        FROM generate_series(1, %s) i, (SELECT {words} AS w) words
+    """, (chats, messages))
+    print(f"seeded {messages} messages in {time.perf_counter() - start:.1f}s")
+
+    start = time.perf_counter()
+    cursor.execute(f"""
+        ALTER TABLE {SCHEMA}.messages ADD COLUMN search_vector tsvector
+        GENERATED ALWAYS AS (to_tsvector('english', COALESCE(text, ''))) STORED
+    """)
+    cursor.execute(f"CREATE INDEX ON {SCHEMA}.messages USING GIN (search_vector)")
+    cursor.execute(f"ANALYZE {SCHEMA}.messages")
+    print(f"built search_vector + GIN index in {time.perf_counter() - start:.1f}s")
+
+
+def timed(cursor, sql, params, runs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times), len(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=3_000_000)
+    parser.add_argument("--chats", type=int, default=2000)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--keep", action="store_true", help="keep the seeded schema")
+    args = parser.parse_args()
+
+    conn = get_db_connection()
+    conn.autocommit = True
+    cursor = conn.cursor()
+    try:
+        seed(cursor, args.messages, args.chats)
+        print(f"{'query':<8} {'ilike ms':>10} {'tsvector ms':>12} {'rows':>6}")
+        for name, pattern, query in QUERIES:
+            ilike_ms, _ = timed(cursor, ILIKE_SQL, (f"%{pattern}%",), args.runs)
+            search_ms, rows = timed(cursor, SEARCH_SQL, (query, query), args.runs)
+            print(f"{name:<8} {ilike_ms:>10.1f} {search_ms:>12.1f} {rows:>6}")
+    finally:
+        if not args.keep:
+            cursor.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+import os
+import json
+import time
+import asyncio
+from collections import OrderedDict
+from redis_client import redis_client
+from websocket_manager import NODE_ID
+
+# In-process TTL/LRU caches for hot lookups (chat membership, users).
+# Writers call invalidate(), which drops the key here and tells every other
+# worker over Redis. If Redis is down, other workers fall back on the TTL.
+
+CACHE_TTL = float(os.getenv("CACHE_TTL", "60"))
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "10000"))
+INVALIDATION_CHANNEL = "cache:invalidate"
+
+MISSING = object()
+
+class TTLCache:
+    def __init__(self, name: str, maxsize: int = CACHE_MAX_ENTRIES, ttl: float = CACHE_TTL, clock=time.monotonic):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.data = OrderedDict()  # key -> (expires_at, value)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        entry = self.data.get(key)
+        if entry is None or entry[0] <= self.clock():
+            if entry is not None:
+                del self.data[key]
+            self.misses += 1
+            return MISSING
+        self.data.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, value):
+        self.data[key] = (self.clock() + self.ttl, value)
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key):
+        if self.data.pop(key, None) is not None:
+            self.invalidations += 1
+
+    def clear(self):
+        self.data.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+# chat_id -> frozenset of member user ids
+membership_cache = TTLCache("membership")
+# "id:<id>" / "email:<email>" -> user row dict
+user_cache = TTLCache("users")
+
+CACHES = {c.name: c for c in (membership_cache, user_cache)}
+
+def user_keys(user: dict):
+    keys = [f"id:{user['id']}"]
+    if user.get("email"):
+        keys.append(f"email:{user['email']}")
+    return keys
+
+async def invalidate(cache: TTLCache, *keys):
+    for key in keys:
+        cache.invalidate(key)
+
+    redis = redis_client.get_client()
+    if not redis:
+        return
+    try:
+        await redis.publish(INVALIDATION_CHANNEL, json.dumps({
+            "node": NODE_ID,
+            "cache": cache.name,
+            "keys": list(keys),
+        }))
+    except Exception as e:
+        print(f"Cache invalidation publish failed ({cache.name}): {e}")
+
+class CacheInvalidator:
+    """Applies invalidations published by other workers."""
+
+    def __init__(self, node_id: str = NODE_ID):
+        self.node_id = node_id
+        self.pubsub = None
+        self.task: asyncio.Task = None
+        self.received = 0
+
+    async def start(self):
+        redis = redis_client.get_client()
+        if not redis:
+            print("Redis client not initialized, caches rely on TTL only")
+            return
+        self.pubsub = redis.pubsub()
+        await self.pubsub.subscribe(INVALIDATION_CHANNEL)
+        self.task = asyncio.create_task(self._listen())
+
+    async def _listen(self):
+        while True:
+            try:
+                message = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                if message is None or message["type"] != "message":
+                    continue
+                self.apply(json.loads(message["data"]))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Cache Invalidation Listener Error: {e}")
+                # Whatever we missed may now be stale; start over
+                for cache in CACHES.values():
+                    cache.clear()
+                await asyncio.sleep(1)
+
+    def apply(self, event: dict):
+        if event.get("node") == self.node_id:
+            return
+        cache = CACHES.get(event.get("cache"))
+        if cache is None:
+            return
+        self.received += 1
+        for key in event.get("keys", []):
+            cache.invalidate(key)
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self.task = None
+        if self.pubsub is not None:
+            await self.pubsub.aclose()
+            self.pubsub = None
+
+def stats():
+    return {name: cache.stats() for name, cache in CACHES.items()}
+
+# Global instance
+cache_invalidator = CacheInvalidator()
@@ -0,0 +1,143 @@
+import os
+import asyncio
+from async_database import async_db
+
+# Chat list summary (last message preview, its time, message count) in chat_summaries.
+#
+# Writers call note() after their message commits. Notes are merged per chat in memory
+# and flushed every CHAT_SUMMARY_FLUSH_MS as one upsert, so a busy room costs one
+# summary write per window instead of one per message. Between flushes /chats can
+# lag by up to the window.
+
+CHAT_SUMMARY_FLUSH_MS = float(os.getenv("CHAT_SUMMARY_FLUSH_MS", "250"))
+
+# Latest-wins is decided by message id, so a late flush from another worker can't
+# roll the preview back; counts are always added.
+UPSERT_SQL = '''
+    INSERT INTO chat_summaries AS s (chat_id, last_message_id, last_message, last_message_at, message_count)
+    SELECT u.chat_id, u.message_id, u.preview, u.at, u.n
+    FROM unnest($1::bigint[], $2::bigint[], $3::text[], $4::text[], $5::bigint[])
+        AS u(chat_id, message_id, preview, at, n)
+    JOIN chats c ON c.id = u.chat_id
+    ORDER BY u.chat_id
+    ON CONFLICT (chat_id) DO UPDATE SET
+        last_message_id = GREATEST(s.last_message_id, EXCLUDED.last_message_id),
+        last_message = CASE WHEN EXCLUDED.last_message_id > s.last_message_id
+                            THEN EXCLUDED.last_message ELSE s.last_message END,
+        last_message_at = CASE WHEN EXCLUDED.last_message_id > s.last_message_id
+                               THEN EXCLUDED.last_message_at ELSE s.last_message_at END,
+        message_count = s.message_count + EXCLUDED.message_count,
+        version = s.version + 1
+'''
+
+def preview(text, msg_type) -> str:
+    # Never None for a text message: a NULL last_message reads as "no summary yet"
+    return (text or "") if msg_type == 'text' else f"Sent a {msg_type}"
+
+async def write_summaries(pending: dict):
+    chat_ids = sorted(pending)
+    entries = [pending[c] for c in chat_ids]
+    await async_db.execute(
+        UPSERT_SQL,
+        chat_ids,
+        [e["message_id"] for e in entries],
+        [e["preview"] for e in entries],
+        [e["at"] for e in entries],
+        [e["count"] for e in entries],
+    )
+
+async def reset_summary(conn, chat_id: int, text: str, at: str):
+    """
+    For clear chat, inside its transaction. Pins last_message_id to the newest message
+    being cleared so notes still in flight for those can't bring its preview back.
+    """
+    await conn.execute('''
+        INSERT INTO chat_summaries AS s (chat_id, last_message_id, last_message, last_message_at, message_count)
+        SELECT $1, COALESCE((SELECT max(id) FROM messages WHERE chat_id = $1), 0), $2, $3, 0
+        ON CONFLICT (chat_id) DO UPDATE SET
+            last_message_id = GREATEST(s.last_message_id, EXCLUDED.last_message_id),
+            last_message = EXCLUDED.last_message,
+            last_message_at = EXCLUDED.last_message_at,
+            message_count = 0,
+            version = s.version + 1
+    ''', chat_id, text, at)
+
+class SummaryCoalescer:
+    def __init__(self, write=write_summaries, flush_ms: float = CHAT_SUMMARY_FLUSH_MS):
+        self.write = write
+        self.interval = flush_ms / 1000
+        self.pending = {}  # chat_id -> {"message_id", "preview", "at", "count"}
+        self.task: asyncio.Task = None
+        self.notes = 0
+        self.flushes = 0
+        self.rows_written = 0
+        self.errors = 0
+
+    def note(self, chat_id: int, message_id: int, preview: str, at: str, count: int = 1):
+        self.notes += 1
+        self._merge(chat_id, {"message_id": message_id, "preview": preview, "at": at, "count": count})
+
+    def _merge(self, chat_id: int, new: dict):
+        entry = self.pending.get(chat_id)
+        if entry is None:
+            self.pending[chat_id] = dict(new)
+            return
+        entry["count"] += new["count"]
+        if new["message_id"] > entry["message_id"]:
+            entry.update(message_id=new["message_id"], preview=new["preview"], at=new["at"])
+
+    def discard(self, chat_id: int):
+        # Clear/delete chat: what we were holding for it no longer applies
+        self.pending.pop(chat_id, None)
+
+    async def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    async def flush(self):
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, {}
+        try:
+            await self.write(batch)
+            self.flushes += 1
+            self.rows_written += len(batch)
+        except asyncio.CancelledError:
+            for chat_id, entry in batch.items():
+                self._merge(chat_id, entry)
+            raise
+        except Exception as e:
+            self.errors += 1
+            print(f"Chat summary flush failed ({len(batch)} chats): {e}")
+            # Merge back into whatever arrived meanwhile and retry next window
+            for chat_id, entry in batch.items():
+                self._merge(chat_id, entry)
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self.task = None
+        await self.flush()
+
+    def stats(self):
+        return {
+            "flush_ms": self.interval * 1000,
+            "notes": self.notes,
+            "flushes": self.flushes,
+            "rows_written": self.rows_written,
+            # Notes absorbed per row written; 1.0 means nothing was coalesced
+            "coalescing_ratio": round(self.notes / self.rows_written, 2) if self.rows_written else 0.0,
+            "pending": len(self.pending),
+            "errors": self.errors,
+        }
+
+# Global instance
+chat_summaries = SummaryCoalescer()
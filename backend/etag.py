@@ -0,0 +1,25 @@
+import hashlib
+from fastapi import Request, Response
+
+# --- Conditional GET ---
+# Validators are built from cheap aggregates (change_seq, count, max id) rather than
+# from the response body, so an unchanged resource costs one small query.
+
+def make_etag(*parts):
+    digest = hashlib.sha1("|".join(str(p) for p in parts).encode()).hexdigest()[:20]
+    return f'W/"{digest}"'
+
+def not_modified(request: Request, response: Response, etag: str):
+    """
+    Returns a bodiless 304 if the client's If-None-Match matches etag, otherwise
+    stamps etag on the outgoing response and returns None.
+    """
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        # Weak comparison: W/"x" and "x" match
+        candidates = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        if "*" in candidates or etag.removeprefix("W/") in candidates:
+            return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return None
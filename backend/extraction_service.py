@@ -0,0 +1,217 @@
+import os
+import json
+import uuid
+import signal
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from redis_client import redis_client
+from file_extractor import extract_text
+from ai_service import analyze_text
+
+try:
+    import resource
+except ImportError:  # Windows: no memory limit
+    resource = None
+
+# Document extraction off the event loop.
+#
+# Parsing a big DOCX/PPTX/HTML file is pure CPU and can take seconds, so /analyze-file
+# hands it to a small process pool (spawned, not forked: the parent has DB pools and
+# an event loop running). Each worker process caps its address space at
+# EXTRACT_MEMORY_MB and each job gets EXTRACT_TIMEOUT_S. A job that ignores the alarm
+# (stuck inside C code) is cut off EXTRACT_KILL_GRACE_S later by killing the pool.
+#
+# Files of EXTRACT_JOB_BYTES or more run as jobs: the endpoint returns a job id right
+# away and the result is kept in Redis (or in this process when Redis is down) for
+# EXTRACT_JOB_TTL seconds.
+
+EXTRACT_WORKERS = int(os.getenv("EXTRACT_WORKERS", str(min(4, os.cpu_count() or 1))))
+EXTRACT_TIMEOUT_S = float(os.getenv("EXTRACT_TIMEOUT_S", "60"))
+EXTRACT_KILL_GRACE_S = 5
+EXTRACT_MEMORY_MB = int(os.getenv("EXTRACT_MEMORY_MB", "1024"))
+EXTRACT_QUEUE_MAX = int(os.getenv("EXTRACT_QUEUE_MAX", "32"))
+EXTRACT_JOB_BYTES = int(os.getenv("EXTRACT_JOB_BYTES", str(20 * 1024 * 1024)))
+EXTRACT_JOB_TTL = 3600
+
+class ExtractionTimeout(BaseException):
+    # BaseException so extract_text's catch-all can't turn it into an empty result
+    pass
+
+class ExtractionBusy(Exception):
+    pass
+
+def _on_alarm(signum, frame):
+    raise ExtractionTimeout()
+
+HAS_ALARM = hasattr(signal, "setitimer")
+
+def _init_worker(memory_mb: int):
+    if resource is not None and memory_mb:
+        limit = memory_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    if HAS_ALARM:
+        signal.signal(signal.SIGALRM, _on_alarm)
+
+def run_with_timeout(timeout: float, fn, *args):
+    """Runs in a pool worker."""
+    if HAS_ALARM:
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        return fn(*args)
+    except ExtractionTimeout:
+        raise TimeoutError(f"Extraction took longer than {timeout:g}s")
+    finally:
+        if HAS_ALARM:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+
+def analyze_document(path: str):
+    """Returns (extracted text, IdeaAnalysis)."""
+    text = extract_text(path)
+    analysis = analyze_text(text or f"File: {os.path.basename(path)}")
+    return text, analysis
+
+class ExtractionService:
+    def __init__(self, workers: int = EXTRACT_WORKERS, timeout: float = EXTRACT_TIMEOUT_S,
+                 memory_mb: int = EXTRACT_MEMORY_MB, queue_max: int = EXTRACT_QUEUE_MAX):
+        self.workers = workers
+        self.timeout = timeout
+        self.memory_mb = memory_mb
+        self.queue_max = queue_max
+        self.pool = None
+        self.pending = 0
+        self.jobs = {}  # job id -> state, when Redis is unavailable
+        self.tasks = set()
+        self.completed = 0
+        self.timeouts = 0
+        self.memory_errors = 0
+        self.rejected = 0
+        self.pool_restarts = 0
+
+    def _pool(self):
+        # Created on first use so scripts and tests that import main don't spawn workers
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(self.memory_mb,),
+            )
+        return self.pool
+
+    def _kill_pool(self, pool):
+        if self.pool is pool:
+            self.pool = None
+        # ProcessPoolExecutor can't cancel a running call; kill its processes instead
+        for process in list((pool._processes or {}).values()):
+            process.kill()
+        pool.shutdown(wait=False, cancel_futures=True)
+        self.pool_restarts += 1
+
+    async def extract(self, path: str) -> str:
+        return await self._run(extract_text, path)
+
+    async def analyze(self, path: str):
+        """Extracts and analyzes a document in the pool. Returns (text, IdeaAnalysis)."""
+        return await self._run(analyze_document, path)
+
+    async def _run(self, fn, *args):
+        if self.pending >= self.queue_max:
+            self.rejected += 1
+            raise ExtractionBusy("Too many documents being analyzed, try again shortly")
+        self.pending += 1
+        try:
+            for attempt in range(2):
+                pool = self._pool()
+                future = asyncio.wrap_future(pool.submit(run_with_timeout, self.timeout, fn, *args))
+                # asyncio.wait, not wait_for: our own deadline must stay distinguishable
+                # from a TimeoutError the worker raised when its alarm fired
+                done, _ = await asyncio.wait({future}, timeout=self.timeout + EXTRACT_KILL_GRACE_S)
+                if not done:
+                    # The alarm never fired (blocked inside C code); the worker stays
+                    # wedged until its process is killed
+                    self.timeouts += 1
+                    future.cancel()
+                    self._kill_pool(pool)
+                    raise TimeoutError(f"Extraction took longer than {self.timeout:g}s")
+                try:
+                    result = future.result()
+                    self.completed += 1
+                    return result
+                except BrokenProcessPool:
+                    # A worker died (or another job's timeout killed the pool); retry once
+                    if self.pool is pool:
+                        self._kill_pool(pool)
+                    if attempt:
+                        raise
+                except TimeoutError:
+                    # The worker's alarm fired; the worker itself is fine
+                    self.timeouts += 1
+                    raise TimeoutError(f"Extraction took longer than {self.timeout:g}s")
+                except MemoryError:
+                    self.memory_errors += 1
+                    raise MemoryError(f"Extraction needed more than {self.memory_mb} MB")
+        finally:
+            self.pending -= 1
+
+    # --- Jobs for large files ---
+
+    async def _save_job(self, job_id: str, state: dict):
+        redis = redis_client.get_client()
+        if redis:
+            try:
+                await redis.set(f"extract:job:{job_id}", json.dumps(state, default=str), ex=EXTRACT_JOB_TTL)
+                return
+            except Exception as e:
+                print(f"Extraction job {job_id} not saved to Redis: {e}")
+        self.jobs[job_id] = state
+
+    async def get_job(self, job_id: str):
+        if job_id in self.jobs:
+            return self.jobs[job_id]
+        redis = redis_client.get_client()
+        if not redis:
+            return None
+        raw = await redis.get(f"extract:job:{job_id}")
+        return json.loads(raw) if raw else None
+
+    async def start_job(self, work) -> str:
+        """Runs the coroutine `work` in the background; its result becomes the job's result."""
+        job_id = uuid.uuid4().hex
+        await self._save_job(job_id, {"status": "pending"})
+
+        async def run():
+            try:
+                result = await work
+                await self._save_job(job_id, {"status": "done", "result": result})
+            except Exception as e:
+                print(f"Extraction job {job_id} failed: {e}")
+                await self._save_job(job_id, {"status": "failed", "error": str(e)})
+
+        task = asyncio.create_task(run())
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return job_id
+
+    async def close(self):
+        for task in list(self.tasks):
+            task.cancel()
+        if self.pool is not None:
+            pool, self.pool = self.pool, None
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "pending": self.pending,
+            "running_jobs": len(self.tasks),
+            "completed": self.completed,
+            "timeouts": self.timeouts,
+            "memory_errors": self.memory_errors,
+            "rejected": self.rejected,
+            "pool_restarts": self.pool_restarts,
+        }
+
+# Global instance
+extraction = ExtractionService()
@@ -1,60 +1,201 @@
 import os
-try:
-    from docx import Document
-except ImportError:
-    Document = None
+import re
+import zipfile
+import xml.etree.ElementTree as ET
+from html.parser import HTMLParser
 
 try:
-    from pptx import Presentation
+    from pypdf import PdfReader
 except ImportError:
-    Presentation = None
+    PdfReader = None
 
 try:
-    from bs4 import BeautifulSoup
+    from openpyxl import load_workbook
 except ImportError:
-    BeautifulSoup = None
+    load_workbook = None
+
+# Bump whenever extract_text's output for the same file changes (see analysis_cache.py)
+EXTRACTOR_VERSION = "2"
+
+# Most characters extract_text returns; extractors stop reading the file once it's reached
+EXTRACT_MAX_CHARS = int(os.getenv("EXTRACT_MAX_CHARS", "2000000"))
+
+# Every extractor below is a generator of text blocks (paragraphs, slides' paragraphs,
+# sheet rows, PDF pages), reading the file incrementally, so memory stays flat however
+# big the file is and a caller that has enough text can simply stop iterating.
+
+W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+A = "{http://schemas.openxmlformats.org/drawingml/2006/main}"
+
+def _xml_paragraphs(source, paragraph_tag, text_tag, tab_tag=None, break_tag=None):
+    """
+    Yields the text of each paragraph_tag element of an XML stream. Finished elements
+    are dropped from the tree as soon as they end, so only the current path is in memory.
+    """
+    stack = []
+    parts = []
+    for event, elem in ET.iterparse(source, events=("start", "end")):
+        if event == "start":
+            stack.append(elem)
+            continue
+        stack.pop()
+        if elem.tag == text_tag:
+            parts.append(elem.text or "")
+        elif elem.tag == tab_tag:
+            parts.append("\t")
+        elif elem.tag == break_tag:
+            parts.append("\n")
+        elif elem.tag == paragraph_tag:
+            yield "".join(parts)
+            parts = []
+        if stack:
+            stack[-1].remove(elem)
+
+def iter_docx(file_path: str):
+    # Body paragraphs, tables included, straight from word/document.xml
+    with zipfile.ZipFile(file_path) as zf, zf.open("word/document.xml") as part:
+        yield from _xml_paragraphs(part, f"{W}p", f"{W}t", f"{W}tab", f"{W}br")
+
+def _slide_number(name: str) -> int:
+    return int(re.search(r"(\d+)\.xml$", name).group(1))
+
+def iter_pptx(file_path: str):
+    with zipfile.ZipFile(file_path) as zf:
+        slides = [n for n in zf.namelist() if re.fullmatch(r"ppt/slides/slide\d+\.xml", n)]
+        for name in sorted(slides, key=_slide_number):
+            with zf.open(name) as part:
+                for paragraph in _xml_paragraphs(part, f"{A}p", f"{A}t", break_tag=f"{A}br"):
+                    if paragraph:
+                        yield paragraph
+
+def iter_xlsx(file_path: str):
+    # read_only streams rows from the sheet XML instead of loading every cell
+    workbook = load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        for sheet in workbook.worksheets:
+            yield f"# {sheet.title}"
+            for row in sheet.iter_rows(values_only=True):
+                values = [str(v) for v in row if v is not None]
+                if values:
+                    yield "\t".join(values)
+    finally:
+        workbook.close()
+
+def iter_pdf(file_path: str):
+    # Given a path, PdfReader reads the whole file into memory; given a file object it
+    # seeks around in it. Pages are parsed one at a time, as they are asked for.
+    with open(file_path, "rb") as f:
+        reader = PdfReader(f)
+        for page in reader.pages:
+            yield page.extract_text() or ""
+
+class _HtmlText(HTMLParser):
+    SKIP = {"script", "style", "noscript", "template"}
+    BLOCKS = {"p", "div", "br", "li", "tr", "h1", "h2", "h3", "h4", "h5", "h6",
+              "section", "article", "header", "footer", "table", "ul", "ol", "pre", "blockquote", "title"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self.skipping = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP:
+            self.skipping += 1
+        elif tag in self.BLOCKS:
+            self.parts.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP:
+            self.skipping = max(0, self.skipping - 1)
+        elif tag in self.BLOCKS:
+            self.parts.append("\n")
+
+    def handle_data(self, data):
+        if not self.skipping:
+            self.parts.append(data)
 
-def extract_text(file_path: str) -> str:
+    def take(self):
+        text, self.parts = "".join(self.parts), []
+        return text
+
+def _html_lines(text: str):
+    for line in text.split("\n"):
+        line = " ".join(line.split())
+        if line:
+            yield line
+
+def iter_html(file_path: str, block_size: int = 64 * 1024):
+    parser = _HtmlText()
+    pending = ""
+    with open(file_path, "r", encoding="utf-8", errors="replace") as f:
+        for block in iter(lambda: f.read(block_size), ""):
+            parser.feed(block)
+            # The last line may continue in the next block
+            pending, _, last = (pending + parser.take()).rpartition("\n")
+            yield from _html_lines(pending)
+            pending = last
+            if len(pending) > block_size:
+                # A page with no line breaks at all; don't buffer all of it
+                yield from _html_lines(pending)
+                pending = ""
+    parser.close()
+    yield from _html_lines(pending + parser.take())
+
+def iter_txt(file_path: str, block_size: int = 64 * 1024):
+    with open(file_path, "r", encoding="utf-8") as f:
+        yield from iter(lambda: f.read(block_size), "")
+
+# extension -> (extractor, library it needs or None)
+EXTRACTORS = {
+    ".docx": (iter_docx, None),
+    ".pptx": (iter_pptx, None),
+    ".xlsx": (iter_xlsx, ("openpyxl", load_workbook)),
+    ".pdf": (iter_pdf, ("pypdf", PdfReader)),
+    ".html": (iter_html, None),
+    ".htm": (iter_html, None),
+    ".txt": (iter_txt, None),
+}
+
+def extract_text(file_path: str, max_chars: int = None) -> str:
     """
-    Extracts text content from various file formats.
+    Extracts text content from various file formats, up to max_chars characters
+    (EXTRACT_MAX_CHARS by default).
     """
     if not os.path.exists(file_path):
         return ""
 
     ext = os.path.splitext(file_path)[1].lower()
+    if ext not in EXTRACTORS:
+        return f"Unsupported file format: {ext}"
+    extractor, dependency = EXTRACTORS[ext]
+    if dependency is not None and dependency[1] is None:
+        return f"Error: {dependency[0]} library not installed."
 
+    budget = max_chars or EXTRACT_MAX_CHARS
+    # Plain text is already one stream; everything else is blocks joined by newlines
+    separator = "" if ext == ".txt" else "\n"
+    text = []
+    size = 0
     try:
-        if ext == ".docx":
-            if Document is None:
-                return "Error: python-docx library not installed."
-            doc = Document(file_path)
-            return "\n".join([para.text for para in doc.paragraphs])
-        
-        elif ext == ".pptx":
-            if Presentation is None:
-                return "Error: python-pptx library not installed."
-            prs = Presentation(file_path)
-            text = []
-            for slide in prs.slides:
-                for shape in slide.shapes:
-                    if hasattr(shape, "text"):
-                        text.append(shape.text)
-            return "\n".join(text)
-        
-        elif ext == ".html" or ext == ".htm":
-            if BeautifulSoup is None:
-                return "Error: beautifulsoup4 library not installed."
-            with open(file_path, "r", encoding="utf-8") as f:
-                soup = BeautifulSoup(f, "lxml")
-                return soup.get_text(separator="\n")
-        
-        elif ext == ".txt":
-            with open(file_path, "r", encoding="utf-8") as f:
-                return f.read()
-        
-        else:
-            return f"Unsupported file format: {ext}"
-            
+        blocks = extractor(file_path)
+        try:
+            for block in blocks:
+                if text:
+                    block = separator + block
+                if size + len(block) >= budget:
+                    text.append(block[:budget - size])
+                    break
+                text.append(block)
+                size += len(block)
+        finally:
+            # Stops the generator now, closing the file even when we broke out early
+            blocks.close()
+        return "".join(text)
+
+    except MemoryError:
+        # Hit the extraction worker's memory limit; let the caller report it
+        raise
     except Exception as e:
         print(f"Error extracting text from {file_path}: {e}")
         return ""
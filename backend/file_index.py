@@ -0,0 +1,161 @@
+import os
+from async_database import async_db
+from analysis_cache import analysis_cache
+
+# Extracted text of uploaded documents, in file_texts, for /search/files.
+#
+# Each file is split into chunks of about FILE_INDEX_CHUNK_CHARS characters (Postgres
+# caps a tsvector at 1 MB, and ts_headline cost grows with the text it has to scan).
+# A chunk remembers where it starts in the full text so matches can be reported as
+# offsets into the document. Re-indexing a file replaces all of its chunks.
+
+FILE_INDEX_CHUNK_CHARS = int(os.getenv("FILE_INDEX_CHUNK_CHARS", "4000"))
+
+# Markers ts_headline puts around matched words; chosen so they can't occur in
+# extracted text. The fragment delimiter is the same idea.
+MATCH_START = "\x02"
+MATCH_END = "\x03"
+FRAGMENT_DELIMITER = "\x1e"
+HEADLINE_OPTIONS = (
+    f'StartSel="{MATCH_START}", StopSel="{MATCH_END}", FragmentDelimiter="{FRAGMENT_DELIMITER}", '
+    'MaxFragments=3, MaxWords=25, MinWords=8'
+)
+
+INSERT_SQL = '''
+    INSERT INTO file_texts (filename, chunk_no, char_start, text, sha256)
+    SELECT $1, u.chunk_no, u.char_start, u.text, $5
+    FROM unnest($2::int[], $3::int[], $4::text[]) AS u(chunk_no, char_start, text)
+'''
+
+
+# Best chunk per file, ranked; headlines only for the page of files returned
+SEARCH_SQL = '''
+    WITH hits AS (
+        SELECT t.filename, t.chunk_no, t.char_start, t.text, ts_rank_cd(t.search_vector, query) AS rank
+        FROM file_texts t, websearch_to_tsquery('english', $1) query
+        WHERE t.search_vector @@ query
+    ), best AS (
+        SELECT DISTINCT ON (filename) *, count(*) OVER (PARTITION BY filename) AS matching_chunks
+        FROM hits
+        ORDER BY filename, rank DESC, chunk_no
+    ), page AS (
+        SELECT * FROM best ORDER BY rank DESC, filename LIMIT $2
+    )
+    SELECT page.filename, page.chunk_no, page.char_start, page.rank, page.matching_chunks, page.text,
+           ts_headline('english', page.text, websearch_to_tsquery('english', $1), $3) AS headline
+    FROM page
+    ORDER BY page.rank DESC, page.filename
+'''
+
+def is_extracted(text: str) -> bool:
+    # extract_text reports problems in-band; only real document text gets indexed
+    return bool(text) and not text.startswith(("Unsupported file format:", "Error:"))
+
+def chunks(text: str, size: int = None):
+    """Yields (char_start, chunk), cutting at whitespace where possible."""
+    size = size or FILE_INDEX_CHUNK_CHARS
+    start = 0
+    while start < len(text):
+        end = min(start + size, len(text))
+        if end < len(text):
+            # Don't split a word unless the chunk is one enormous word
+            cut = text.rfind(" ", start + size // 2, end)
+            cut = max(cut, text.rfind("\n", start + size // 2, end))
+            if cut > start:
+                end = cut + 1
+        yield start, text[start:end]
+        start = end
+
+def locate_snippets(chunk: str, char_start: int, headline: str):
+    """
+    Turns a ts_headline result into snippets with offsets into the whole document:
+    [{"text", "start", "end", "matches": [[start, end], ...]}]. Fragments that can't be
+    found verbatim in the chunk (ts_headline rewrote markup) keep their text but get no offsets.
+    """
+    snippets = []
+    search_from = 0
+    for fragment in headline.split(FRAGMENT_DELIMITER):
+        fragment = fragment.strip()
+        if not fragment:
+            continue
+        plain = []
+        marks = []
+        pos = 0
+        for i, part in enumerate(fragment.split(MATCH_START)):
+            if i:
+                word, _, rest = part.partition(MATCH_END)
+                marks.append((pos, pos + len(word)))
+                plain.append(word)
+                pos += len(word)
+                part = rest
+            plain.append(part)
+            pos += len(part)
+        plain = "".join(plain)
+
+        at = chunk.find(plain, search_from)
+        if at < 0:
+            at = chunk.find(plain)
+        if at < 0:
+            snippets.append({"text": plain, "start": None, "end": None, "matches": []})
+            continue
+        search_from = at + len(plain)
+        base = char_start + at
+        snippets.append({
+            "text": plain,
+            "start": base,
+            "end": base + len(plain),
+            "matches": [[base + s, base + e] for s, e in marks],
+        })
+    return snippets
+
+async def index_text(filename: str, text: str, sha256: str = None) -> int:
+    """
+    Replaces the indexed text of a file. Returns the number of chunks stored; 0 when
+    there was nothing to index or the file is already indexed with this content.
+    """
+    if not is_extracted(text):
+        return 0
+    async with async_db.transaction() as conn:
+        if sha256 is not None:
+            indexed = await conn.fetchval(
+                "SELECT sha256 FROM file_texts WHERE filename = $1 AND chunk_no = 0 FOR UPDATE", filename
+            )
+            if indexed == sha256:
+                return 0
+        parts = list(chunks(text.replace("\x00", "")))  # Postgres text can't hold NUL
+        await conn.execute("DELETE FROM file_texts WHERE filename = $1", filename)
+        await conn.execute(
+            INSERT_SQL,
+            filename,
+            list(range(len(parts))),
+            [start for start, _ in parts],
+            [chunk for _, chunk in parts],
+            sha256,
+        )
+    return len(parts)
+
+async def index_upload(filename: str):
+    """
+    Background task for /upload: extract in the extraction pool (which also warms the
+    analysis cache for a later /analyze-file), then index.
+    """
+    try:
+        text, _, sha256 = await analysis_cache.analyze(os.path.join("uploads", filename))
+        chunk_count = await index_text(filename, text, sha256)
+        if chunk_count:
+            print(f"Indexed {filename}: {len(text)} chars in {chunk_count} chunks")
+    except Exception as e:
+        print(f"Error indexing {filename}: {e}")
+
+async def search_files(q: str, limit: int):
+    rows = await async_db.fetch(SEARCH_SQL, q, limit, HEADLINE_OPTIONS)
+    return [
+        {
+            "filename": row["filename"],
+            "url": f"/uploads/{row['filename']}",
+            "rank": row["rank"],
+            "matching_chunks": row["matching_chunks"],
+            "snippets": locate_snippets(row["text"], row["char_start"], row["headline"]),
+        }
+        for row in rows
+    ]
@@ -0,0 +1,622 @@
+import os
+import json
+import time
+import select
+import threading
+import psycopg2
+from database import DATABASE_URL, get_db_connection, get_db_cursor
+
+# Postgres -> Firestore replication.
+#
+# Mutations call enqueue_sync() inside their own transaction, so an outbox row exists
+# exactly when the change committed. One worker per deployment (whichever process holds
+# the advisory lock) drains the outbox in id order, in batches, with retries.
+
+SYNC_BATCH_SIZE = int(os.getenv("SYNC_BATCH_SIZE", "200"))
+# Fallback poll in case a NOTIFY is missed (e.g. while reconnecting)
+SYNC_POLL_INTERVAL = float(os.getenv("SYNC_POLL_INTERVAL", "5"))
+# Followers retry the leader lock this often
+SYNC_LEADER_RETRY = float(os.getenv("SYNC_LEADER_RETRY", "10"))
+SYNC_RETRY_BASE = float(os.getenv("SYNC_RETRY_BASE", "2"))
+SYNC_RETRY_MAX = float(os.getenv("SYNC_RETRY_MAX", "300"))
+# After this many failures an event is parked (dead = TRUE) instead of blocking its chat
+SYNC_MAX_ATTEMPTS = int(os.getenv("SYNC_MAX_ATTEMPTS", "20"))
+# Firestore caps a WriteBatch at 500 writes; stay clear of it
+FIRESTORE_BATCH_LIMIT = int(os.getenv("FIRESTORE_BATCH_LIMIT", "400"))
+# Consecutive all-failed batches before we stop calling Firestore for a while
+SYNC_BREAKER_THRESHOLD = int(os.getenv("SYNC_BREAKER_THRESHOLD", "5"))
+SYNC_BREAKER_COOLDOWN = float(os.getenv("SYNC_BREAKER_COOLDOWN", "30"))
+# How long "this chat has no Firestore doc" is believed before the query runs again
+SYNC_NO_DOC_TTL = float(os.getenv("SYNC_NO_DOC_TTL", "600"))
+
+SYNC_LOCK_KEY = 7_301_166_001  # pg_try_advisory_lock key, any constant unique to this app
+NOTIFY_CHANNEL = "sync_outbox"
+
+# Outbox kinds, grouped by handler. Consecutive events of a group are applied together.
+#   message        - new message (entity_id = message id)
+#   message_update - edit / pin / soft delete of an existing message
+#   clear_chat     - all messages removed (payload: {"timestamp"})
+#   delete_chat    - chat and its messages removed
+#   idea           - Firestore-only idea doc (payload: the doc)
+EVENT_GROUPS = {
+    "message": "messages",
+    "message_update": "messages",
+    "clear_chat": "chat",
+    "delete_chat": "chat",
+    "idea": "idea",
+}
+
+# messages columns come back lowercased from Postgres; Firestore keeps the camelCase names
+MESSAGE_FIELDS = {
+    "id": "id",
+    "text": "text",
+    "sender": "sender",
+    "time": "time",
+    "type": "type",
+    "fileurl": "fileUrl",
+    "filename": "fileName",
+    "filesize": "fileSize",
+    "ispinned": "isPinned",
+    "callroomname": "callRoomName",
+    "callstatus": "callStatus",
+    "isvoice": "isVoice",
+    "replyto": "replyTo",
+    "isdeleted": "isDeleted",
+    "deleted_for": "deleted_for",
+}
+
+def message_to_firestore(row) -> dict:
+    data = {}
+    for column, field in MESSAGE_FIELDS.items():
+        if column in row:
+            data[field] = row[column]
+    data["isPinned"] = bool(data.get("isPinned"))
+    if data.get("replyTo"):
+        try:
+            data["replyTo"] = json.loads(data["replyTo"])
+        except (TypeError, ValueError):
+            pass
+    return data
+
+async def enqueue_sync(conn, kind: str, chat_id: int = None, entity_id: int = None, payload: dict = None):
+    """
+    Records a change for the sync worker. Call with the same asyncpg connection,
+    inside the same transaction, as the write itself.
+    """
+    await conn.execute(
+        "INSERT INTO sync_outbox (kind, chat_id, entity_id, payload) VALUES ($1, $2, $3, $4)",
+        kind, chat_id, entity_id, json.dumps(payload) if payload is not None else None
+    )
+    # Delivered on commit; identical notifications in one transaction collapse into one
+    await conn.execute(f"NOTIFY {NOTIFY_CHANNEL}")
+
+async def enqueue_sync_many(conn, kind: str, items):
+    """enqueue_sync for many (chat_id, entity_id) pairs in one statement."""
+    if not items:
+        return
+    chat_ids, entity_ids = zip(*items)
+    await conn.execute(
+        "INSERT INTO sync_outbox (kind, chat_id, entity_id) "
+        "SELECT $1, * FROM unnest($2::bigint[], $3::bigint[])",
+        kind, list(chat_ids), list(entity_ids)
+    )
+    await conn.execute(f"NOTIFY {NOTIFY_CHANNEL}")
+
+class CircuitBreaker:
+    """
+    closed -> calls go through. After `threshold` consecutive failures -> open: no calls
+    for `cooldown` seconds. Then half_open: one trial; success closes, failure re-opens.
+    """
+
+    def __init__(self, threshold: int, cooldown: float, clock=time.monotonic):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.clock = clock
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trips = 0
+
+    def allow(self) -> bool:
+        if self.state == "open" and self.clock() - self.opened_at >= self.cooldown:
+            self.state = "half_open"
+        return self.state != "open"
+
+    def retry_in(self) -> float:
+        if self.state != "open":
+            return 0.0
+        return max(0.0, self.cooldown - (self.clock() - self.opened_at))
+
+    def record_success(self):
+        if self.state != "closed":
+            print("Sync: Firestore reachable again, circuit closed")
+        self.state = "closed"
+        self.failures = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= self.threshold:
+            if self.state != "open":
+                self.trips += 1
+                print(f"Sync: Firestore failing, circuit open for {self.cooldown}s")
+            self.state = "open"
+            self.opened_at = self.clock()
+
+def find_chat_path(fs_db, chat_id: int):
+    # Legacy chat docs have random ids, so the only way in is a query on the id field
+    query = fs_db.collection("chats").where("id", "==", chat_id).limit(1).stream()
+    for doc in query:
+        return doc.reference.path
+    return None
+
+class ChatRefs:
+    """
+    chat_id -> Firestore document path, cached in memory and persisted in
+    firestore_chat_refs so the "where id == chat_id" query runs once per chat, ever.
+
+    Chats without a doc (created through the API, not the old Firestore frontend) are
+    remembered too, as a NULL doc_path, for no_doc_ttl seconds before asking again.
+    """
+
+    def __init__(self, fs_db, no_doc_ttl: float = SYNC_NO_DOC_TTL, clock=time.monotonic):
+        self.fs_db = fs_db
+        self.no_doc_ttl = no_doc_ttl
+        self.clock = clock
+        self.cache = {}
+        # chat_id -> clock() after which a missing doc is looked up again
+        self.no_doc = {}
+        # Found via Firestore during this batch (None = no doc); saved with the batch's commit
+        self.discovered = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _known_missing(self, chat_id) -> bool:
+        expires = self.no_doc.get(chat_id)
+        if expires is None:
+            return False
+        if expires <= self.clock():
+            del self.no_doc[chat_id]
+            return False
+        return True
+
+    def prefetch(self, cursor, chat_ids):
+        missing = [c for c in set(chat_ids) if c not in self.cache and not self._known_missing(c)]
+        if not missing:
+            return
+        cursor.execute('''
+            SELECT chat_id, doc_path, EXTRACT(EPOCH FROM now() - checked_at) AS age
+            FROM firestore_chat_refs
+            WHERE chat_id = ANY(%s) AND (doc_path IS NOT NULL OR checked_at > now() - make_interval(secs => %s))
+        ''', (missing, self.no_doc_ttl))
+        for row in cursor.fetchall():
+            if row["doc_path"] is None:
+                self.no_doc[row["chat_id"]] = self.clock() + self.no_doc_ttl - float(row["age"])
+            else:
+                self.cache[row["chat_id"]] = row["doc_path"]
+
+    def resolve(self, chat_id):
+        path = self.cache.get(chat_id)
+        if path is not None or self._known_missing(chat_id):
+            self.hits += 1
+            return path
+        self.misses += 1
+        path = find_chat_path(self.fs_db, chat_id)
+        if path is not None:
+            self.cache[chat_id] = path
+        else:
+            self.no_doc[chat_id] = self.clock() + self.no_doc_ttl
+        self.discovered[chat_id] = path
+        return path
+
+    def save(self, cursor):
+        if not self.discovered:
+            return
+        # Skip chats already deleted in Postgres (their delete_chat event may still be
+        # queued behind this batch); inserting them would fail the FK and the batch with it
+        chat_ids = list(self.discovered)
+        cursor.execute('''
+            INSERT INTO firestore_chat_refs (chat_id, doc_path, checked_at)
+            SELECT u.chat_id, u.doc_path, now()
+            FROM unnest(%s::bigint[], %s::text[]) AS u(chat_id, doc_path)
+            WHERE EXISTS (SELECT 1 FROM chats c WHERE c.id = u.chat_id)
+            ON CONFLICT (chat_id) DO UPDATE SET doc_path = EXCLUDED.doc_path, checked_at = EXCLUDED.checked_at
+        ''', (chat_ids, [self.discovered[c] for c in chat_ids]))
+
+    def committed(self):
+        self.discovered = {}
+
+    def rollback(self):
+        # The batch that found these didn't commit; look them up again next time
+        for chat_id in self.discovered:
+            self.cache.pop(chat_id, None)
+            self.no_doc.pop(chat_id, None)
+        self.discovered = {}
+
+    def forget(self, chat_id):
+        self.cache.pop(chat_id, None)
+        self.no_doc.pop(chat_id, None)
+        self.discovered.pop(chat_id, None)
+
+def find_message_ref(chat_ref, message_id: int):
+    # Messages that started life in Firestore have random doc ids; newer ones use the message id
+    for doc in chat_ref.collection("messages").where("id", "==", message_id).limit(1).stream():
+        return doc.reference
+    return chat_ref.collection("messages").document(str(message_id))
+
+def apply_messages(fs_db, events, rows, resolve=None):
+    """
+    Writes a batch of 'message' events to Firestore using WriteBatch commits.
+    rows maps message id -> current Postgres row (missing if deleted since).
+    resolve maps chat_id -> chat document path (None if the chat has no doc).
+    Returns (done event ids, synced message ids, {event id: error}).
+    A chat's events succeed or fail together so they retry in order.
+    """
+    resolve = resolve or (lambda chat_id: find_chat_path(fs_db, chat_id))
+
+    by_chat = {}
+    for event in events:
+        by_chat.setdefault(event["chat_id"], []).append(event)
+
+    done, synced, failed = [], [], {}
+    batch = fs_db.batch()
+    in_batch = []  # (chat events, message ids) riding on the current batch
+
+    def fail(chat_events, error):
+        for event in chat_events:
+            failed[event["id"]] = str(error)
+
+    def commit(write_batch, members):
+        try:
+            if len(write_batch):
+                write_batch.commit()
+        except Exception as e:
+            print(f"Sync: batch of {len(members)} chat(s) failed: {e}")
+            for chat_events, _ in members:
+                fail(chat_events, e)
+            return False
+        for chat_events, ids in members:
+            done.extend(e["id"] for e in chat_events)
+            synced.extend(ids)
+        return True
+
+    for chat_id, chat_events in by_chat.items():
+        try:
+            path = resolve(chat_id)
+        except Exception as e:
+            print(f"Sync: could not resolve chat {chat_id}: {e}")
+            fail(chat_events, e)
+            continue
+        if path is None:
+            print(f"Sync: no Firestore doc for chat {chat_id}, skipping {len(chat_events)} event(s)")
+            done.extend(e["id"] for e in chat_events)
+            # Nothing to mirror them to; mark them synced so _backfill doesn't queue them again
+            synced.extend(e["entity_id"] for e in chat_events if e["entity_id"] in rows)
+            continue
+
+        chat_ref = fs_db.document(path)
+        writes, ids, last = [], [], None
+        try:
+            for event in chat_events:
+                row = rows.get(event["entity_id"])
+                if row is None:
+                    continue
+                data = message_to_firestore(row)
+                if event["kind"] == "message_update":
+                    ref = find_message_ref(chat_ref, data["id"])
+                else:
+                    # Doc id = message id, so a retried event overwrites instead of duplicating
+                    ref = chat_ref.collection("messages").document(str(data["id"]))
+                    last = data
+                writes.append(("set", ref, data))
+                ids.append(data["id"])
+        except Exception as e:
+            print(f"Sync: chat {chat_id} failed: {e}")
+            fail(chat_events, e)
+            continue
+        if last:
+            # One lastMessage update per chat per batch, not per message
+            writes.append(("update", chat_ref, {
+                "lastMessage": last.get("text", "Sent a file"),
+                "timestamp": last.get("time")
+            }))
+
+        if len(batch) + len(writes) > FIRESTORE_BATCH_LIMIT:
+            commit(batch, in_batch)
+            batch, in_batch = fs_db.batch(), []
+
+        if len(writes) > FIRESTORE_BATCH_LIMIT:
+            # A single chat bigger than one batch gets its own run of commits.
+            # Sets are idempotent, so a retry after a partial failure is harmless.
+            try:
+                for i in range(0, len(writes), FIRESTORE_BATCH_LIMIT):
+                    chunk = fs_db.batch()
+                    for op, ref, data in writes[i:i + FIRESTORE_BATCH_LIMIT]:
+                        getattr(chunk, op)(ref, data)
+                    chunk.commit()
+            except Exception as e:
+                print(f"Sync: chat {chat_id} failed: {e}")
+                fail(chat_events, e)
+                continue
+            done.extend(e["id"] for e in chat_events)
+            synced.extend(ids)
+            continue
+
+        for op, ref, data in writes:
+            getattr(batch, op)(ref, data)
+        in_batch.append((chat_events, ids))
+
+    commit(batch, in_batch)
+    return done, synced, failed
+
+def delete_messages(fs_db, chat_ref):
+    batch = fs_db.batch()
+    for msg in chat_ref.collection("messages").stream():
+        batch.delete(msg.reference)
+        if len(batch) >= FIRESTORE_BATCH_LIMIT:
+            batch.commit()
+            batch = fs_db.batch()
+    if len(batch):
+        batch.commit()
+
+def apply_chat_event(fs_db, event, resolve):
+    path = resolve(event["chat_id"])
+    if path is None:
+        return
+    chat_ref = fs_db.document(path)
+    delete_messages(fs_db, chat_ref)
+    if event["kind"] == "clear_chat":
+        payload = json.loads(event["payload"] or "{}")
+        chat_ref.update({"lastMessage": "Chat cleared", "timestamp": payload.get("timestamp")})
+    else:
+        chat_ref.delete()
+
+def apply_idea(fs_db, event):
+    idea = json.loads(event["payload"])
+    # Doc id = idea id so a retry doesn't add it twice
+    fs_db.collection("ideas").document(str(idea["id"])).set(idea)
+
+class SyncWorker:
+    def __init__(self):
+        self.fs_db = None
+        self.chat_refs = None
+        self.thread = None
+        self.is_leader = False
+        self._stop = threading.Event()
+        self._lock_conn = None
+
+        self.breaker = CircuitBreaker(SYNC_BREAKER_THRESHOLD, SYNC_BREAKER_COOLDOWN)
+        self.processed = 0
+        self.failures = 0
+        self.batches = 0
+        self.last_batch_ms = 0.0
+
+    def start(self, fs_db):
+        self.fs_db = fs_db
+        self.chat_refs = ChatRefs(fs_db)
+        self._stop.clear()
+        self.thread = threading.Thread(target=self._run, name="firestore-sync", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self.thread:
+            self.thread.join(timeout=SYNC_POLL_INTERVAL + 1)
+            self.thread = None
+        self._drop_leadership()
+
+    def _lead(self):
+        # A dedicated session holds the advisory lock; losing the session releases it
+        if self._lock_conn is not None and not self._lock_conn.closed:
+            return True
+        conn = psycopg2.connect(DATABASE_URL)
+        conn.autocommit = True
+        cursor = conn.cursor()
+        cursor.execute("SELECT pg_try_advisory_lock(%s)", (SYNC_LOCK_KEY,))
+        if not cursor.fetchone()[0]:
+            conn.close()
+            return False
+        cursor.execute(f"LISTEN {NOTIFY_CHANNEL}")
+        self._lock_conn = conn
+        self.is_leader = True
+        print("Sync: this process is the Firestore sync leader")
+        self._backfill()
+        return True
+
+    def _drop_leadership(self):
+        if self._lock_conn is not None:
+            try:
+                self._lock_conn.close()
+            except Exception:
+                pass
+        self._lock_conn = None
+        self.is_leader = False
+
+    def _backfill(self):
+        # Rows written before the outbox existed; cheap no-op once they're drained
+        conn = get_db_connection()
+        try:
+            conn.cursor().execute('''
+                INSERT INTO sync_outbox (kind, chat_id, entity_id)
+                SELECT 'message', m.chat_id, m.id FROM messages m
+                WHERE m.synced = FALSE
+                  AND NOT EXISTS (
+                      SELECT 1 FROM sync_outbox o WHERE o.kind = 'message' AND o.entity_id = m.id
+                  )
+                ORDER BY m.id
+            ''')
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                if not self._lead():
+                    self._stop.wait(SYNC_LEADER_RETRY)
+                    continue
+                if not self.breaker.allow():
+                    # Firestore is down: leave the outbox alone, it replays on recovery
+                    self._stop.wait(min(self.breaker.retry_in(), SYNC_POLL_INTERVAL))
+                    continue
+                while self._drain_batch():
+                    if self._stop.is_set():
+                        return
+                self._wait_for_work()
+            except Exception as e:
+                print(f"Sync worker error: {e}")
+                self._drop_leadership()
+                self._stop.wait(1)
+
+    def _wait_for_work(self):
+        conn = self._lock_conn
+        ready, _, _ = select.select([conn], [], [], SYNC_POLL_INTERVAL)
+        if ready:
+            conn.poll()
+            conn.notifies.clear()
+
+    def _drain_batch(self):
+        """Processes one batch. Returns True if there may be more to do."""
+        start = time.monotonic()
+        conn = get_db_connection()
+        try:
+            cursor = get_db_cursor(conn)
+            # Oldest due events, skipping chats whose earlier event is still backing off
+            cursor.execute('''
+                SELECT o.* FROM sync_outbox o
+                WHERE NOT o.dead AND o.next_attempt_at <= NOW()
+                  AND NOT EXISTS (
+                      SELECT 1 FROM sync_outbox b
+                      WHERE NOT b.dead AND b.chat_id = o.chat_id AND b.id < o.id
+                        AND b.next_attempt_at > NOW()
+                  )
+                ORDER BY o.id
+                LIMIT %s
+            ''', (SYNC_BATCH_SIZE,))
+            events = cursor.fetchall()
+            if not events:
+                return False
+
+            done, synced, failed = self._apply(cursor, events)
+            self.chat_refs.save(cursor)
+            if done:
+                self.breaker.record_success()
+            elif failed:
+                self.breaker.record_failure()
+
+            if synced:
+                cursor.execute("UPDATE messages SET synced = TRUE WHERE id = ANY(%s)", (synced,))
+            if done:
+                cursor.execute("DELETE FROM sync_outbox WHERE id = ANY(%s)", (done,))
+            # Nothing went through and the breaker is (re)opened: Firestore is down, which
+            # says nothing about these events. Don't spend their attempts, or a long outage
+            # would park the whole backlog as dead instead of replaying it on recovery.
+            if failed and not done and self.breaker.state != "closed":
+                cursor.execute(
+                    "UPDATE sync_outbox SET last_error = %s WHERE id = ANY(%s)",
+                    (next(iter(failed.values()))[:1000], list(failed))
+                )
+                failed_attempts = {}
+            else:
+                failed_attempts = failed
+            for event_id, error in failed_attempts.items():
+                cursor.execute('''
+                    UPDATE sync_outbox
+                    SET attempts = attempts + 1,
+                        last_error = %s,
+                        next_attempt_at = NOW() + make_interval(secs => LEAST(%s, %s * power(2, attempts))),
+                        dead = attempts + 1 >= %s
+                    WHERE id = %s
+                ''', (error[:1000], SYNC_RETRY_MAX, SYNC_RETRY_BASE, SYNC_MAX_ATTEMPTS, event_id))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            self.chat_refs.rollback()
+            raise
+        else:
+            self.chat_refs.committed()
+            self.processed += len(done)
+            self.failures += len(failed)
+            self.batches += 1
+            self.last_batch_ms = round((time.monotonic() - start) * 1000, 3)
+        finally:
+            conn.close()
+        # Everything failed: back off to the poll instead of spinning on the same rows
+        return bool(done) and self.breaker.allow()
+
+    def _apply(self, cursor, events):
+        # Split into runs of the same handler so a chat's events apply in outbox order
+        runs = []
+        for event in events:
+            group = EVENT_GROUPS.get(event["kind"])
+            if runs and runs[-1][0] == group:
+                runs[-1][1].append(event)
+            else:
+                runs.append((group, [event]))
+
+        self.chat_refs.prefetch(cursor, [e["chat_id"] for e in events if e["chat_id"] is not None])
+        by_id = {e["id"]: e for e in events}
+        done, synced, failed = [], [], {}
+        # Chats with a failed event; their later events stay queued behind it
+        blocked = set()
+
+        for group, run in runs:
+            run = [e for e in run if e["chat_id"] is None or e["chat_id"] not in blocked]
+            if not run:
+                continue
+
+            if group == "messages":
+                ids = [e["entity_id"] for e in run]
+                cursor.execute("SELECT * FROM messages WHERE id = ANY(%s)", (ids,))
+                rows = {row["id"]: row for row in cursor.fetchall()}
+                d, s, f = apply_messages(self.fs_db, run, rows, self.chat_refs.resolve)
+                done += d
+                synced += s
+                failed.update(f)
+            else:
+                for event in run:
+                    try:
+                        if group == "chat":
+                            apply_chat_event(self.fs_db, event, self.chat_refs.resolve)
+                            if event["kind"] == "delete_chat":
+                                self.chat_refs.forget(event["chat_id"])
+                        elif group == "idea":
+                            apply_idea(self.fs_db, event)
+                        else:
+                            raise ValueError(f"unknown sync kind {event['kind']!r}")
+                        done.append(event["id"])
+                    except Exception as e:
+                        print(f"Sync: {event['kind']} event {event['id']} failed: {e}")
+                        failed[event["id"]] = str(e)
+
+            blocked.update(by_id[event_id]["chat_id"] for event_id in failed)
+            blocked.discard(None)
+        return done, synced, failed
+
+    def stats(self):
+        return {
+            "is_leader": self.is_leader,
+            "processed": self.processed,
+            "failures": self.failures,
+            "batches": self.batches,
+            "last_batch_ms": self.last_batch_ms,
+            "chat_ref_hits": self.chat_refs.hits if self.chat_refs else 0,
+            "chat_ref_misses": self.chat_refs.misses if self.chat_refs else 0,
+            "breaker": self.breaker.state,
+            "breaker_trips": self.breaker.trips,
+        }
+
+async def outbox_lag(async_db):
+    row = await async_db.fetchrow('''
+        SELECT count(*) FILTER (WHERE NOT dead) AS pending,
+               count(*) FILTER (WHERE dead) AS dead,
+               EXTRACT(EPOCH FROM NOW() - min(created_at) FILTER (WHERE NOT dead)) AS oldest_age_s
+        FROM sync_outbox
+    ''')
+    return {
+        "pending": row["pending"],
+        "dead": row["dead"],
+        "oldest_age_s": round(float(row["oldest_age_s"] or 0), 3),
+    }
+
+# Global instance
+sync_worker = SyncWorker()
@@ -0,0 +1,255 @@
+import os
+import time
+import threading
+
+# Snowflake-style ids: | 41 bits ms since ID_EPOCH | 6 bits worker | 6 bits sequence |
+#
+# 53 bits in total, so ids stay exact as JavaScript numbers (the frontend keeps them as
+# plain numbers) and as Redis sorted set scores. Each worker can hand out 64 ids per
+# millisecond; ids from one worker are strictly increasing and ids across workers are
+# ordered by time to the millisecond, which is all keyset pagination needs.
+#
+# Legacy ids were bare ms timestamps (~1.7e12). Snowflake ids for any time after
+# ID_EPOCH + 28 days are above LEGACY_ID_LIMIT, so old and new ids sort correctly.
+
+ID_EPOCH = 1704067200000  # 2024-01-01T00:00:00Z
+WORKER_BITS = 6
+SEQUENCE_BITS = 6
+MAX_WORKER_ID = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+TIMESTAMP_SHIFT = WORKER_BITS + SEQUENCE_BITS
+LEGACY_ID_LIMIT = 10 ** 13
+
+# pg_try_advisory_lock(WORKER_LOCK_NAMESPACE, worker id) marks a worker id as taken
+WORKER_LOCK_NAMESPACE = 0x1d5
+# How often the lease's lock is confirmed; ids are refused after two missed checks
+WORKER_LEASE_CHECK_S = float(os.getenv("WORKER_LEASE_CHECK_S", "5"))
+
+class NoFreeWorkerId(RuntimeError):
+    pass
+
+class WorkerIdLost(RuntimeError):
+    pass
+
+class ClockMovedBackwards(RuntimeError):
+    pass
+
+class WorkerLease:
+    """
+    A worker id held by a session-level advisory lock on a connection of its own, so
+    the id frees itself when the process exits or dies.
+
+    The connection can also drop under us (Postgres restart, idle timeout), which
+    releases the lock while we keep issuing ids. A keeper thread confirms the lock
+    every check_interval; when it is gone the lease takes the same id back, or any
+    free one, and until that works valid() turns False and ids are refused.
+    """
+
+    def __init__(self, connect, check_interval: float = WORKER_LEASE_CHECK_S, clock=time.monotonic):
+        self.connect = connect
+        self.check_interval = check_interval
+        self.clock = clock
+        self.conn = None
+        self.worker_id = None
+        self.checked_at = None
+        self.losses = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def acquire(self, preferred: int = None) -> int:
+        """Locks preferred if it's free, else the lowest free id. Raises NoFreeWorkerId."""
+        conn = self.connect()
+        try:
+            # No transaction left open on a connection that sits idle for the process lifetime
+            conn.autocommit = True
+            cursor = conn.cursor()
+            candidates = list(range(MAX_WORKER_ID + 1))
+            if preferred is not None:
+                candidates.remove(preferred)
+                candidates.insert(0, preferred)
+            for worker_id in candidates:
+                cursor.execute("SELECT pg_try_advisory_lock(%s, %s)", (WORKER_LOCK_NAMESPACE, worker_id))
+                if cursor.fetchone()[0]:
+                    break
+            else:
+                raise NoFreeWorkerId(
+                    f"All {MAX_WORKER_ID + 1} worker ids are held by live processes; "
+                    "run fewer processes or set WORKER_ID explicitly"
+                )
+        except BaseException:
+            conn.close()
+            raise
+        self.conn, self.worker_id, self.checked_at = conn, worker_id, self.clock()
+        return worker_id
+
+    def _held(self) -> bool:
+        try:
+            cursor = self.conn.cursor()
+            # Two-key advisory locks show up with objsubid = 2
+            cursor.execute('''
+                SELECT count(*) FROM pg_locks
+                WHERE locktype = 'advisory' AND classid = %s AND objid = %s AND objsubid = 2
+                  AND pid = pg_backend_pid() AND granted
+            ''', (WORKER_LOCK_NAMESPACE, self.worker_id))
+            return cursor.fetchone()[0] > 0
+        except Exception:
+            return False
+
+    def check(self) -> bool:
+        if self._held():
+            self.checked_at = self.clock()
+            return True
+        self.losses += 1
+        print(f"Worker id {self.worker_id}: advisory lock lost, claiming again")
+        self._close()
+        try:
+            self.acquire(preferred=self.worker_id)
+            return True
+        except Exception as e:
+            print(f"Worker id could not be claimed again, refusing to issue ids: {e}")
+            return False
+
+    def valid(self) -> bool:
+        return self.checked_at is not None and self.clock() - self.checked_at <= 2 * self.check_interval
+
+    def start(self):
+        def keep():
+            while not self._stop.wait(self.check_interval):
+                self.check()
+
+        self._thread = threading.Thread(target=keep, name="worker-id-lease", daemon=True)
+        self._thread.start()
+
+    def _close(self):
+        conn, self.conn = self.conn, None
+        if conn is not None:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def release(self):
+        self._stop.set()
+        self.checked_at = None
+        self._close()
+
+# This process's lease, when the worker id came from Postgres
+_lease = None
+
+def claim_worker_id(connect=None) -> int:
+    """
+    WORKER_ID from the environment, or the lowest worker id no live process holds,
+    leased for the rest of the process (see WorkerLease). connect returns a new
+    psycopg2-style connection (tests pass their own). Raises NoFreeWorkerId when all
+    64 are taken.
+    """
+    global _lease
+    env = os.getenv("WORKER_ID")
+    if env is not None:
+        worker_id = int(env)
+        if not 0 <= worker_id <= MAX_WORKER_ID:
+            raise ValueError(f"WORKER_ID must be between 0 and {MAX_WORKER_ID}")
+        return worker_id
+    if _lease is not None:
+        return _lease.worker_id
+
+    if connect is None:
+        # Not from the pool: the pool would hand it to someone else on close()
+        import psycopg2
+        from database import DATABASE_URL
+        connect = lambda: psycopg2.connect(DATABASE_URL)
+    lease = WorkerLease(connect)
+    worker_id = lease.acquire()
+    lease.start()
+    _lease = lease
+    return worker_id
+
+def release_worker_id():
+    """Frees this process's worker id (shutdown); ids must not be generated afterwards."""
+    global _lease
+    lease, _lease = _lease, None
+    if lease is not None:
+        lease.release()
+
+class IdGenerator:
+    def __init__(self, worker_id: int = None, clock=None):
+        self.worker_id = worker_id
+        # Set when worker_id is leased from Postgres; ids are refused while it's lost
+        self.lease = None
+        self.clock = clock or (lambda: time.time_ns() // 1_000_000)
+        self.last_ms = -1
+        self.sequence = 0
+        self.lock = threading.Lock()
+        self.generated = 0
+        self.sequence_waits = 0
+        self.clock_regressions = 0
+
+    def configure(self, worker_id: int, lease: WorkerLease = None):
+        if not 0 <= worker_id <= MAX_WORKER_ID:
+            raise ValueError(f"worker id must be between 0 and {MAX_WORKER_ID}")
+        self.worker_id = worker_id
+        self.lease = lease
+
+    def claim(self, connect=None):
+        self.configure(claim_worker_id(connect), lease=_lease)
+
+    def next_id(self) -> int:
+        if self.worker_id is None:
+            # Scripts and tests that never ran startup
+            self.claim()
+
+        with self.lock:
+            if self.lease is not None:
+                if not self.lease.valid():
+                    raise WorkerIdLost(f"Worker id lease not confirmed for {2 * self.lease.check_interval:g}s")
+                # Re-claimed after a lost lock, possibly as another id
+                self.worker_id = self.lease.worker_id
+            now = self.clock()
+            behind = now < self.last_ms
+            if behind:
+                # Clock stepped back (NTP): keep counting on the last timestamp we used
+                self.clock_regressions += 1
+                now = self.last_ms
+            if now == self.last_ms:
+                self.sequence = (self.sequence + 1) & MAX_SEQUENCE
+                if self.sequence == 0 and behind:
+                    # Waiting for the clock to catch up could take as long as it stepped
+                    # back, with the lock held and the event loop blocked; fail this id
+                    # instead. The sequence stays used up until the clock passes last_ms.
+                    self.sequence = MAX_SEQUENCE
+                    raise ClockMovedBackwards(
+                        f"Clock is {self.last_ms - self.clock()} ms behind the last id; no ids left for that millisecond"
+                    )
+                if self.sequence == 0:
+                    # 64 ids this millisecond already; wait (under 1 ms) for the next one
+                    self.sequence_waits += 1
+                    while now <= self.last_ms:
+                        time.sleep(0.0001)
+                        now = max(self.clock(), now)
+            else:
+                self.sequence = 0
+            self.last_ms = now
+            self.generated += 1
+            return ((now - ID_EPOCH) << TIMESTAMP_SHIFT) | (self.worker_id << SEQUENCE_BITS) | self.sequence
+
+    def stats(self):
+        return {
+            "worker_id": self.worker_id,
+            "generated": self.generated,
+            "sequence_waits": self.sequence_waits,
+            "clock_regressions": self.clock_regressions,
+            "lease_losses": self.lease.losses if self.lease else 0,
+        }
+
+def timestamp_ms(id: int) -> int:
+    """Creation time of an id in unix ms; legacy ids are the timestamp itself."""
+    id = int(id)
+    if id < LEGACY_ID_LIMIT:
+        return id
+    return (id >> TIMESTAMP_SHIFT) + ID_EPOCH
+
+# Global instance
+ids = IdGenerator()
+
+def next_id() -> int:
+    return ids.next_id()
@@ -0,0 +1,264 @@
+import os
+import asyncio
+from datetime import datetime
+from async_database import async_db
+from firestore_sync import enqueue_sync_many
+from recent_messages import recent_messages
+from chat_summary import chat_summaries, preview
+
+# Group commit for messages arriving over WebSockets.
+#
+# Instead of one transaction (and one fsync) per frame, frames are queued and written
+# together: the first frame opens a window of INGEST_BATCH_WINDOW_MS, and everything
+# that arrives before it closes (up to INGEST_BATCH_MAX) shares one transaction.
+# submit() only returns once that transaction has committed.
+#
+# Frames may carry a client_msg_id. A retry of a frame that was already stored (same
+# sender and client_msg_id, enforced by a unique index) is not inserted again;
+# submit() returns the stored row and flags it as a duplicate.
+
+INGEST_BATCH_WINDOW_MS = float(os.getenv("INGEST_BATCH_WINDOW_MS", "5"))
+INGEST_BATCH_MAX = int(os.getenv("INGEST_BATCH_MAX", "100"))
+
+# Upper bounds of the batch size histogram in stats()
+SIZE_BUCKETS = (1, 4, 16, 64)
+
+COLUMNS = ("id", "chat_id", "text", "sender", "time", "type", "fileUrl", "fileName", "fileSize",
+           "client_msg_id", "change_seq")
+INSERT_SQL = f'''
+    INSERT INTO messages ({", ".join(COLUMNS)}, synced)
+    SELECT *, FALSE FROM unnest(
+        $1::bigint[], $2::bigint[], $3::text[], $4::text[], $5::text[],
+        $6::text[], $7::text[], $8::text[], $9::text[], $10::text[], $11::bigint[]
+    )
+    ON CONFLICT (sender, client_msg_id) WHERE client_msg_id IS NOT NULL DO NOTHING
+    RETURNING *
+'''
+EXISTING_SQL = '''
+    SELECT * FROM messages
+    WHERE client_msg_id IS NOT NULL
+      AND (sender, client_msg_id) IN (SELECT * FROM unnest($1::text[], $2::text[]))
+'''
+
+def client_key(message):
+    if message.get("client_msg_id") is None:
+        return None
+    return (str(message["sender"]), message["client_msg_id"])
+
+async def stored_messages(conn, keys):
+    """(sender, client_msg_id) -> row for keys that are already in the table."""
+    if not keys:
+        return {}
+    senders, client_ids = zip(*keys)
+    rows = await conn.fetch(EXISTING_SQL, list(senders), list(client_ids))
+    return {(row["sender"], row["client_msg_id"]): row for row in rows}
+
+async def write_messages(messages):
+    """
+    Inserts messages (dicts with COLUMNS minus change_seq) in one transaction.
+    Returns (results, seqs): results[i] = (row, duplicate) for messages[i], and
+    seqs[chat_id] = (change_seq after the write, how much the write moved it).
+    """
+    keys = {client_key(m) for m in messages} - {None}
+    seqs, change_seqs = {}, {}
+    async with async_db.transaction() as conn:
+        # Retries of frames stored earlier, and repeats within this batch, aren't inserted again
+        existing = await stored_messages(conn, keys)
+        fresh, seen = [], set(existing)
+        for m in messages:
+            key = client_key(m)
+            if key is not None:
+                if key in seen:
+                    continue
+                seen.add(key)
+            fresh.append(m)
+
+        by_chat = {}
+        for m in fresh:
+            by_chat.setdefault(m["chat_id"], []).append(m)
+
+        # One chat row update per chat, taken in id order so two workers' batches can't deadlock
+        for chat_id in sorted(by_chat):
+            mine = by_chat[chat_id]
+            # The preview goes to chat_summaries via the coalescer, not onto this row
+            seq = await conn.fetchval(
+                "UPDATE chats SET change_seq = change_seq + $1 WHERE id = $2 RETURNING change_seq",
+                len(mine), chat_id
+            )
+            seqs[chat_id] = (seq, len(mine))
+            for i, m in enumerate(mine):
+                change_seqs[id(m)] = seq - len(mine) + 1 + i if seq is not None else 0
+
+        rows = []
+        if fresh:
+            columns = [[m.get(c) for m in fresh] for c in COLUMNS[:-1]]
+            columns.append([change_seqs[id(m)] for m in fresh])
+            rows = await conn.fetch(INSERT_SQL, *columns)
+            await enqueue_sync_many(conn, "message", [(row["chat_id"], row["id"]) for row in rows])
+
+        inserted = {row["id"]: row for row in rows}
+        for row in rows:
+            if row["client_msg_id"] is not None:
+                existing[(row["sender"], row["client_msg_id"])] = row
+        if len(rows) < len(fresh):
+            # Lost a race with another worker inserting the same client_msg_id
+            existing.update(await stored_messages(conn, keys - set(existing)))
+
+    results = []
+    for m in messages:
+        if m["id"] in inserted:
+            results.append((inserted[m["id"]], False))
+        else:
+            row = existing.get(client_key(m))
+            if row is None:
+                raise RuntimeError(f"Message {m['id']} was neither inserted nor found")
+            results.append((row, True))
+    return results, seqs
+
+class MessageIngest:
+    def __init__(self, write=write_messages, window_ms: float = INGEST_BATCH_WINDOW_MS,
+                 max_batch: int = INGEST_BATCH_MAX):
+        self.write = write
+        self.window = window_ms / 1000
+        self.max_batch = max(1, max_batch)
+        self.queue: asyncio.Queue = None
+        self.full: asyncio.Event = None
+        self.task: asyncio.Task = None
+
+        self.batches = 0
+        self.messages = 0
+        self.max_batch_size = 0
+        self.sizes = {b: 0 for b in SIZE_BUCKETS}
+        self.sizes_over = 0
+        self.fallbacks = 0
+        self.errors = 0
+        self.duplicates = 0
+
+    async def start(self):
+        self.queue = asyncio.Queue()
+        self.full = asyncio.Event()
+        self.task = asyncio.create_task(self._run())
+
+    async def submit(self, message: dict):
+        """
+        Queues message for the next batch. Returns (row, duplicate) once committed;
+        duplicate means row is an earlier copy with the same client_msg_id.
+        """
+        if self.task is None:
+            # Not started (scripts, tests): plain one-message transaction
+            results, seqs = await self.write([message])
+            await self._mirror(results, seqs)
+            return results[0]
+
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((message, future))
+        if self.queue.qsize() >= self.max_batch:
+            self.full.set()
+        return await future
+
+    async def _run(self):
+        while True:
+            batch = [await self.queue.get()]
+            if self.window > 0 and self.queue.qsize() < self.max_batch - 1:
+                self.full.clear()
+                try:
+                    await asyncio.wait_for(self.full.wait(), self.window)
+                except asyncio.TimeoutError:
+                    pass
+            while len(batch) < self.max_batch and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+
+            try:
+                await self._flush(batch)
+            except asyncio.CancelledError:
+                self._fail(batch, RuntimeError("Message ingest stopped"))
+                raise
+            except Exception as e:
+                print(f"Message ingest error: {e}")
+                self._fail(batch, e)
+
+    async def _flush(self, batch):
+        try:
+            results, seqs = await self.write([m for m, _ in batch])
+        except Exception as e:
+            if len(batch) == 1:
+                self.errors += 1
+                self._fail(batch, e)
+                return
+            # One bad frame (duplicate id, deleted chat) shouldn't fail its neighbours
+            self.fallbacks += 1
+            print(f"Ingest batch of {len(batch)} failed, retrying one by one: {e}")
+            for item in batch:
+                await self._flush([item])
+            return
+
+        self._record(len(batch))
+        for (_, future), result in zip(batch, results):
+            if result[1]:
+                self.duplicates += 1
+            if not future.done():
+                future.set_result(result)
+        await self._mirror(results, seqs)
+
+    async def _mirror(self, results, seqs):
+        now = datetime.now().isoformat()
+        by_chat = {}
+        for row, duplicate in results:
+            if duplicate:
+                continue
+            message = dict(row)
+            message.pop("search_vector", None)  # as main.serialize_message does
+            by_chat.setdefault(row["chat_id"], []).append(message)
+            chat_summaries.note(row["chat_id"], row["id"], preview(row["text"], row["type"]), now)
+        for chat_id, messages in by_chat.items():
+            seq, bumps = seqs.get(chat_id, (None, 0))
+            await recent_messages.push(chat_id, seq, messages, bumps=bumps)
+
+    def _fail(self, batch, error):
+        for _, future in batch:
+            if not future.done():
+                future.set_exception(error)
+
+    def _record(self, size: int):
+        self.batches += 1
+        self.messages += size
+        self.max_batch_size = max(self.max_batch_size, size)
+        for bound in SIZE_BUCKETS:
+            if size <= bound:
+                self.sizes[bound] += 1
+                return
+        self.sizes_over += 1
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self.task = None
+        while self.queue is not None and not self.queue.empty():
+            self._fail([self.queue.get_nowait()], RuntimeError("Message ingest stopped"))
+
+    def stats(self):
+        histogram, low = {}, 1
+        for bound in SIZE_BUCKETS:
+            histogram[str(bound) if bound == low else f"{low}-{bound}"] = self.sizes[bound]
+            low = bound + 1
+        histogram[f"{low}+"] = self.sizes_over
+        return {
+            "window_ms": self.window * 1000,
+            "max_batch": self.max_batch,
+            "batches": self.batches,
+            "messages": self.messages,
+            "avg_batch_size": round(self.messages / self.batches, 2) if self.batches else 0.0,
+            "max_batch_size": self.max_batch_size,
+            "batch_sizes": histogram,
+            "fallbacks": self.fallbacks,
+            "errors": self.errors,
+            "duplicates": self.duplicates,
+            "queue_depth": self.queue.qsize() if self.queue is not None else 0,
+        }
+
+# Global instance
+ingest = MessageIngest()
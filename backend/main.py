@@ -1,7 +1,9 @@
+import asyncio
 import json
+import logging
 import os
 import shutil
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, UploadFile, File, HTTPException, BackgroundTasks
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, UploadFile, File, HTTPException, Request, Response, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from models import Message, IdeaAnalysis, FileInput
@@ -11,10 +13,25 @@ import firebase_admin
 from firebase_admin import credentials, firestore
 from datetime import datetime
 from dotenv import load_dotenv
-from database import init_db, get_db_connection, get_db_cursor
-import psycopg2
+from database import init_db, get_pool_stats, close_pool, member_id
+from async_database import async_db, rows_affected
+from firestore_sync import sync_worker, enqueue_sync, outbox_lag, message_to_firestore
+from reconcile import reconcile, reconcile_run
+from ingest import ingest, stored_messages
+from id_generator import ids, release_worker_id, next_id
+from chat_summary import chat_summaries, preview, reset_summary
+from recent_messages import recent_messages, hidden_for, HIDDEN_FOR_USER_SQL
+from message_search import build_search_query, search_page
+from file_index import index_text, index_upload, search_files
+from extraction_service import extraction, ExtractionBusy, EXTRACT_JOB_BYTES
+from analysis_cache import analysis_cache
+from etag import make_etag, not_modified
+from cache import membership_cache, user_cache, user_keys, invalidate, cache_invalidator, MISSING, stats as cache_stats
+import asyncpg
 from redis_client import redis_client
 
+logger = logging.getLogger(__name__)
+
 # Load environment variables
 load_dotenv()
 
@@ -39,11 +56,27 @@ manager = ConnectionManager()
 @app.on_event("startup")
 async def startup_event():
     init_db() # Ensure tables exist
+    ids.claim()
+    await async_db.connect()
+    await ingest.start()
+    await chat_summaries.start()
     await redis_client.connect()
+    await cache_invalidator.start()
+    # Only one process across the deployment actually syncs; the rest stand by
+    sync_worker.start(db)
 
 @app.on_event("shutdown")
 async def shutdown_event():
+    await manager.close()
+    await ingest.close()
+    await chat_summaries.close()
+    await extraction.close()
+    sync_worker.stop()
+    await cache_invalidator.close()
     await redis_client.close()
+    await async_db.close()
+    close_pool()
+    release_worker_id()
 
 # Create uploads directory
 os.makedirs("uploads", exist_ok=True)
@@ -58,102 +91,112 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# --- Sync Logic ---
-def sync_to_firebase():
-    print("Starting sync to Firebase...")
-    conn = get_db_connection()
-    cursor = get_db_cursor(conn)
-    
-    # Sync Messages
-    cursor.execute("SELECT * FROM messages WHERE synced = FALSE")
-    unsynced_messages = cursor.fetchall()
-    
-    for msg in unsynced_messages:
-        try:
-            chat_id = msg['chat_id']
-            # Get Firestore Chat Doc
-            chats_ref = db.collection("chats")
-            query = chats_ref.where("id", "==", chat_id).limit(1).stream()
-            
-            for doc in query:
-                messages_ref = doc.reference.collection("messages")
-                
-                msg_data = dict(msg)
-                # Remove internal fields
-                del msg_data['synced']
-                del msg_data['chat_id'] # Firestore structure is hierarchical
-                
-                # Convert boolean back if needed (SQLite stores 0/1)
-                msg_data['isPinned'] = bool(msg_data['isPinned'])
-                
-                # Add to Firestore
-                messages_ref.add(msg_data)
-                
-                # Update last message
-                doc.reference.update({
-                    "lastMessage": msg_data.get("text", "Sent a file"),
-                    "timestamp": msg_data.get("time")
-                })
-                
-                # Mark as synced in Postgres
-                conn.cursor().execute("UPDATE messages SET synced = TRUE WHERE id = %s", (msg['id'],))
-                conn.commit()
-                print(f"Synced message {msg['id']}")
-                
-        except Exception as e:
-            print(f"Failed to sync message {msg['id']}: {e}")
-            
-    conn.close()
-    print("Sync complete.")
+# --- Metrics ---
+@app.get("/metrics")
+async def get_metrics():
+    try:
+        outbox = await outbox_lag(async_db)
+    except Exception as e:
+        outbox = {"error": str(e)}
+    return {
+        "db_pool": get_pool_stats(),
+        "async_db_pool": async_db.stats(),
+        "websockets": manager.stats(),
+        "firestore_sync": {**sync_worker.stats(), "outbox": outbox},
+        "caches": cache_stats(),
+        "recent_messages": recent_messages.stats(),
+        "ingest": ingest.stats(),
+        "chat_summaries": chat_summaries.stats(),
+        "ids": ids.stats(),
+        "extraction": extraction.stats(),
+        "analysis_cache": analysis_cache.stats()
+    }
+
+@app.post("/sync/reconcile")
+def reconcile_firestore(background_tasks: BackgroundTasks, response: Response, chat_id: int = None,
+                        repair: bool = False, full: bool = False):
+    # Plain def: the Firestore client blocks, so this runs in the threadpool
+    # Not sync_worker.chat_refs: the sync thread mutates that one without a lock
+    if chat_id:
+        return reconcile(db, chat_ids=[chat_id], repair=repair, full=full)
+
+    # Every chat takes too long for one request; run it after responding
+    if not reconcile_run.start():
+        raise HTTPException(status_code=409, detail="A reconcile of all chats is already running")
+    background_tasks.add_task(reconcile_run.run, db, repair=repair, full=full)
+    response.status_code = 202
+    return {"status": "running", "status_url": "/sync/reconcile/status"}
+
+@app.get("/sync/reconcile/status")
+def reconcile_status():
+    return reconcile_run.state
 
 # --- Helper Functions ---
 
-def get_user(user_id: int):
-    conn = get_db_connection()
-    cursor = get_db_cursor(conn)
-    cursor.execute("SELECT * FROM users WHERE id = %s", (user_id,))
-    row = cursor.fetchone()
-    conn.close()
-    if row:
-        return dict(row)
-    return None
+async def _cached_user(key: str, query: str, value):
+    # Callers mutate the dict they get back, so hand out copies
+    user = user_cache.get(key)
+    if user is MISSING:
+        row = await async_db.fetchrow(query, value)
+        if not row:
+            # Not cached: the user may be created a moment later
+            return None
+        user = dict(row)
+        for k in user_keys(user):
+            user_cache.set(k, user)
+    return dict(user)
 
-def get_user_by_email(email: str):
-    conn = get_db_connection()
-    cursor = get_db_cursor(conn)
-    cursor.execute("SELECT * FROM users WHERE email = %s", (email,))
-    row = cursor.fetchone()
-    conn.close()
-    if row:
-        return dict(row)
-    return None
+async def get_user(user_id: int):
+    return await _cached_user(f"id:{user_id}", "SELECT * FROM users WHERE id = $1", user_id)
+
+async def get_user_by_email(email: str):
+    return await _cached_user(f"email:{email}", "SELECT * FROM users WHERE email = $1", email)
+
+async def get_chat_member_ids(chat_id: int):
+    """Member user ids of a chat, served from the membership cache."""
+    members = membership_cache.get(chat_id)
+    if members is MISSING:
+        rows = await async_db.fetch("SELECT user_id FROM chat_members WHERE chat_id = $1", chat_id)
+        members = frozenset(r["user_id"] for r in rows)
+        membership_cache.set(chat_id, members)
+    return members
 
 def create_user_doc(user_data):
     # Deprecated: Use inline SQL in endpoints + sync
     pass
 
-def update_user_doc(user_id: int, update_data):
+async def update_user_doc(user_id: int, update_data):
     # This should update Postgres
-    conn = get_db_connection()
-    cursor = conn.cursor() # Standard cursor for updates is fine
-    
     # Construct SET clause dynamically
-    set_clause = ", ".join([f"{k} = %s" for k in update_data.keys()])
+    set_clause = ", ".join([f"{k} = ${i}" for i, k in enumerate(update_data.keys(), start=1)])
     values = list(update_data.values())
     values.append(user_id)
-    
-    cursor.execute(f"UPDATE users SET {set_clause} WHERE id = %s", values)
-    conn.commit()
-    conn.close()
-
-def get_chat_doc(chat_id: int):
-    conn = get_db_connection()
-    cursor = get_db_cursor(conn)
-    cursor.execute("SELECT * FROM chats WHERE id = %s", (chat_id,))
-    row = cursor.fetchone()
-    conn.close()
+
+    await async_db.execute(f"UPDATE users SET {set_clause} WHERE id = ${len(values)}", *values)
+
+# Chat row plus its summary (chat_summary.py), which now owns lastMessage/timestamp
+CHAT_LIST_COLUMNS = """
+    c.*, s.last_message AS summary_message, s.last_message_at AS summary_at,
+    COALESCE(s.message_count, 0) AS message_count
+"""
+
+def chat_with_summary(row) -> dict:
+    chat = dict(row)
+    # Chats without a summary yet keep what the chats row says
+    summary_message, summary_at = chat.pop("summary_message"), chat.pop("summary_at")
+    if summary_message is not None:
+        chat["lastmessage"] = summary_message
+        chat["timestamp"] = summary_at
+    return chat
+
+async def get_chat_doc(chat_id: int):
+    row = await async_db.fetchrow(f'''
+        SELECT {CHAT_LIST_COLUMNS} FROM chats c
+        LEFT JOIN chat_summaries s ON s.chat_id = c.id
+        WHERE c.id = $1
+    ''', chat_id)
     if row:
-        chat = dict(row)
+        chat = chat_with_summary(row)
         # Parse JSON fields
         if chat.get("participants"):
             try:
@@ -163,28 +206,85 @@ def get_chat_doc(chat_id: int):
         return chat
     return None
 
-# --- Endpoints ---
+async def next_change_seq(conn, chat_id: int, count: int = 1):
+    """
+    Bumps the chat's change counter and returns the new value (None if the chat is gone).
+    The row lock is held until commit, so seqs become visible in order within a chat.
+    """
+    return await conn.fetchval(
+        "UPDATE chats SET change_seq = change_seq + $2 WHERE id = $1 RETURNING change_seq",
+        chat_id, count
+    )
 
+async def add_chat_member(conn, chat_id: int, participant: dict, role: str = "member"):
+    """
+    Adds participant to chat_members and appends it to the chats.participants display list.
+    Returns the updated participants list, or None if they were already a member.
+    Must be called inside a transaction.
+    """
+    user_id = member_id(participant)
+    if user_id is None:
+        return None
 
+    status = await conn.execute('''
+        INSERT INTO chat_members (chat_id, user_id, role)
+        VALUES ($1, $2, $3)
+        ON CONFLICT (chat_id, user_id) DO NOTHING
+    ''', chat_id, user_id, role)
+    if rows_affected(status) == 0:
+        return None
+
+    # Append in SQL instead of read-modify-write in Python
+    row = await conn.fetchrow('''
+        UPDATE chats
+        SET participants = (COALESCE(NULLIF(participants, ''), '[]')::jsonb || $2::jsonb)::text,
+            change_seq = change_seq + 1, synced = FALSE
+        WHERE id = $1
+        RETURNING participants
+    ''', chat_id, json.dumps([participant], default=str))
+    return json.loads(row["participants"]) if row else None
 
 # --- Endpoints ---
 
 @app.get("/chats")
-async def get_chats(user_id: int = None):
-    conn = get_db_connection()
-    cursor = get_db_cursor(conn)
-    
+async def get_chats(request: Request, response: Response, user_id: int = None):
+    # count catches deletes, sum(change_seq) catches any chat-row change, max(id) catches creates,
+    # sum(s.version) catches summary flushes, which land after the message's own seq bump
     if user_id:
-        cursor.execute("SELECT * FROM chats")
+        version = await async_db.fetchrow('''
+            SELECT count(*) AS n, COALESCE(sum(c.change_seq), 0) AS seq, COALESCE(max(c.id), 0) AS max_id,
+                   COALESCE(sum(s.version), 0) AS summary
+            FROM chat_members m
+            JOIN chats c ON c.id = m.chat_id
+            LEFT JOIN chat_summaries s ON s.chat_id = c.id
+            WHERE m.user_id = $1
+        ''', user_id)
     else:
-        cursor.execute("SELECT * FROM chats")
-        
-    rows = cursor.fetchall()
-    conn.close()
-    
+        version = await async_db.fetchrow('''
+            SELECT count(*) AS n, COALESCE(sum(c.change_seq), 0) AS seq, COALESCE(max(c.id), 0) AS max_id,
+                   COALESCE(sum(s.version), 0) AS summary
+            FROM chats c
+            LEFT JOIN chat_summaries s ON s.chat_id = c.id
+        ''')
+    etag = make_etag("chats", user_id, version["n"], version["seq"], version["max_id"], version["summary"])
+    cached = not_modified(request, response, etag)
+    if cached:
+        return cached
+
+    if user_id:
+        # Index scan on chat_members(user_id) instead of parsing every chat's participants
+        rows = await async_db.fetch(f'''
+            SELECT {CHAT_LIST_COLUMNS} FROM chat_members m
+            JOIN chats c ON c.id = m.chat_id
+            LEFT JOIN chat_summaries s ON s.chat_id = c.id
+            WHERE m.user_id = $1
+        ''', user_id)
+    else:
+        rows = await async_db.fetch(f"SELECT {CHAT_LIST_COLUMNS} FROM chats c LEFT JOIN chat_summaries s ON s.chat_id = c.id")
+
     chats = []
     for row in rows:
-        chat = dict(row)
+        chat = chat_with_summary(row)
         # Parse JSON fields
         if chat.get("participants"):
             try:
@@ -196,25 +296,17 @@ async def get_chats(user_id: int = None):
                 chat["createdBy"] = json.loads(chat["createdBy"])
             except:
                 chat["createdBy"] = None
-        
-        # Filter if user_id is provided
-        if user_id:
-            participants = chat.get("participants", [])
-            if any(p.get("id") == user_id for p in participants):
-                chats.append(chat)
-        else:
-            chats.append(chat)
+        chats.append(chat)
             
     return chats
 
 @app.post("/chats")
-async def create_chat(chat_data: dict, background_tasks: BackgroundTasks):
+async def create_chat(chat_data: dict):
     import traceback
     try:
         print(f"Received chat_data: {chat_data}")
-        # Use Postgres SERIAL or manual ID? We used timestamp manual ID in SQLite.
-        # Postgres supports BIGINT Primary Key, so manual ID is fine.
-        new_id = int(datetime.now().timestamp() * 1000)
+        # Snowflake id (id_generator.py): unique across workers, time-ordered
+        new_id = next_id()
         
         new_chat = {
             "id": new_id,
@@ -230,29 +322,32 @@ async def create_chat(chat_data: dict, background_tasks: BackgroundTasks):
         }
         
         # 1. Save to Postgres
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        import json
-        cursor.execute('''
-            INSERT INTO chats (id, name, type, participants, avatar, lastMessage, timestamp, isPrivate, createdBy, synced)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, FALSE)
-        ''', (
-            new_id,
-            new_chat["name"],
-            new_chat["type"],
-            json.dumps(new_chat["participants"]),
-            new_chat["avatar"],
-            new_chat["lastMessage"],
-            new_chat["timestamp"],
-            new_chat["isPrivate"], # Postgres handles bool natively
-            json.dumps(new_chat["createdBy"]) if new_chat["createdBy"] else None
-        ))
-        conn.commit()
-        conn.close()
-        
-        # 2. Trigger Background Sync
-        background_tasks.add_task(sync_to_firebase)
+        owner_id = member_id(new_chat["createdBy"]) if isinstance(new_chat["createdBy"], dict) else None
+        members = {}
+        for p in new_chat["participants"]:
+            uid = member_id(p) if isinstance(p, dict) else None
+            if uid is not None:
+                members[uid] = "owner" if uid == owner_id else "member"
+
+        async with async_db.transaction() as conn:
+            await conn.execute('''
+                INSERT INTO chats (id, name, type, participants, avatar, lastMessage, timestamp, isPrivate, createdBy, synced)
+                VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, FALSE)
+            ''',
+                new_id,
+                new_chat["name"],
+                new_chat["type"],
+                json.dumps(new_chat["participants"]),
+                new_chat["avatar"],
+                new_chat["lastMessage"],
+                new_chat["timestamp"],
+                bool(new_chat["isPrivate"]), # Postgres handles bool natively
+                json.dumps(new_chat["createdBy"]) if new_chat["createdBy"] else None
+            )
+            await conn.executemany(
+                "INSERT INTO chat_members (chat_id, user_id, role) VALUES ($1, $2, $3) ON CONFLICT DO NOTHING",
+                [(new_id, uid, role) for uid, role in members.items()]
+            )
         
         return new_chat
     except Exception as e:
@@ -267,39 +362,30 @@ async def join_chat(request: dict):
     chat_id = request.get("chat_id")
     user = request.get("user")
     
-    chat_doc_data = get_chat_doc(chat_id)
+    chat_doc_data = await get_chat_doc(chat_id)
     
     if not chat_doc_data:
         raise HTTPException(status_code=404, detail="Chat not found")
     
-    participants = chat_doc_data.get("participants", [])
-    # Parse if string
-    if isinstance(participants, str):
-        participants = json.loads(participants)
+    async with async_db.transaction() as conn:
+        participants = await add_chat_member(conn, chat_id, user)
 
-    if not any(p.get("id") == user["id"] for p in participants):
-        participants.append(user)
-        
-        # Update Postgres. get_chat_doc handles fetch. update needs specific call
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("UPDATE chats SET participants = %s, synced = FALSE WHERE id = %s", 
-                       (json.dumps(participants), chat_id))
-        conn.commit()
-        conn.close()
+    if participants is not None:
+        await invalidate(membership_cache, chat_id)
+        chat_doc_data["participants"] = participants
             
     return {"message": "Joined chat", "chat": chat_doc_data}
 
 @app.post("/login")
-async def login(user_data: dict, background_tasks: BackgroundTasks):
+async def login(user_data: dict):
     email = user_data.get("email")
-    existing_user = get_user_by_email(email)
+    existing_user = await get_user_by_email(email)
     
     if existing_user:
         return existing_user
     
     # New User
-    new_id = int(datetime.now().timestamp() * 1000)
+    new_id = next_id()
 
     new_user = {
         "id": new_id,
@@ -311,30 +397,23 @@ async def login(user_data: dict, background_tasks: BackgroundTasks):
     }
     
     # 1. Save to Postgres
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
+    await async_db.execute('''
         INSERT INTO users (id, name, email, avatar, status, lastSeen, synced)
-        VALUES (%s, %s, %s, %s, %s, %s, FALSE)
-    ''', (
+        VALUES ($1, $2, $3, $4, $5, $6, FALSE)
+    ''',
         new_user["id"],
         new_user["name"],
         new_user["email"],
         new_user["avatar"],
         new_user["status"],
         new_user["lastSeen"]
-    ))
-    conn.commit()
-    conn.close()
-    
-    # 2. Trigger Sync
-    background_tasks.add_task(sync_to_firebase)
+    )
     
     return new_user
 
 @app.put("/users/{user_id}")
 async def update_user(user_id: int, user_data: dict):
-    user = get_user(user_id)
+    user = await get_user(user_id)
     if not user:
         return {"error": "User not found"}
     
@@ -344,19 +423,22 @@ async def update_user(user_id: int, user_data: dict):
         updates["avatar"] = f"https://ui-avatars.com/api/?name={user_data['name']}&background=random"
     
     if updates:
-        update_user_doc(user_id, updates)
+        await update_user_doc(user_id, updates)
+        await invalidate(user_cache, *user_keys(user))
         # Return updated user
         user.update(updates)
         return user
     return user
 
 @app.get("/ideas")
-async def get_ideas():
-    conn = get_db_connection()
-    cursor = get_db_cursor(conn)
-    cursor.execute("SELECT * FROM ideas ORDER BY timestamp DESC")
-    rows = cursor.fetchall()
-    conn.close()
+async def get_ideas(request: Request, response: Response):
+    # Ideas are insert/delete only, so count + max(id) identifies the list
+    version = await async_db.fetchrow("SELECT count(*) AS n, COALESCE(max(id), 0) AS max_id FROM ideas")
+    cached = not_modified(request, response, make_etag("ideas", version["n"], version["max_id"]))
+    if cached:
+        return cached
+
+    rows = await async_db.fetch("SELECT * FROM ideas ORDER BY timestamp DESC")
     
     ideas = []
     for row in rows:
@@ -366,57 +448,57 @@ async def get_ideas():
     return ideas
 
 @app.post("/ideas")
-async def add_idea(idea: dict, background_tasks: BackgroundTasks):
-    new_id = int(datetime.now().timestamp() * 1000)
+async def add_idea(idea: dict):
+    new_id = next_id()
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
+    await async_db.execute('''
         INSERT INTO ideas (id, text, category, votes, timestamp, is_analyzed, synced)
-        VALUES (%s, %s, %s, %s, %s, %s, FALSE)
-    ''', (
+        VALUES ($1, $2, $3, $4, $5, $6, FALSE)
+    ''',
         new_id,
         idea.get("text") or idea.get("title"), 
         idea.get("category") or idea.get("content"), 
         0,
         datetime.now().isoformat(),
         False
-    ))
-    conn.commit()
-    conn.close()
-    
-    background_tasks.add_task(sync_to_firebase)
+    )
     
     # Return what frontend expects
     idea["id"] = new_id
     return idea
 
 @app.delete("/ideas/{idea_id}")
-async def delete_idea(idea_id: int, background_tasks: BackgroundTasks):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM ideas WHERE id = %s", (idea_id,))
-    if cursor.rowcount == 0:
-        conn.close()
+async def delete_idea(idea_id: int):
+    status = await async_db.execute("DELETE FROM ideas WHERE id = $1", idea_id)
+    if rows_affected(status) == 0:
         raise HTTPException(status_code=404, detail="Idea not found")
-    conn.commit()
-    conn.close()
     
-    background_tasks.add_task(sync_to_firebase)
     return {"message": "Idea deleted"}
 
 @app.get("/chats/public")
-async def get_public_chats():
-    conn = get_db_connection()
-    cursor = get_db_cursor(conn)
+async def get_public_chats(request: Request, response: Response):
+    version = await async_db.fetchrow('''
+        SELECT count(*) AS n, COALESCE(sum(c.change_seq), 0) AS seq, COALESCE(max(c.id), 0) AS max_id,
+               COALESCE(sum(s.version), 0) AS summary
+        FROM chats c
+        LEFT JOIN chat_summaries s ON s.chat_id = c.id
+        WHERE c.type = 'group' AND c.isPrivate = FALSE
+    ''')
+    etag = make_etag("public", version["n"], version["seq"], version["max_id"], version["summary"])
+    cached = not_modified(request, response, etag)
+    if cached:
+        return cached
+
     # Filter for public groups (type='group' and isPrivate=FALSE)
-    cursor.execute("SELECT * FROM chats WHERE type = 'group' AND isPrivate = FALSE")
-    rows = cursor.fetchall()
-    conn.close()
-    
+    rows = await async_db.fetch(f'''
+        SELECT {CHAT_LIST_COLUMNS} FROM chats c
+        LEFT JOIN chat_summaries s ON s.chat_id = c.id
+        WHERE c.type = 'group' AND c.isPrivate = FALSE
+    ''')
+
     public_chats = []
     for row in rows:
-        chat = dict(row)
+        chat = chat_with_summary(row)
         # Parse JSON fields
         if chat.get("participants") and isinstance(chat["participants"], str):
             try:
@@ -426,292 +508,339 @@ async def get_public_chats():
         public_chats.append(chat)
     return public_chats
 
-@app.post("/chats/join")
-async def join_chat(request: dict, background_tasks: BackgroundTasks):
-    chat_id = request.get("chat_id")
-    user = request.get("user")
-    
-    chat_doc_data = get_chat_doc(chat_id)
-    
-    if not chat_doc_data:
-        # Auto-create if not exists (legacy behavior)
-        new_chat = {
-            "id": chat_id,
-            "name": f"Group {chat_id}",
-            "type": "group",
-            "participants": [user],
-            "avatar": f"https://ui-avatars.com/api/?name=Group {chat_id}&background=random",
-            "members": 1,
-            "lastMessage": "Tap to start chatting",
-            "timestamp": datetime.now().isoformat(),
-            "isPrivate": False,
-            "createdBy": None
-        }
-        
-        # Save to SQLite
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        import json
-        cursor.execute('''
-            INSERT INTO chats (id, name, type, participants, avatar, lastMessage, timestamp, isPrivate, createdBy, synced)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 0)
-        ''', (
-            new_chat["id"],
-            new_chat["name"],
-            new_chat["type"],
-            json.dumps(new_chat["participants"]),
-            new_chat["avatar"],
-            new_chat["lastMessage"],
-            new_chat["timestamp"],
-            0,
-            None
-        ))
-        conn.commit()
-        conn.close()
-        
-        background_tasks.add_task(sync_to_firebase)
-        return {"message": "Joined new chat", "chat": new_chat}
-    
-    # Update existing chat
-    # 1. Read from Postgres
-    conn = get_db_connection()
-    cursor = get_db_cursor(conn)
-    cursor.execute("SELECT participants FROM chats WHERE id = %s", (chat_id,))
-    row = cursor.fetchone()
-    
-    if not row:
-        # If not in SQLite but in Firestore (edge case), we might need to fetch from Firestore.
-        # But for "Local First", we assume SQLite is master or synced.
-        # If missing in SQLite, we should probably fetch from Firestore or error.
-        # Given the hybrid nature, let's try to get from SQLite.
-        pass 
-    
-    participants = []
-    if row:
-        import json
+MESSAGE_PAGE_DEFAULT = int(os.getenv("MESSAGE_PAGE_DEFAULT", "50"))
+MESSAGE_PAGE_MAX = int(os.getenv("MESSAGE_PAGE_MAX", "200"))
+
+def serialize_message(row):
+    msg = dict(row)
+    # Generated search column (see /search/messages); never sent to clients
+    msg.pop("search_vector", None)
+    # Parse replyTo JSON if it exists
+    if msg.get("replyTo"):
         try:
-            participants = json.loads(row["participants"])
+            msg["replyTo"] = json.loads(msg["replyTo"])
         except:
-            participants = []
-            
-    if not any(p.get("id") == user["id"] for p in participants):
-        participants.append(user)
-        
-        # Update Postgres
-        # Logic above reuses conn implicitly if not closed, but here we closed nothing.
-        # Actually line 512 closes conn.
-        # Let's keep it clean.
-        cursor = conn.cursor()
-        cursor.execute('''
-            UPDATE chats 
-            SET participants = %s, synced = FALSE 
-            WHERE id = %s
-        ''', (json.dumps(participants), chat_id))
-        conn.commit()
-        
-        background_tasks.add_task(sync_to_firebase)
-        
-    conn.close()
-            
-    return {"message": "Joined chat", "chat": {"id": chat_id, "participants": participants}}
-
+            msg["replyTo"] = None
+    return msg
 
+async def recent_history(chat_id: int, change_seq):
+    """
+    Newest messages of the chat (oldest-first) and whether that is its whole history.
+    Served from Redis; on a miss, read from Postgres and cached for the next reader.
+    """
+    cached = await recent_messages.read(chat_id, change_seq)
+    if cached is not None:
+        return cached
+    # Unfiltered, so the entry serves every user; 'Delete for Me' is applied per reader
+    rows = await async_db.fetch(
+        "SELECT * FROM messages WHERE chat_id = $1 ORDER BY id DESC LIMIT $2",
+        chat_id, recent_messages.size + 1
+    )
+    complete = len(rows) <= recent_messages.size
+    messages = [serialize_message(row) for row in reversed(rows[:recent_messages.size])]
+    await recent_messages.fill(chat_id, change_seq, messages, complete)
+    return messages, complete
 
 @app.get("/chats/{chat_id}/messages")
-async def get_messages(chat_id: int, user_id: int = None):
-    conn = get_db_connection()
-    cursor = get_db_cursor(conn)
-    cursor.execute("SELECT * FROM messages WHERE chat_id = %s ORDER BY id ASC", (chat_id,))
+async def get_messages(request: Request, response: Response, chat_id: int, user_id: int = None,
+                       before_id: int = None, after_id: int = None, limit: int = None):
+    # Every message mutation bumps change_seq, so it fully versions this chat's history.
+    # Read it before the messages so a write landing in between can't hide behind an old ETag.
+    change_seq = await async_db.fetchval("SELECT change_seq FROM chats WHERE id = $1", chat_id)
+    etag = make_etag("messages", chat_id, change_seq, user_id, before_id, after_id, limit)
+    cached = not_modified(request, response, etag)
+    if cached:
+        return cached
+
+    # Legacy callers (no cursor params) still get the whole history as a plain list
+    legacy = before_id is None and after_id is None and limit is None
+    if not legacy:
+        limit = max(1, min(limit or MESSAGE_PAGE_DEFAULT, MESSAGE_PAGE_MAX))
+
+    # The newest page usually comes straight from the Redis copy
+    recent = None
+    if before_id is None and after_id is None and recent_messages.enabled():
+        recent, complete = await recent_history(chat_id, change_seq)
+        if user_id:
+            recent = [m for m in recent if not hidden_for(m, user_id)]
+        # Older messages exist outside the cache, so it only answers a page it fully covers
+        if not complete and (legacy or len(recent) <= limit):
+            recent = None
+
+    conditions = ["chat_id = $1"]
+    args = [chat_id]
+    if user_id:
+        args.append(user_id)
+        conditions.append(HIDDEN_FOR_USER_SQL.format(param=f"${len(args)}"))
+
+    if legacy:
+        if recent is not None:
+            return recent
+        rows = await async_db.fetch(
+            f"SELECT * FROM messages WHERE {' AND '.join(conditions)} ORDER BY id ASC", *args
+        )
+        return [serialize_message(row) for row in rows]
+
+    # Keyset pagination over the (chat_id, id) index
+    if after_id is not None:
+        args.append(after_id)
+        conditions.append(f"id > ${len(args)}")
+    if before_id is not None:
+        args.append(before_id)
+        conditions.append(f"id < ${len(args)}")
+
+    # Scrolling forward from after_id reads oldest-first; everything else reads newest-first
+    ascending = after_id is not None
+    if recent is not None:
+        has_more = len(recent) > limit
+        messages = recent[-limit:]
+    else:
+        args.append(limit + 1)
+        rows = await async_db.fetch(f"""
+            SELECT * FROM messages
+            WHERE {' AND '.join(conditions)}
+            ORDER BY id {'ASC' if ascending else 'DESC'}
+            LIMIT ${len(args)}
+        """, *args)
+
+        # has_more: another page exists in the direction we were reading
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if not ascending:
+            rows = list(reversed(rows))
+        messages = [serialize_message(row) for row in rows]
+
+    # prev_cursor -> pass as before_id to load older messages
+    # next_cursor -> pass as after_id to poll for newer messages
+    older_exist = has_more if not ascending else bool(messages)
+    return {
+        "messages": messages,
+        "prev_cursor": messages[0]["id"] if messages and older_exist else None,
+        "next_cursor": messages[-1]["id"] if messages else after_id,
+        "has_more": has_more,
+        "seq": change_seq or 0,
+    }
+
+@app.get("/search/messages")
+async def search_messages(q: str, chat_id: int = None, sender: str = None, user_id: int = None,
+                          limit: int = None, cursor: str = None):
+    """Full-text message search (message_search.py)."""
+    q = q.strip()
+    if not q:
+        raise HTTPException(status_code=400, detail="Empty query")
+    limit = max(1, min(limit or MESSAGE_PAGE_DEFAULT, MESSAGE_PAGE_MAX))
+
+    try:
+        sql, args = build_search_query(q, limit, chat_id=chat_id, sender=sender, user_id=user_id, cursor=cursor)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    rows, next_cursor, has_more = search_page(await async_db.fetch(sql, *args), limit)
+    return {
+        "results": [serialize_message(row) for row in rows],
+        "next_cursor": next_cursor,
+        "has_more": has_more,
+    }
+
+CHANGES_PAGE_MAX = int(os.getenv("CHANGES_PAGE_MAX", "500"))
+
+@app.get("/chats/{chat_id}/changes")
+async def get_changes(chat_id: int, since: int = 0, user_id: int = None, limit: int = None):
+    """
+    Returns messages created or modified after change seq `since`.
+    Poll again with since=<seq> from the response. When `reset` is true the chat was
+    cleared after `since`; drop local state and use `messages` as the full history.
+    """
+    chat = await async_db.fetchrow("SELECT change_seq, cleared_seq FROM chats WHERE id = $1", chat_id)
+    if not chat:
+        raise HTTPException(status_code=404, detail="Chat not found")
+
+    limit = max(1, min(limit or CHANGES_PAGE_MAX, CHANGES_PAGE_MAX))
+    args = [chat_id, since, limit + 1]
+    hidden_sql = "FALSE"
+    if user_id:
+        args.append(user_id)
+        hidden_sql = f"NOT ({HIDDEN_FOR_USER_SQL.format(param='$4')})"
+
+    rows = await async_db.fetch(f"""
+        SELECT *, {hidden_sql} AS hidden_for_user FROM messages
+        WHERE chat_id = $1 AND change_seq > $2
+        ORDER BY change_seq ASC
+        LIMIT $3
+    """, *args)
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
     messages = []
-    
-    import json
-    
-    for row in cursor.fetchall():
-        msg = dict(row)
+    removed = []
+    for row in rows:
+        msg = serialize_message(row)
+        if msg.pop("hidden_for_user"):
+            # Deleted for this user only; the client just drops it
+            removed.append(msg["id"])
+        else:
+            messages.append(msg)
+
+    if has_more:
+        seq = rows[-1]["change_seq"]
+    else:
+        seq = max([chat["change_seq"]] + [row["change_seq"] for row in rows])
+
+    return {
+        "seq": seq,
+        "reset": since < chat["cleared_seq"],
+        "messages": messages,
+        "removed": removed,
+        "has_more": has_more,
+    }
+
+async def find_stored_message(client_key):
+    async with async_db.acquire() as conn:
+        return (await stored_messages(conn, {client_key})).get(client_key)
+
+async def insert_message(chat_id: int, msg_dict: dict, new_part: dict = None):
+    """Inserts a REST message (and self-heals membership). Returns (change_seq, row, participants)."""
+    participant_update = None
+    async with async_db.transaction() as conn:
+        change_seq = await next_change_seq(conn, chat_id)
+        row = await conn.fetchrow('''
+            INSERT INTO messages (id, chat_id, text, sender, time, type, fileUrl, fileName, fileSize, isPinned, callRoomName, callStatus, isVoice, replyTo, client_msg_id, change_seq, synced)
+            VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13, $14, $15, $16, FALSE)
+            RETURNING *
+        ''',
+            msg_dict["id"],
+            chat_id,
+            msg_dict.get("text"),
+            str(msg_dict.get("sender")),
+            msg_dict.get("time"),
+            msg_dict.get("type"),
+            msg_dict.get("fileUrl"),
+            msg_dict.get("filename"),
+            msg_dict.get("size"),
+            False, # isPinned
+            msg_dict.get("callRoomName"),
+            msg_dict.get("callStatus"),
+            msg_dict.get("isVoice", False),
+            json.dumps(msg_dict.get("replyTo")) if msg_dict.get("replyTo") else None,
+            msg_dict.get("client_msg_id"),
+            change_seq or 0
+        )
+        await enqueue_sync(conn, "message", chat_id, msg_dict["id"])
         
-        # Check 'Delete for Me' logic
-        if user_id and msg.get("deleted_for"):
+        if new_part is not None:
             try:
-                deleted_for_list = json.loads(msg["deleted_for"])
-                # print(f"DEBUG: msg {msg['id']} deleted_for={deleted_for_list} user_id={user_id}")
-                if any(str(u) == str(user_id) for u in deleted_for_list):
-                    # print(f"DEBUG: Skipping msg {msg['id']}")
-                    continue # Skip this message
+                # Savepoint so a failure here doesn't abort the message insert
+                async with conn.transaction():
+                    participant_update = await add_chat_member(conn, chat_id, new_part)
             except Exception as e:
-                print(f"DEBUG: Error parsing deleted_for: {e}")
-                pass
-                
-        # Parse replyTo JSON if it exists
-        if msg.get("replyTo"):
-            try:
-                msg["replyTo"] = json.loads(msg["replyTo"])
-            except:
-                msg["replyTo"] = None
-        messages.append(msg)
-    conn.close()
-    return messages
+                print(f"Self-healing participant error: {e}")
+    return change_seq, row, participant_update
 
 @app.post("/chats/{chat_id}/messages")
-async def add_message(chat_id: int, message: Message, background_tasks: BackgroundTasks):
-    # 1. Save to Postgres
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Generate ID using timestamp
-    # Postgres supports BIGINT, manual ID is ok.
-    new_id = int(datetime.now().timestamp() * 1000)
+async def add_message(chat_id: int, message: Message):
+    # Snowflake id (id_generator.py): unique across workers, time-ordered
+    new_id = next_id()
     
     msg_dict = message.dict()
     
     msg_dict["id"] = new_id
     msg_dict["isPinned"] = False
-    
-    cursor.execute('''
-        INSERT INTO messages (id, chat_id, text, sender, time, type, fileUrl, fileName, fileSize, isPinned, callRoomName, callStatus, isVoice, replyTo, synced)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, FALSE)
-    ''', (
-        new_id,
-        chat_id,
-        msg_dict.get("text"),
-        msg_dict.get("sender"),
-        msg_dict.get("time"),
-        msg_dict.get("type"),
-        msg_dict.get("fileUrl"),
-        msg_dict.get("filename"),
-        msg_dict.get("size"),
-        False, # isPinned
-        msg_dict.get("callRoomName"),
-        msg_dict.get("callStatus"),
-        msg_dict.get("isVoice", False),
-        json.dumps(msg_dict.get("replyTo")) if msg_dict.get("replyTo") else None
-    ))
-    
-    # Self-Healing: Check if sender is in participants, if not add them
+
+    # A retry of a send we already stored gets the original id back, nothing is re-sent
+    client_key = (str(message.sender), message.client_msg_id) if message.client_msg_id else None
+    if client_key:
+        stored = await find_stored_message(client_key)
+        if stored:
+            msg_dict["id"] = stored["id"]
+            return msg_dict
+    
+    participant_update = None
+
+    # Self-healing: senders missing from chat_members get added below.
+    # Membership is cached, so the common case costs no query.
+    new_part = None
+    sender_id = msg_dict.get("sender")
     try:
-        sender_id = msg_dict.get("sender")
         if sender_id and sender_id != 'me':
-             # Try to interpret sender_id as int if possible
-             try:
-                 sender_int = int(sender_id)
-             except:
-                 sender_int = sender_id
-                 
-             # Re-get cursor as dict
-             dict_cursor = get_db_cursor(conn)
-             dict_cursor.execute("SELECT participants FROM chats WHERE id = %s", (chat_id,))
-             chat_row = dict_cursor.fetchone()
-             if chat_row:
-                 parts = json.loads(chat_row["participants"])
-                 if not any(str(p.get("id")) == str(sender_int) for p in parts):
-                     # Fetch user query
-                     dict_cursor.execute("SELECT * FROM users WHERE id = %s", (sender_int,))
-                     user_row = dict_cursor.fetchone()
-                     if user_row:
-                         user_data = dict(user_row)
-                         new_part = {
-                             "id": user_data["id"],
-                             "name": user_data["name"],
-                             "email": user_data["email"],
-                             "avatar": user_data["avatar"]
-                         }
-                         parts.append(new_part)
-                         cursor.execute("UPDATE chats SET participants = %s WHERE id = %s", 
-                                      (json.dumps(parts), chat_id))
-                                      
-                         # Broadcast updated participants list
-                         await manager.broadcast({
-                             "type": "participant_update",
-                             "participants": parts
-                         }, chat_id)
+            try:
+                sender_int = int(sender_id)
+            except (TypeError, ValueError):
+                sender_int = None
+            if sender_int is not None and sender_int not in await get_chat_member_ids(chat_id):
+                user_data = await get_user(sender_int)
+                if user_data:
+                    new_part = {
+                        "id": user_data["id"],
+                        "name": user_data["name"],
+                        "email": user_data["email"],
+                        "avatar": user_data["avatar"]
+                    }
     except Exception as e:
         print(f"Self-healing participant error: {e}")
-        
-    conn.commit()
-    conn.close()
-    
-    # 2. Trigger Background Sync
-    background_tasks.add_task(sync_to_firebase)
-    
-    # 3. Broadcast via WebSocket (Uses Redis Pub/Sub internally now)
+
+    # 1. Save to Postgres
+    try:
+        change_seq, row, participant_update = await insert_message(chat_id, msg_dict, new_part)
+    except asyncpg.UniqueViolationError:
+        # Same client_msg_id raced in from another request
+        stored = client_key and await find_stored_message(client_key)
+        if not stored:
+            raise
+        msg_dict["id"] = stored["id"]
+        return msg_dict
+
+    await recent_messages.push(chat_id, change_seq, [serialize_message(row)])
+    chat_summaries.note(chat_id, new_id, preview(msg_dict.get("text"), msg_dict.get("type")), datetime.now().isoformat())
+
+    if new_part is not None:
+        # Stale entry, or we just added them
+        await invalidate(membership_cache, chat_id)
+
+    if participant_update is not None:
+        # Broadcast updated participants list
+        await manager.broadcast({
+            "type": "participant_update",
+            "participants": participant_update
+        }, chat_id)
+    
+    # 2. Broadcast via WebSocket (Uses Redis Pub/Sub internally now)
     await manager.broadcast(msg_dict, chat_id)
     
     return msg_dict
 
-def sync_clear_messages(chat_id: int):
-    chats_ref = db.collection("chats")
-    query = chats_ref.where("id", "==", chat_id).limit(1).stream()
-    for doc in query:
-        messages_ref = doc.reference.collection("messages")
-        batch = db.batch()
-        count = 0
-        for msg in messages_ref.stream():
-            batch.delete(msg.reference)
-            count += 1
-            if count >= 400:
-                batch.commit()
-                batch = db.batch()
-                count = 0
-        if count > 0:
-            batch.commit()
-        
-        doc.reference.update({
-            "lastMessage": "Chat cleared",
-            "timestamp": datetime.now().isoformat()
-        })
-
 @app.delete("/chats/{chat_id}/messages")
-async def clear_chat_messages(chat_id: int, background_tasks: BackgroundTasks):
-    # 1. Delete from Postgres
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM messages WHERE chat_id = %s", (chat_id,))
-    
-    # Update last message in chat
-    cursor.execute('''
-        UPDATE chats 
-        SET lastMessage = 'Chat cleared', timestamp = %s, synced = FALSE 
-        WHERE id = %s
-    ''', (datetime.now().isoformat(), chat_id))
-    
-    conn.commit()
-    conn.close()
-    
-    # 2. Background Sync
-    background_tasks.add_task(sync_clear_messages, chat_id)
-    background_tasks.add_task(sync_to_firebase) # For the chat update
+async def clear_chat_messages(chat_id: int):
+    cleared_at = datetime.now().isoformat()
+    async with async_db.transaction() as conn:
+        # Before the delete: it needs the id of the newest message being cleared
+        await reset_summary(conn, chat_id, 'Chat cleared', cleared_at)
+        await conn.execute("DELETE FROM messages WHERE chat_id = $1", chat_id)
+
+        # Update last message in chat; cleared_seq tells change-feed clients to reset
+        await conn.execute('''
+            UPDATE chats
+            SET lastMessage = 'Chat cleared', timestamp = $1, synced = FALSE,
+                change_seq = change_seq + 1, cleared_seq = change_seq + 1
+            WHERE id = $2
+        ''', cleared_at, chat_id)
+
+        # Firestore side happens in the sync worker
+        await enqueue_sync(conn, "clear_chat", chat_id, payload={"timestamp": cleared_at})
+    await recent_messages.drop(chat_id)
+    chat_summaries.discard(chat_id)
     
     return {"message": "Chat cleared"}
 
-def sync_delete_chat(chat_id: int):
-    chats_ref = db.collection("chats")
-    query = chats_ref.where("id", "==", chat_id).limit(1).stream()
-    for doc in query:
-        # Delete messages first
-        messages_ref = doc.reference.collection("messages")
-        batch = db.batch()
-        for msg in messages_ref.stream():
-            batch.delete(msg.reference)
-            if len(batch) >= 400:
-                batch.commit()
-                batch = db.batch()
-        if len(batch) > 0:
-            batch.commit()
-            
-        # Delete chat doc
-        doc.reference.delete()
-
 @app.delete("/chats/{chat_id}")
-async def delete_chat(chat_id: int, background_tasks: BackgroundTasks):
-    # 1. Soft/Hard Delete from Postgres
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM messages WHERE chat_id = %s", (chat_id,))
-    cursor.execute("DELETE FROM chats WHERE id = %s", (chat_id,))
-    conn.commit()
-    conn.close()
-    
-    # 2. Background Sync
-    background_tasks.add_task(sync_delete_chat, chat_id)
+async def delete_chat(chat_id: int):
+    async with async_db.transaction() as conn:
+        await conn.execute("DELETE FROM messages WHERE chat_id = $1", chat_id)
+        await conn.execute("DELETE FROM chat_members WHERE chat_id = $1", chat_id)
+        await conn.execute("DELETE FROM chats WHERE id = $1", chat_id)
+        await enqueue_sync(conn, "delete_chat", chat_id)
+    await invalidate(membership_cache, chat_id)
+    await recent_messages.drop(chat_id)
+    chat_summaries.discard(chat_id)
     
     return {"message": "Chat deleted"}
 
@@ -723,139 +852,100 @@ async def delete_message_for_me(chat_id: int, message_id: int, request: dict):
         print("DEBUG: user_id missing")
         raise HTTPException(status_code=400, detail="user_id required")
         
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # 1. Fetch current deleted_for
-    cursor.execute("SELECT deleted_for FROM messages WHERE id = %s", (message_id,))
-    row = cursor.fetchone()
-    if not row:
-        print("DEBUG: Message not found")
-        conn.close()
-        raise HTTPException(status_code=404, detail="Message not found")
-        
-    current_deleted_for = row[0]
-    deleted_list = []
-    if current_deleted_for:
-        try:
-            deleted_list = json.loads(current_deleted_for)
-        except:
-            deleted_list = []
-            
-    # 2. Add user_id if not present
-    if user_id not in deleted_list:
-        deleted_list.append(user_id)
-        cursor.execute("UPDATE messages SET deleted_for = %s WHERE id = %s", (json.dumps(deleted_list), message_id))
-        conn.commit()
-        
-    conn.close()
+    async with async_db.transaction() as conn:
+        # Chat row first, then the message, in the same order as every other mutation
+        change_seq = await next_change_seq(conn, chat_id)
+        # 1. Fetch current deleted_for
+        row = await conn.fetchrow(
+            "SELECT deleted_for FROM messages WHERE id = $1 AND chat_id = $2 FOR UPDATE", message_id, chat_id
+        )
+        if change_seq is None or not row:
+            print("DEBUG: Message not found")
+            raise HTTPException(status_code=404, detail="Message not found")
+
+        current_deleted_for = row[0]
+        deleted_list = []
+        if current_deleted_for:
+            try:
+                deleted_list = json.loads(current_deleted_for)
+            except:
+                deleted_list = []
+
+        # 2. Add user_id if not present
+        if user_id not in deleted_list:
+            deleted_list.append(user_id)
+            await conn.execute(
+                "UPDATE messages SET deleted_for = $1, change_seq = $2 WHERE id = $3",
+                json.dumps(deleted_list), change_seq, message_id
+            )
+
     return {"status": "success", "deleted_for": deleted_list}
 
 @app.post("/chats/{chat_id}/messages/{message_id}/pin")
 async def pin_message(chat_id: int, message_id: int):
-    # TODO: This endpoint used Firestore only? It should update Postgres too.
-    # The original implementation only updated Firestore!
-    # I should verify this.
-    # Original: chats_ref = db.collection...
-    # I should add Postgres update.
-    
-    conn = get_db_connection()
-    cursor = get_db_cursor(conn)
-    cursor.execute("SELECT isPinned FROM messages WHERE id = %s", (message_id,))
-    row = cursor.fetchone()
-    
-    new_status = False
-    if row:
-        new_status = not row["isPinned"]
-        cursor.execute("UPDATE messages SET isPinned = %s, synced = FALSE WHERE id = %s", (new_status, message_id))
-        conn.commit()
-    
-    conn.close()
-    
-    # Also update Firestore (Hybrid)
-    chats_ref = db.collection("chats")
-    query = chats_ref.where("id", "==", chat_id).limit(1).stream()
-    
-    for doc in query:
-        messages_ref = doc.reference.collection("messages")
-        msg_query = messages_ref.where("id", "==", message_id).limit(1).stream()
-        
-        for msg_doc in msg_query:
-            msg_data = msg_doc.to_dict()
-            new_status = not msg_data.get("isPinned", False)
-            msg_doc.reference.update({"isPinned": new_status})
-            
-            msg_data["isPinned"] = new_status
-            return msg_data
-            
-    raise HTTPException(status_code=404, detail="Message not found")
+    # Toggle in Postgres; the sync worker mirrors it to Firestore
+    async with async_db.transaction() as conn:
+        change_seq = await next_change_seq(conn, chat_id)
+        row = await conn.fetchrow('''
+            UPDATE messages SET isPinned = NOT COALESCE(isPinned, FALSE), change_seq = $1, synced = FALSE
+            WHERE id = $2 AND chat_id = $3
+            RETURNING *
+        ''', change_seq, message_id, chat_id)
+        if row is None:
+            raise HTTPException(status_code=404, detail="Message not found")
+        await enqueue_sync(conn, "message_update", chat_id, message_id)
+    await recent_messages.push(chat_id, change_seq, [serialize_message(row)])
+
+    # Same camelCase shape the Firestore doc used to be returned in
+    return message_to_firestore(row)
 
 @app.put("/chats/{chat_id}/messages/{message_id}")
-async def update_message(chat_id: int, message_id: int, updates: dict, background_tasks: BackgroundTasks):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
+async def update_message(chat_id: int, message_id: int, updates: dict):
     # 1. Update Postgres
     fields = []
     values = []
     for k, v in updates.items():
         if k in ['text', 'callStatus', 'isPinned', 'replyTo']: # Allowed fields
-            fields.append(f"{k} = %s")
+            fields.append(f"{k} = ${len(fields) + 1}")
             if isinstance(v, (dict, list)):
                 values.append(json.dumps(v))
+            elif k == 'isPinned':
+                values.append(bool(v))
+            elif v is not None:
+                values.append(str(v))
             else:
                 values.append(v)
                 
     if not fields:
-        conn.close()
         return {"error": "No valid fields to update"}
         
-    values.append(message_id) # For WHERE clause
-    
-    cursor.execute(f"UPDATE messages SET {', '.join(fields)} WHERE id = %s", values)
-    
-    if cursor.rowcount == 0:
-        conn.close()
-        raise HTTPException(status_code=404, detail="Message not found in local DB")
+    # 2. Update and fetch the updated message in one round trip
+    async with async_db.transaction() as conn:
+        change_seq = await next_change_seq(conn, chat_id)
+        values.append(change_seq)
+        fields.append(f"change_seq = ${len(values)}")
+        values.append(message_id) # For WHERE clause
+        values.append(chat_id)
+        row = await conn.fetchrow(
+            f"UPDATE messages SET {', '.join(fields)} WHERE id = ${len(values) - 1} AND chat_id = ${len(values)} RETURNING *",
+            *values
+        )
+
+        if row is None:
+            # Raising inside the transaction rolls back the seq bump
+            raise HTTPException(status_code=404, detail="Message not found in local DB")
+        await enqueue_sync(conn, "message_update", chat_id, message_id)
+    await recent_messages.push(chat_id, change_seq, [serialize_message(row)])
         
-    conn.commit()
-    
-    # 2. Fetch updated message
-    cursor = get_db_cursor(conn) # Switch to dict cursor
-    cursor.execute("SELECT * FROM messages WHERE id = %s", (message_id,))
-    row = cursor.fetchone()
-    updated_msg = dict(row)
-    
-    if updated_msg.get("replyTo"):
-         try:
-             updated_msg["replyTo"] = json.loads(updated_msg["replyTo"])
-         except:
-             pass
-             
-    conn.close()
+    updated_msg = serialize_message(row)
     
     # 3. Broadcast
     await manager.broadcast(updated_msg, chat_id)
     
-    # 4. Background Sync (Firestore)
-    def sync_update():
-        chats_ref = db.collection("chats")
-        query = chats_ref.where("id", "==", chat_id).limit(1).stream()
-        for doc in query:
-            messages_ref = doc.reference.collection("messages")
-            msg_query = messages_ref.where("id", "==", message_id).limit(1).stream()
-            for msg_doc in msg_query:
-                msg_doc.reference.update(updates)
-                
-    background_tasks.add_task(sync_update)
-    
     return updated_msg
 
 @app.delete("/chats/{chat_id}/messages/{message_id}")
 async def delete_message(chat_id: int, message_id: int):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
     # 1. Soft Delete in Postgres
     updates = {
         "text": "🚫 This message was deleted",
@@ -870,95 +960,65 @@ async def delete_message(chat_id: int, message_id: int):
         "isDeleted": True 
     }
     
-    cursor.execute("""
-        UPDATE messages 
-        SET text = %s, type = %s, fileUrl = NULL, fileName = NULL, 
-            fileSize = NULL, callStatus = NULL, callRoomName = NULL, 
-            isVoice = NULL, replyTo = NULL, isDeleted = TRUE
-        WHERE id = %s
-    """, (updates["text"], updates["type"], message_id))
-    
-    if cursor.rowcount == 0:
-        conn.close()
-        raise HTTPException(status_code=404, detail="Message not found")
+    # RETURNING gives us the updated message for broadcast
+    async with async_db.transaction() as conn:
+        change_seq = await next_change_seq(conn, chat_id)
+        row = await conn.fetchrow("""
+            UPDATE messages
+            SET text = $1, type = $2, fileUrl = NULL, fileName = NULL,
+                fileSize = NULL, callStatus = NULL, callRoomName = NULL,
+                isVoice = NULL, replyTo = NULL, isDeleted = TRUE, change_seq = $3
+            WHERE id = $4 AND chat_id = $5
+            RETURNING *
+        """, updates["text"], updates["type"], change_seq, message_id, chat_id)
+
+        if row is None:
+            raise HTTPException(status_code=404, detail="Message not found")
+        await enqueue_sync(conn, "message_update", chat_id, message_id)
+    await recent_messages.push(chat_id, change_seq, [serialize_message(row)])
         
-    conn.commit()
-    
-    # Fetch updated message for broadcast
-    cursor = get_db_cursor(conn)
-    cursor.execute("SELECT * FROM messages WHERE id = %s", (message_id,))
-    updated_msg = dict(cursor.fetchone())
-    conn.close()
+    updated_msg = serialize_message(row)
     
     # 2. Broadcast Update
     await manager.broadcast(updated_msg, chat_id)
     
-    # 3. Background Sync (Firestore)
-    def sync_soft_delete():
-        chats_ref = db.collection("chats")
-        query = chats_ref.where("id", "==", chat_id).limit(1).stream()
-        for doc in query:
-            messages_ref = doc.reference.collection("messages")
-            msg_query = messages_ref.where("id", "==", message_id).limit(1).stream()
-            for msg_doc in msg_query:
-                msg_doc.reference.update(updates)
-
-    sync_soft_delete()
-    
     return {"status": "success", "message": "Message deleted"}
 
 @app.post("/chats/{chat_id}/participants")
-async def add_participant(chat_id: int, user_data: dict, background_tasks: BackgroundTasks):
+async def add_participant(chat_id: int, user_data: dict):
     email = user_data.get("email")
     if not email:
         raise HTTPException(status_code=400, detail="Email is required")
         
-    user_to_add = get_user_by_email(email)
+    user_to_add = await get_user_by_email(email)
     if not user_to_add:
         raise HTTPException(status_code=404, detail="User not found")
         
     # 1. Update Postgres
-    conn = get_db_connection()
-    cursor = get_db_cursor(conn)
-    
-    # Get current participants from SQLite
-    cursor.execute("SELECT participants FROM chats WHERE id = %s", (chat_id,))
-    row = cursor.fetchone()
-    
-    if not row:
-        conn.close()
-        raise HTTPException(status_code=404, detail="Chat not found")
-        
-    import json
-    current_participants = json.loads(row["participants"])
-    
-    # Check if already in chat
-    if any(p.get("id") == user_to_add["id"] for p in current_participants):
-         conn.close()
-         raise HTTPException(status_code=400, detail="User already in chat")
-         
-    current_participants.append(user_to_add)
-    
-    cursor.execute("UPDATE chats SET participants = %s, synced = FALSE WHERE id = %s", 
-                  (json.dumps(current_participants), chat_id))
-    conn.commit()
-    conn.close()
-    
-    # 2. Background Sync
-    background_tasks.add_task(sync_to_firebase)
+    async with async_db.transaction() as conn:
+        chat_exists = await conn.fetchval("SELECT 1 FROM chats WHERE id = $1", chat_id)
+        if not chat_exists:
+            raise HTTPException(status_code=404, detail="Chat not found")
+
+        # Returns None when the user is already a member
+        added = await add_chat_member(conn, chat_id, user_to_add)
+        if added is None:
+             raise HTTPException(status_code=400, detail="User already in chat")
+    await invalidate(membership_cache, chat_id)
     
     return {"message": "User added", "user": user_to_add}
 
 @app.get("/chats/{chat_id}/participants")
-async def get_participants(chat_id: int):
-    conn = get_db_connection()
-    cursor = get_db_cursor(conn)
-    cursor.execute("SELECT participants FROM chats WHERE id = %s", (chat_id,))
-    row = cursor.fetchone()
-    conn.close()
+async def get_participants(request: Request, response: Response, chat_id: int):
+    # Membership changes bump change_seq (see add_chat_member)
+    change_seq = await async_db.fetchval("SELECT change_seq FROM chats WHERE id = $1", chat_id)
+    cached = not_modified(request, response, make_etag("participants", chat_id, change_seq))
+    if cached:
+        return cached
+
+    row = await async_db.fetchrow("SELECT participants FROM chats WHERE id = $1", chat_id)
     
     if row:
-        import json
         try:
             return json.loads(row["participants"])
         except:
@@ -966,13 +1026,26 @@ async def get_participants(chat_id: int):
     return []
 
 @app.post("/upload")
-def upload_file(file: UploadFile = File(...)):
+def upload_file(background_tasks: BackgroundTasks, file: UploadFile = File(...)):
     file_location = f"uploads/{file.filename}"
     with open(file_location, "wb+") as file_object:
         shutil.copyfileobj(file.file, file_object)
+    # Make the document searchable (/search/files) once the response is out
+    background_tasks.add_task(index_upload, file.filename)
     
     return {"url": f"/uploads/{file.filename}"}
 
+FILE_SEARCH_DEFAULT = 20
+FILE_SEARCH_MAX = 100
+
+@app.get("/search/files")
+async def search_files_endpoint(q: str, limit: int = None):
+    q = q.strip()
+    if not q:
+        raise HTTPException(status_code=400, detail="Empty query")
+    limit = max(1, min(limit or FILE_SEARCH_DEFAULT, FILE_SEARCH_MAX))
+    return {"results": await search_files(q, limit)}
+
 @app.post("/analyze-message")
 async def analyze_message_endpoint(analysis_request: IdeaAnalysis):
     is_idea, confidence = analyze_text(analysis_request.text)
@@ -985,113 +1058,168 @@ async def analyze_message_endpoint(analysis_request: IdeaAnalysis):
             "tags": ["AI Detected"],
             "timestamp": datetime.now().isoformat()
         }
-        # Add ID
-        ideas_ref = db.collection("ideas")
-        count = len(list(ideas_ref.stream()))
-        new_idea["id"] = count + 1
-        
-        db.collection("ideas").add(new_idea)
+        # Generated id like everywhere else; counting the whole collection for it was O(n)
+        new_idea["id"] = next_id()
+        async with async_db.transaction() as conn:
+            await enqueue_sync(conn, "idea", payload=new_idea)
         
     return {"is_idea": is_idea, "confidence": confidence}
 
-from file_extractor import extract_text
+async def analyze_upload(filename: str):
+    file_path = f"uploads/{filename}"
+
+    # Extract text content and analyze it: cached by file content, else in the extraction pool
+    extracted_text, analysis, sha256 = await analysis_cache.analyze(file_path)
+
+    if not extracted_text:
+        extracted_text = f"File: {filename}"
+    # Keep the full text searchable; the idea below only carries a preview
+    try:
+        await index_text(filename, extracted_text, sha256)
+    except Exception as e:
+        print(f"Error indexing {filename}: {e}")
+
+    # Force is_idea to True since user explicitly requested it
+    analysis.is_idea = True
+
+    if analysis.is_idea:
+         new_idea = {
+            "title": f"File Idea: {filename}",
+            "content": extracted_text[:500] + "..." if len(extracted_text) > 500 else extracted_text,
+            "full_content": extracted_text,
+            "tags": ["File", "AI Detected", analysis.category or "General"],
+            "timestamp": datetime.now().isoformat(),
+            "priority": analysis.priority,
+            "viability_score": analysis.viability_score,
+            "deadline": analysis.deadline,
+            "action_suggestion": analysis.action_suggestion
+         }
+         new_idea["id"] = next_id()
+         async with async_db.transaction() as conn:
+             await enqueue_sync(conn, "idea", payload=new_idea)
+
+    return analysis
+
+async def analyze_upload_job(filename: str):
+    return (await analyze_upload(filename)).dict()
 
 @app.post("/analyze-file")
-async def analyze_file_endpoint(file_input: FileInput):
+async def analyze_file_endpoint(file_input: FileInput, response: Response):
     file_path = f"uploads/{file_input.filename}"
     
     try:
-        # Extract text content
-        extracted_text = extract_text(file_path)
-        
-        if not extracted_text or "Unsupported" in extracted_text:
-            if not extracted_text:
-                extracted_text = f"File: {file_input.filename}"
-                
-        # Analyze the extracted text
-        analysis = analyze_text(extracted_text)
-        
-        # Force is_idea to True since user explicitly requested it
-        analysis.is_idea = True
-        
-        if analysis.is_idea:
-             new_idea = {
-                "title": f"File Idea: {file_input.filename}",
-                "content": extracted_text[:500] + "..." if len(extracted_text) > 500 else extracted_text,
-                "full_content": extracted_text,
-                "tags": ["File", "AI Detected", analysis.category or "General"],
-                "timestamp": datetime.now().isoformat(),
-                "priority": analysis.priority,
-                "viability_score": analysis.viability_score,
-                "deadline": analysis.deadline,
-                "action_suggestion": analysis.action_suggestion
-            }
-             ideas_ref = db.collection("ideas")
-             count = len(list(ideas_ref.stream()))
-             new_idea["id"] = count + 1
-             
-             db.collection("ideas").add(new_idea)
-             
-        return analysis
+        # Big documents run as a background job; poll status_url for the analysis
+        if os.path.exists(file_path) and os.path.getsize(file_path) >= EXTRACT_JOB_BYTES:
+            job_id = await extraction.start_job(analyze_upload_job(file_input.filename))
+            response.status_code = 202
+            return {"job_id": job_id, "status": "pending", "status_url": f"/analyze-file/jobs/{job_id}"}
+
+        return await analyze_upload(file_input.filename)
+    except ExtractionBusy as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         print(f"Error analyzing file: {e}")
         # Fallback to simple analysis
         return {"is_idea": False, "error": str(e)}
 
+@app.get("/analyze-file/jobs/{job_id}")
+async def get_analyze_job(job_id: str):
+    job = await extraction.get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found or expired")
+    return {"job_id": job_id, **job}
+
+
+# Frames a client may have in flight before we stop reading from it
+WS_MAX_INFLIGHT = int(os.getenv("WS_MAX_INFLIGHT", "64"))
 
 @app.websocket("/ws/{chat_id}/{user_id}")
 async def websocket_endpoint(websocket: WebSocket, chat_id: int, user_id: int):
     await manager.connect(websocket, chat_id)
+
+    # Frames are submitted as they arrive, so a client can pipeline sends; this task
+    # acks (or nacks) them and broadcasts the stored messages in arrival order.
+    inflight = asyncio.Queue(maxsize=WS_MAX_INFLIGHT)
+
+    async def deliver():
+        while True:
+            item = await inflight.get()
+            if item is None:
+                return
+            message_data, client_msg_id, submitted = item
+            try:
+                row, duplicate = await submitted
+            except Exception as e:
+                logger.exception("Error storing message %s in chat %s", client_msg_id, chat_id)
+                manager.send_personal({"type": "nack", "client_msg_id": client_msg_id, "error": str(e)}, websocket, chat_id)
+                continue
+
+            manager.send_personal({
+                "type": "ack",
+                "client_msg_id": client_msg_id,
+                "id": row["id"],
+                "duplicate": duplicate,
+            }, websocket, chat_id)
+            if not duplicate:
+                # 2. Broadcast to Room (via Redis); a duplicate went out the first time
+                message_data["id"] = row["id"]
+                try:
+                    await manager.broadcast(message_data, chat_id)
+                except Exception as e:
+                    print(f"Error broadcasting message: {e}")
+
+    deliverer = asyncio.create_task(deliver())
     try:
         while True:
             data = await websocket.receive_text()
+            client_msg_id = None
             try:
                 message_data = json.loads(data)
                 
                 # 1. Save to Postgres
-                conn = get_db_connection()
-                cursor = conn.cursor()
-                
-                # Default values
-                msg_id = message_data.get("id", int(datetime.now().timestamp() * 1000))
+                # Server id always; the client's own key (or, from older clients, its
+                # id) only identifies retries
+                client_msg_id = message_data.get("client_msg_id", message_data.get("id"))
+                client_msg_id = str(client_msg_id) if client_msg_id is not None else None
                 text = message_data.get("text", "")
-                sender = message_data.get("sender", str(user_id)) # Fallback to user_id path param
+                sender = str(message_data.get("sender", user_id)) # Fallback to user_id path param
                 time_str = message_data.get("time", datetime.now().strftime("%H:%M"))
                 msg_type = message_data.get("type", "text")
                 file_url = message_data.get("fileUrl", "")
                 file_name = message_data.get("filename", "")
-                file_size = message_data.get("size", "")
-                
-                cursor.execute('''
-                    INSERT INTO messages (id, chat_id, text, sender, time, type, fileUrl, fileName, fileSize, synced)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, FALSE)
-                ''', (
-                    msg_id,
-                    chat_id,
-                    text,
-                    sender,
-                    time_str,
-                    msg_type,
-                    file_url,
-                    file_name,
-                    file_size
-                ))
-                
-                # Update Chat's Last Message
-                last_msg_preview = text if msg_type == 'text' else f"Sent a {msg_type}"
-                cursor.execute('UPDATE chats SET lastMessage = %s, timestamp = %s WHERE id = %s', 
-                               (last_msg_preview, datetime.now().isoformat(), chat_id))
-                
-                conn.commit()
-                conn.close()
-                
-                # 2. Broadcast to Room (via Redis)
-                await manager.broadcast(message_data, chat_id)
+                file_size = str(message_data.get("size", ""))
+
+                # Written together with other frames arriving in the same few ms
+                submitted = asyncio.ensure_future(ingest.submit({
+                    "id": next_id(),
+                    "chat_id": chat_id,
+                    "text": text,
+                    "sender": sender,
+                    "time": time_str,
+                    "type": msg_type,
+                    "fileUrl": file_url,
+                    "fileName": file_name,
+                    "fileSize": file_size,
+                    "client_msg_id": client_msg_id,
+                }))
+                await inflight.put((message_data, client_msg_id, submitted))
                 
             except json.JSONDecodeError:
                 print(f"Invalid JSON received: {data}")
+                manager.send_personal({"type": "nack", "client_msg_id": None, "error": "invalid JSON"}, websocket, chat_id)
             except Exception as e:
-                print(f"Error processing message: {e}")
-                
+                # Bad frame shape, no worker id, ingest closed...: the client still gets an answer
+                logger.exception("Error processing message %s in chat %s", client_msg_id, chat_id)
+                manager.send_personal({"type": "nack", "client_msg_id": client_msg_id, "error": str(e)}, websocket, chat_id)
+
     except WebSocketDisconnect:
-        manager.disconnect(websocket, chat_id)
+        pass
+    finally:
+        # Let what was already submitted finish, so committed messages still reach the room
+        try:
+            await inflight.put(None)
+            await deliverer
+        except Exception as e:
+            print(f"Error delivering pending messages: {e}")
+        # Always drop the socket so the chat's channel refcount stays accurate
+        await manager.disconnect(websocket, chat_id)
@@ -0,0 +1,73 @@
+import math
+from recent_messages import HIDDEN_FOR_USER_SQL
+
+# Full-text search over messages.search_vector (GIN index, see database.py).
+#
+# Results are ordered by (rank DESC, id DESC); the cursor is the last row's "rank:id".
+
+def encode_search_cursor(rank: float, id: int) -> str:
+    return f"{rank!r}:{id}"
+
+def decode_search_cursor(cursor: str):
+    """(rank, id) from a cursor; ValueError if it isn't one we handed out."""
+    try:
+        rank, id = cursor.split(":")
+        rank, id = float(rank), int(id)
+    except (AttributeError, ValueError):
+        raise ValueError("Invalid cursor")
+    if not math.isfinite(rank):
+        raise ValueError("Invalid cursor")
+    return rank, id
+
+def build_search_query(q: str, limit: int, chat_id: int = None, sender: str = None, user_id: int = None,
+                       cursor: str = None):
+    """
+    (sql, args) for one page of search results, fetching limit + 1 rows so the caller
+    can tell whether there is another page.
+    """
+    args = [q]
+    conditions = ["m.search_vector @@ query", "NOT COALESCE(m.isDeleted, FALSE)"]
+    if chat_id is not None:
+        args.append(chat_id)
+        conditions.append(f"m.chat_id = ${len(args)}")
+    if sender is not None:
+        args.append(sender)
+        conditions.append(f"m.sender = ${len(args)}")
+    if user_id:
+        # Only chats the user belongs to, minus their 'Delete for Me' messages
+        args.append(user_id)
+        conditions.append(f"m.chat_id IN (SELECT chat_id FROM chat_members WHERE user_id = ${len(args)})")
+        conditions.append(HIDDEN_FOR_USER_SQL.format(param=f"${len(args)}"))
+
+    after = ""
+    if cursor:
+        rank, last_id = decode_search_cursor(cursor)
+        args.extend([rank, last_id])
+        # ts_rank_cd returns real; compare at the same precision so ties resolve on id
+        after = f"WHERE (rank, id) < (${len(args) - 1}::real, ${len(args)})"
+
+    args.append(limit + 1)
+    # ts_headline is expensive, so it only runs on the page that is returned
+    sql = f"""
+        SELECT page.*, ts_headline('english', COALESCE(page.text, ''), websearch_to_tsquery('english', $1),
+                                   'MaxFragments=2, MaxWords=20, MinWords=5') AS snippet
+        FROM (
+            SELECT * FROM (
+                SELECT m.*, ts_rank_cd(m.search_vector, query) AS rank
+                FROM messages m, websearch_to_tsquery('english', $1) query
+                WHERE {' AND '.join(conditions)}
+            ) hits
+            {after}
+            ORDER BY rank DESC, id DESC
+            LIMIT ${len(args)}
+        ) page
+        ORDER BY rank DESC, id DESC
+    """
+    return sql, args
+
+def search_page(rows, limit: int):
+    """Splits limit + 1 fetched rows into (page, next_cursor, has_more)."""
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    next_cursor = encode_search_cursor(rows[-1]["rank"], rows[-1]["id"]) if has_more else None
+    return rows, next_cursor, has_more
@@ -1,3 +1,6 @@
+# One-off import of the original Firestore data. For ongoing Postgres <-> Firestore
+# consistency checks use reconcile.py (or POST /sync/reconcile), which compares per-chat
+# hash trees and rewrites only the drifted buckets instead of copying everything.
 import firebase_admin
 from firebase_admin import credentials, firestore
 import sqlite3
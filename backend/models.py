@@ -16,6 +16,8 @@ class Message(BaseModel):
     callRoomName: Optional[str] = None
     callStatus: Optional[str] = None
     isVoice: bool = False
+    # Idempotency key: resending the same one returns the stored message
+    client_msg_id: Optional[str] = None
 
 class IdeaAnalysis(BaseModel):
     is_idea: bool
@@ -0,0 +1,169 @@
+import os
+import json
+from redis_client import redis_client
+
+# Newest N messages of each chat, kept in Redis so opening a chat doesn't scan its history.
+#
+# recent:<chat_id>       sorted set, score = message id, member = serialized message
+# recent:<chat_id>:meta  hash: seq = chats.change_seq the set reflects,
+#                        complete = 1 if the set holds the chat's whole history
+#
+# Readers only trust an entry whose seq matches the chat's current change_seq, so any
+# write we didn't mirror (a Redis blip, an out-of-order update, a participant change)
+# just turns into a miss and a refill from Postgres.
+
+RECENT_MESSAGES_SIZE = int(os.getenv("RECENT_MESSAGES_SIZE", "100"))
+RECENT_MESSAGES_TTL = int(os.getenv("RECENT_MESSAGES_TTL", str(24 * 60 * 60)))
+
+# Applies one committed transaction that moved change_seq by `bumps`. Only extends an
+# entry that is exactly that far behind; a gap means we missed something, so the entry
+# is dropped instead.
+# KEYS: set, meta. ARGV: seq, bumps, size, ttl, then (id, payload) pairs.
+PUSH_SCRIPT = """
+local cached = tonumber(redis.call('HGET', KEYS[2], 'seq'))
+if not cached then return 0 end
+local seq = tonumber(ARGV[1])
+if seq <= cached then return 0 end
+if seq - tonumber(ARGV[2]) ~= cached then
+    redis.call('DEL', KEYS[1], KEYS[2])
+    return -1
+end
+for i = 5, #ARGV, 2 do
+    redis.call('ZREMRANGEBYSCORE', KEYS[1], ARGV[i], ARGV[i])
+    redis.call('ZADD', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+local size = tonumber(ARGV[3])
+if redis.call('ZCARD', KEYS[1]) > size then
+    redis.call('ZREMRANGEBYRANK', KEYS[1], 0, -(size + 1))
+    redis.call('HSET', KEYS[2], 'complete', 0)
+end
+redis.call('HSET', KEYS[2], 'seq', seq)
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+redis.call('EXPIRE', KEYS[2], ARGV[4])
+return 1
+"""
+
+def keys(chat_id: int):
+    return f"recent:{chat_id}", f"recent:{chat_id}:meta"
+
+def encode(message: dict) -> str:
+    return json.dumps(message, separators=(",", ":"), ensure_ascii=False, default=str)
+
+# 'Delete for Me' filter. deleted_for holds ids as numbers or strings, so match both.
+HIDDEN_FOR_USER_SQL = """
+    NOT (COALESCE(NULLIF(deleted_for, ''), '[]')::jsonb @> jsonb_build_array({param}::bigint)
+         OR COALESCE(NULLIF(deleted_for, ''), '[]')::jsonb @> jsonb_build_array({param}::text))
+"""
+
+def hidden_for(message: dict, user_id) -> bool:
+    # Python side of HIDDEN_FOR_USER_SQL: ids may be stored as numbers or strings
+    try:
+        deleted_for = json.loads(message.get("deleted_for") or "[]")
+    except (TypeError, ValueError):
+        return False
+    return user_id in deleted_for or str(user_id) in deleted_for
+
+class RecentMessages:
+    def __init__(self, size: int = RECENT_MESSAGES_SIZE, ttl: int = RECENT_MESSAGES_TTL):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.fills = 0
+        self.pushes = 0
+        self.resets = 0
+        self.errors = 0
+
+    def enabled(self):
+        return redis_client.get_client() is not None
+
+    async def read(self, chat_id: int, seq: int):
+        """
+        Returns (messages oldest-first, complete) if the cached entry is at seq, else None.
+        """
+        redis = redis_client.get_client()
+        if not redis:
+            return None
+        set_key, meta_key = keys(chat_id)
+        try:
+            async with redis.pipeline(transaction=True) as pipe:
+                pipe.hgetall(meta_key)
+                pipe.zrange(set_key, 0, -1)
+                meta, payloads = await pipe.execute()
+        except Exception as e:
+            self.errors += 1
+            print(f"Recent messages read failed for chat {chat_id}: {e}")
+            return None
+
+        if not meta or int(meta.get("seq", -1)) != (seq or 0):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return [json.loads(p) for p in payloads], meta.get("complete") == "1"
+
+    async def fill(self, chat_id: int, seq: int, messages, complete: bool):
+        """Replaces the chat's entry. seq must have been read before the messages were."""
+        redis = redis_client.get_client()
+        if not redis:
+            return
+        set_key, meta_key = keys(chat_id)
+        try:
+            async with redis.pipeline(transaction=True) as pipe:
+                pipe.delete(set_key, meta_key)
+                if messages:
+                    pipe.zadd(set_key, {encode(m): m["id"] for m in messages})
+                    pipe.expire(set_key, self.ttl)
+                pipe.hset(meta_key, mapping={"seq": seq or 0, "complete": int(complete)})
+                pipe.expire(meta_key, self.ttl)
+                await pipe.execute()
+            self.fills += 1
+        except Exception as e:
+            self.errors += 1
+            print(f"Recent messages fill failed for chat {chat_id}: {e}")
+
+    async def push(self, chat_id: int, seq: int, messages, bumps: int = 1):
+        """
+        Mirrors a committed insert/update of messages. seq is the chat's change_seq
+        after the write, bumps how much the write advanced it. Call after commit.
+        """
+        redis = redis_client.get_client()
+        if not redis or seq is None:
+            return
+        args = [seq, bumps, self.size, self.ttl]
+        for m in messages:
+            args += [m["id"], encode(m)]
+        try:
+            result = await redis.eval(PUSH_SCRIPT, 2, *keys(chat_id), *args)
+            if result == 1:
+                self.pushes += 1
+            elif result == -1:
+                self.resets += 1
+        except Exception as e:
+            self.errors += 1
+            print(f"Recent messages push failed for chat {chat_id}: {e}")
+
+    async def drop(self, chat_id: int):
+        redis = redis_client.get_client()
+        if not redis:
+            return
+        try:
+            await redis.delete(*keys(chat_id))
+        except Exception as e:
+            self.errors += 1
+            print(f"Recent messages drop failed for chat {chat_id}: {e}")
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "fills": self.fills,
+            "pushes": self.pushes,
+            "resets": self.resets,
+            "errors": self.errors,
+        }
+
+# Global instance
+recent_messages = RecentMessages()
@@ -0,0 +1,362 @@
+import os
+import json
+import hashlib
+import argparse
+import threading
+from datetime import datetime
+from database import get_db_connection, get_db_cursor
+from firestore_sync import FIRESTORE_BATCH_LIMIT, ChatRefs, message_to_firestore
+from id_generator import timestamp_ms, ID_EPOCH, TIMESTAMP_SHIFT, LEGACY_ID_LIMIT
+
+# Postgres <-> Firestore drift detection.
+#
+# Each chat's messages are split into buckets by id range. A bucket's hash covers the
+# fingerprints of its messages and the chat's root hash covers the bucket hashes, so
+# equal roots mean the chat is in sync and unequal ones point at the buckets to repair.
+# Postgres is the source of truth: repairs only ever write to Firestore.
+#
+# Bucket hashes that matched Firestore are stored in reconcile_buckets. Later runs
+# only read Firestore for buckets whose Postgres hash moved since (plus anything not
+# verified in RECONCILE_FULL_AFTER_HOURS, which catches drift made on the Firestore
+# side), one id-range query per bucket, so a quiet chat costs no Firestore reads.
+
+# Buckets are by message creation time (see id_generator.timestamp_ms); default one day
+RECONCILE_BUCKET_SPAN = int(os.getenv("RECONCILE_BUCKET_SPAN", str(24 * 60 * 60 * 1000)))
+RECONCILE_FULL_AFTER_HOURS = float(os.getenv("RECONCILE_FULL_AFTER_HOURS", "168"))
+
+# What we compare. Fields the app never writes to Firestore are left out so
+# legacy docs don't show up as drift.
+FINGERPRINT_FIELDS = (
+    "id", "text", "sender", "time", "type", "fileUrl", "fileName", "fileSize",
+    "isPinned", "isDeleted", "callStatus", "replyTo",
+)
+BOOL_FIELDS = ("isPinned", "isDeleted")
+
+def normalize(field, value):
+    if field in BOOL_FIELDS:
+        return bool(value)
+    if value == "" or value is None:
+        return None
+    if field == "id":
+        return int(value)
+    if field == "replyTo" and isinstance(value, str):
+        try:
+            return json.loads(value)
+        except ValueError:
+            return value
+    if field == "sender":
+        return str(value)
+    return value
+
+def fingerprint(data: dict) -> str:
+    values = [normalize(f, data.get(f)) for f in FINGERPRINT_FIELDS]
+    return json.dumps(values, sort_keys=True, separators=(",", ":"), default=str)
+
+def bucket_of(message_id: int, span: int = RECONCILE_BUCKET_SPAN) -> int:
+    return timestamp_ms(message_id) // span
+
+def bucket_id_ranges(bucket: int, span: int = RECONCILE_BUCKET_SPAN):
+    """[low, high) message id ranges whose ids fall in bucket: legacy ids, then Snowflake ids."""
+    start, end = bucket * span, (bucket + 1) * span
+    ranges = []
+    if start < LEGACY_ID_LIMIT:
+        ranges.append((start, min(end, LEGACY_ID_LIMIT)))
+    if end > ID_EPOCH:
+        low = max((start - ID_EPOCH) << TIMESTAMP_SHIFT, LEGACY_ID_LIMIT)
+        high = (end - ID_EPOCH) << TIMESTAMP_SHIFT
+        if high > low:
+            ranges.append((low, high))
+    return ranges
+
+class HashTree:
+    """Two-level hash tree over (message id, data) pairs."""
+
+    def __init__(self, items, span: int = RECONCILE_BUCKET_SPAN):
+        self.items = {}  # bucket -> {message id: data}
+        for message_id, data in items:
+            self.items.setdefault(bucket_of(message_id, span), {})[int(message_id)] = data
+
+        self.buckets = {}
+        for bucket, messages in self.items.items():
+            h = hashlib.sha1()
+            for message_id in sorted(messages):
+                h.update(fingerprint(messages[message_id]).encode())
+                h.update(b"\n")
+            self.buckets[bucket] = h.hexdigest()
+
+        root = hashlib.sha1()
+        for bucket in sorted(self.buckets):
+            root.update(f"{bucket}:{self.buckets[bucket]}\n".encode())
+        self.root = root.hexdigest()
+
+    def diff(self, other) -> list:
+        """Buckets whose hash differs (or exist on one side only)."""
+        if self.root == other.root:
+            return []
+        return sorted(b for b in set(self.buckets) | set(other.buckets)
+                      if self.buckets.get(b) != other.buckets.get(b))
+
+def postgres_tree(rows, span: int = RECONCILE_BUCKET_SPAN) -> HashTree:
+    return HashTree(((row["id"], message_to_firestore(row)) for row in rows), span)
+
+def firestore_docs(chat_ref, buckets=None, span: int = RECONCILE_BUCKET_SPAN):
+    messages = chat_ref.collection("messages")
+    if buckets is None:
+        yield from messages.stream()
+        return
+    for bucket in buckets:
+        for low, high in bucket_id_ranges(bucket, span):
+            yield from messages.where("id", ">=", low).where("id", "<", high).stream()
+
+def firestore_tree(chat_ref, span: int = RECONCILE_BUCKET_SPAN, buckets=None):
+    """
+    Returns the tree plus {message id: [doc refs]} for repairs. With buckets, only those
+    buckets are read. Docs without a usable id field can't be matched to Postgres and
+    are reported as strays (full reads only).
+    """
+    refs, items, strays = {}, [], []
+    for doc in firestore_docs(chat_ref, buckets, span):
+        data = doc.to_dict() or {}
+        try:
+            message_id = int(data.get("id"))
+        except (TypeError, ValueError):
+            strays.append(doc.reference)
+            continue
+        refs.setdefault(message_id, []).append(doc.reference)
+        # Duplicates keep the first doc's content in the tree; repair drops the rest
+        if len(refs[message_id]) == 1:
+            items.append((message_id, data))
+    return HashTree(items, span), refs, strays
+
+def reconcile_chat(fs_db, chat_path: str, rows, repair: bool = False, span: int = RECONCILE_BUCKET_SPAN,
+                   known=None, refresh=None):
+    """
+    Compares one chat's Postgres rows with its Firestore messages.
+    known: {bucket: hash} already verified in sync; buckets whose Postgres hash still
+    matches are skipped without reading Firestore. None reads everything.
+    refresh(ids) -> {id: row}: current Postgres rows, re-read after Firestore so writes
+    that committed (and synced) after `rows` was read aren't undone.
+    With repair=True, rewrites only the differing buckets from Postgres.
+    Returns a report; report["synced_ids"] are the message ids written to Firestore and
+    report["verified"] maps checked buckets to the hash to store (None: forget the bucket).
+    """
+    chat_ref = fs_db.document(chat_path)
+    pg = postgres_tree(rows, span)
+    if known is None:
+        check = None
+    else:
+        check = sorted(b for b in set(pg.buckets) | set(known) if known.get(b) != pg.buckets.get(b))
+
+    report = {
+        "in_sync": True,
+        "buckets": len(pg.buckets),
+        "checked_buckets": 0,
+        "drifted_buckets": [],
+        "missing": [],  # in Postgres, not in Firestore
+        "changed": [],  # in both, content differs
+        "extra": [],    # in Firestore only
+        "duplicates": [],
+        "strays": 0,
+        "writes": 0,
+        "synced_ids": [],
+        "verified": {},
+    }
+    if check == []:
+        return report
+
+    fs, refs, strays = firestore_tree(chat_ref, span, check)
+    checked = check if check is not None else sorted(set(pg.buckets) | set(fs.buckets))
+    duplicates = {mid: r for mid, r in refs.items() if len(r) > 1}
+    buckets = [b for b in checked if pg.buckets.get(b) != fs.buckets.get(b)]
+    report.update({
+        "in_sync": not buckets and not duplicates,
+        "checked_buckets": len(checked),
+        "drifted_buckets": buckets,
+        "duplicates": sorted(duplicates),
+        "strays": len(strays),
+    })
+    # Drifted buckets aren't stored even once repaired: the next run checks the repair
+    for bucket in checked:
+        if bucket not in buckets:
+            report["verified"][bucket] = pg.buckets.get(bucket)
+
+    # Candidates from the snapshot, then decided on current Postgres rows
+    current, fs_messages = {}, {}
+    for bucket in buckets:
+        pg_bucket, fs_bucket = pg.items.get(bucket, {}), fs.items.get(bucket, {})
+        fs_messages.update(fs_bucket)
+        for message_id in set(pg_bucket) | set(fs_bucket):
+            data = pg_bucket.get(message_id)
+            if data is None or message_id not in fs_bucket or fingerprint(data) != fingerprint(fs_bucket[message_id]):
+                current[message_id] = data
+    if refresh and current:
+        fresh = refresh(sorted(current))
+        current = {mid: message_to_firestore(fresh[mid]) if mid in fresh else None for mid in current}
+
+    writes, written_ids = [], []
+    for message_id in sorted(current):
+        data, fs_data = current[message_id], fs_messages.get(message_id)
+        if data is None:
+            if fs_data is not None:
+                report["extra"].append(message_id)
+                writes.extend(("delete", ref, None) for ref in refs[message_id])
+            continue
+        if fs_data is None:
+            report["missing"].append(message_id)
+            writes.append(("set", chat_ref.collection("messages").document(str(message_id)), data))
+        elif fingerprint(data) != fingerprint(fs_data):
+            report["changed"].append(message_id)
+            writes.append(("set", refs[message_id][0], data))
+        else:
+            continue  # synced since the snapshot
+        written_ids.append(message_id)
+
+    # Duplicate docs from the old add()-based sync: keep the first, drop the rest
+    for message_id, dup_refs in duplicates.items():
+        writes.extend(("delete", ref, None) for ref in dup_refs[1:])
+
+    if repair and writes:
+        for i in range(0, len(writes), FIRESTORE_BATCH_LIMIT):
+            batch = fs_db.batch()
+            for op, ref, data in writes[i:i + FIRESTORE_BATCH_LIMIT]:
+                if op == "set":
+                    batch.set(ref, data)
+                else:
+                    batch.delete(ref)
+            batch.commit()
+    report["writes"] = len(writes) if repair else 0
+    report["synced_ids"] = written_ids if repair else []
+    return report
+
+def save_verified(cursor, chat_id: int, verified: dict, span: int = RECONCILE_BUCKET_SPAN):
+    keep = {b: h for b, h in verified.items() if h is not None}
+    gone = [b for b, h in verified.items() if h is None]
+    if keep:
+        cursor.execute('''
+            INSERT INTO reconcile_buckets (chat_id, span, bucket, hash, verified_at)
+            SELECT %s, %s, u.bucket, u.hash, NOW()
+            FROM unnest(%s::bigint[], %s::text[]) AS u(bucket, hash)
+            ON CONFLICT (chat_id, span, bucket) DO UPDATE SET hash = EXCLUDED.hash, verified_at = NOW()
+        ''', (chat_id, span, list(keep), list(keep.values())))
+    if gone:
+        cursor.execute(
+            "DELETE FROM reconcile_buckets WHERE chat_id = %s AND span = %s AND bucket = ANY(%s)",
+            (chat_id, span, gone)
+        )
+
+def reconcile(fs_db, chat_ids=None, repair: bool = False, resolve=None, full: bool = False):
+    """
+    Reconciles the given chats (default: all chats in Postgres).
+    resolve maps chat_id -> Firestore doc path; defaults to a ChatRefs private to this run.
+    full ignores stored bucket hashes and reads every chat's Firestore messages.
+    """
+    refs = None
+    if resolve is None:
+        refs = ChatRefs(fs_db)
+        resolve = refs.resolve
+    span = RECONCILE_BUCKET_SPAN
+    conn = get_db_connection()
+    try:
+        cursor = get_db_cursor(conn)
+        if chat_ids is None:
+            cursor.execute("SELECT id FROM chats ORDER BY id")
+            chat_ids = [row["id"] for row in cursor.fetchall()]
+        if refs:
+            refs.prefetch(cursor, chat_ids)
+
+        results = {}
+        for chat_id in chat_ids:
+            path = resolve(chat_id)
+            if refs and refs.discovered:
+                # Persist lookups as we go so the sync worker can reuse them
+                refs.save(cursor)
+                conn.commit()
+                refs.committed()
+            if path is None:
+                # The sync worker skips these too; nothing to compare against
+                results[chat_id] = {"in_sync": False, "error": "no Firestore chat doc"}
+                continue
+            known = None
+            if not full:
+                cursor.execute('''
+                    SELECT bucket, hash FROM reconcile_buckets
+                    WHERE chat_id = %s AND span = %s
+                      AND verified_at > NOW() - make_interval(hours => %s)
+                ''', (chat_id, span, RECONCILE_FULL_AFTER_HOURS))
+                known = {row["bucket"]: row["hash"] for row in cursor.fetchall()}
+            cursor.execute("SELECT * FROM messages WHERE chat_id = %s", (chat_id,))
+            rows = cursor.fetchall()
+
+            def refresh(ids, chat_id=chat_id):
+                cursor.execute("SELECT * FROM messages WHERE chat_id = %s AND id = ANY(%s)", (chat_id, ids))
+                return {row["id"]: row for row in cursor.fetchall()}
+
+            report = reconcile_chat(fs_db, path, rows, repair=repair, span=span, known=known, refresh=refresh)
+            if report["synced_ids"]:
+                cursor.execute("UPDATE messages SET synced = TRUE WHERE id = ANY(%s)", (report["synced_ids"],))
+            save_verified(cursor, chat_id, report.pop("verified"), span)
+            conn.commit()
+            results[chat_id] = report
+
+        return {
+            "chats": len(results),
+            "drifted": [c for c, r in results.items() if not r["in_sync"]],
+            "repaired": repair,
+            "results": results,
+        }
+    finally:
+        conn.close()
+
+class ReconcileRun:
+    """One all-chats reconcile at a time, run in the background (POST /sync/reconcile)."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.state = {"status": "idle"}
+
+    def start(self) -> bool:
+        if not self.lock.acquire(blocking=False):
+            return False
+        self.state = {"status": "running", "started_at": datetime.now().isoformat()}
+        return True
+
+    def run(self, fs_db, **kwargs):
+        # Call only after start() returned True
+        try:
+            summary = reconcile(fs_db, **kwargs)
+            self.state = {**self.state, "status": "done", "finished_at": datetime.now().isoformat(),
+                          "chats": summary["chats"], "drifted": summary["drifted"], "repaired": summary["repaired"]}
+        except Exception as e:
+            print(f"Reconcile failed: {e}")
+            self.state = {**self.state, "status": "failed", "error": str(e)}
+        finally:
+            self.lock.release()
+
+# Global instance
+reconcile_run = ReconcileRun()
+
+if __name__ == "__main__":
+    import firebase_admin
+    from firebase_admin import credentials, firestore
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Compare Postgres and Firestore chats and repair drift")
+    parser.add_argument("--chat", type=int, action="append", help="Chat id (repeatable); default all chats")
+    parser.add_argument("--repair", action="store_true", help="Rewrite drifted buckets from Postgres")
+    parser.add_argument("--full", action="store_true", help="Ignore stored bucket hashes and compare everything")
+    args = parser.parse_args()
+
+    if not firebase_admin._apps:
+        firebase_admin.initialize_app(credentials.Certificate(os.getenv("FIREBASE_CREDENTIALS", "serviceAccountKey.json")))
+
+    summary = reconcile(firestore.client(), chat_ids=args.chat, repair=args.repair, full=args.full)
+    for chat_id, report in summary["results"].items():
+        if report["in_sync"]:
+            continue
+        if "error" in report:
+            print(f"chat {chat_id}: {report['error']}")
+        else:
+            print(f"chat {chat_id}: buckets {report['drifted_buckets']} missing={len(report['missing'])} "
+                  f"changed={len(report['changed'])} extra={len(report['extra'])} duplicates={len(report['duplicates'])}")
+    print(f"{len(summary['drifted'])} of {summary['chats']} chats drifted" + (" (repaired)" if args.repair else ""))
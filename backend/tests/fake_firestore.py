@@ -0,0 +1,187 @@
+import time
+import operator
+import itertools
+
+# In-memory stand-in for the parts of google.cloud.firestore the sync code uses.
+# `calls` counts round trips the real client would make (reads, single writes, commits);
+# `latency` adds a simulated network delay to each of them.
+
+_auto_ids = itertools.count(1)
+_OPS = {"==": operator.eq, "<": operator.lt, "<=": operator.le, ">": operator.gt, ">=": operator.ge}
+
+
+class FakeSnapshot:
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+
+    @property
+    def exists(self):
+        return self._data is not None
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+
+class FakeDocument:
+    def __init__(self, client, path):
+        self.client = client
+        self.path = path
+        self.id = path.rsplit("/", 1)[-1]
+
+    def collection(self, name):
+        return FakeCollection(self.client, f"{self.path}/{name}")
+
+    def get(self):
+        self.client._rpc()
+        return FakeSnapshot(self, self.client.docs.get(self.path))
+
+    def set(self, data, merge=False):
+        self.client._rpc()
+        self.client._set(self.path, data, merge)
+
+    def update(self, data):
+        self.client._rpc()
+        self.client._update(self.path, data)
+
+    def delete(self):
+        self.client._rpc()
+        self.client._delete(self.path)
+
+
+class FakeQuery:
+    def __init__(self, collection, filters=(), limit=None):
+        self.collection = collection
+        self.filters = list(filters)
+        self._limit = limit
+
+    def where(self, field, op, value):
+        assert op in _OPS, "only comparison filters are faked"
+        return FakeQuery(self.collection, self.filters + [(field, op, value)], self._limit)
+
+    def limit(self, n):
+        return FakeQuery(self.collection, self.filters, n)
+
+    def stream(self):
+        client = self.collection.client
+        client._rpc()
+        client.check_available()
+        matches = []
+        for path, data in client._children(self.collection.path):
+            if all(self._matches(data, field, op, value) for field, op, value in self.filters):
+                matches.append(FakeSnapshot(FakeDocument(client, path), data))
+                if self._limit is not None and len(matches) >= self._limit:
+                    break
+        return iter(matches)
+
+
+    @staticmethod
+    def _matches(data, field, op, value):
+        if op != "==" and (field not in data or type(data[field]) is not type(value)):
+            return False  # range filters only match values of the same type, like Firestore
+        return _OPS[op](data.get(field), value)
+
+
+class FakeCollection(FakeQuery):
+    def __init__(self, client, path):
+        self.client = client
+        self.path = path
+        super().__init__(self)
+
+    def document(self, doc_id=None):
+        return FakeDocument(self.client, f"{self.path}/{doc_id or next(_auto_ids)}")
+
+    def add(self, data):
+        doc = self.document()
+        doc.set(data)
+        return None, doc
+
+
+class FakeBatch:
+    def __init__(self, client):
+        self.client = client
+        self.ops = []
+
+    def __len__(self):
+        return len(self.ops)
+
+    def set(self, ref, data, merge=False):
+        self.ops.append(("set", ref.path, data, merge))
+
+    def update(self, ref, data):
+        self.ops.append(("update", ref.path, data, False))
+
+    def delete(self, ref):
+        self.ops.append(("delete", ref.path, None, False))
+
+    def commit(self):
+        assert len(self.ops) <= 500, "Firestore batches are limited to 500 writes"
+        self.client._rpc()
+        self.client.commits += 1
+        self.client.check_available()
+        # All or nothing, like the real thing
+        before = dict(self.client.docs)
+        try:
+            for op, path, data, merge in self.ops:
+                if op == "set":
+                    self.client._set(path, data, merge)
+                elif op == "update":
+                    self.client._update(path, data)
+                else:
+                    self.client._delete(path)
+        except Exception:
+            self.client.docs = before
+            raise
+        self.ops = []
+
+
+class FakeFirestore:
+    def __init__(self, latency=0.0):
+        self.docs = {}
+        self.calls = 0
+        self.commits = 0
+        self.available = True
+        self.latency = latency
+
+    def _rpc(self):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def check_available(self):
+        if not self.available:
+            raise ConnectionError("Firestore unavailable")
+
+    def collection(self, name):
+        return FakeCollection(self, name)
+
+    def document(self, path):
+        return FakeDocument(self, path)
+
+    def batch(self):
+        return FakeBatch(self)
+
+    def _children(self, collection_path):
+        depth = collection_path.count("/") + 1
+        prefix = collection_path + "/"
+        for path in sorted(self.docs):
+            if path.startswith(prefix) and path.count("/") == depth:
+                yield path, self.docs[path]
+
+    def _set(self, path, data, merge):
+        self.check_available()
+        if merge and path in self.docs:
+            self.docs[path] = {**self.docs[path], **data}
+        else:
+            self.docs[path] = dict(data)
+
+    def _update(self, path, data):
+        self.check_available()
+        if path not in self.docs:
+            raise KeyError(f"No document to update: {path}")
+        self.docs[path] = {**self.docs[path], **data}
+
+    def _delete(self, path):
+        self.check_available()
+        self.docs.pop(path, None)
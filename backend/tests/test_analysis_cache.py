@@ -0,0 +1,91 @@
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+import analysis_cache as analysis_cache_module
+from analysis_cache import AnalysisCache, UPSERT_SQL, EVICT_SQL
+from models import IdeaAnalysis
+
+
+class FakeDb:
+    """analysis_cache rows by (sha256, extractor_version); records evictions asked for."""
+
+    def __init__(self):
+        self.rows = {}
+        self.evictions = []
+
+    async def fetchrow(self, query, sha256, version):
+        return self.rows.get((sha256, version))
+
+    async def execute(self, query, *args):
+        if query is UPSERT_SQL:
+            sha256, version, analyzer_version, text, analysis, size = args
+            self.rows[(sha256, version)] = {
+                "text": text, "analysis": analysis, "analyzer_version": analyzer_version,
+                "bytes": size, "last_used_at": datetime.now(timezone.utc),
+            }
+        elif query is EVICT_SQL:
+            self.evictions.append(args[0])
+        return "DELETE 0"
+
+    @asynccontextmanager
+    async def transaction(self):
+        yield self
+
+
+class FakeExtraction:
+    def __init__(self):
+        self.calls = []
+
+    async def analyze(self, path):
+        self.calls.append(path)
+        return "What if we launch an ad campaign?", IdeaAnalysis(is_idea=True, category="Campaign")
+
+
+def setup(monkeypatch, max_bytes=1024 * 1024):
+    db, extraction = FakeDb(), FakeExtraction()
+    monkeypatch.setattr(analysis_cache_module, "async_db", db)
+    monkeypatch.setattr(analysis_cache_module, "extraction", extraction)
+    return AnalysisCache(max_bytes=max_bytes), db, extraction
+
+
+def test_same_content_is_only_extracted_once(monkeypatch, tmp_path):
+    cache, db, extraction = setup(monkeypatch)
+    first, copy = tmp_path / "deck.pptx", tmp_path / "deck (shared).pptx"
+    first.write_bytes(b"same bytes")
+    copy.write_bytes(b"same bytes")
+
+    async def main():
+        return [await cache.analyze(str(p)) for p in (first, first, copy)]
+
+    results = asyncio.run(main())
+
+    assert extraction.calls == [str(first)]
+    assert len({sha for _, _, sha in results}) == 1
+    assert all(text.startswith("What if") and analysis.category == "Campaign" for text, analysis, _ in results)
+    assert (cache.hits, cache.misses, cache.stores) == (2, 1, 1)
+    # The repeat of the same path didn't hash the file again
+    assert cache.digests.hits == 1
+    assert db.evictions == [1024 * 1024]
+
+
+def test_a_new_analyzer_version_misses(monkeypatch, tmp_path):
+    cache, db, extraction = setup(monkeypatch)
+    path = tmp_path / "notes.txt"
+    path.write_text("notes")
+
+    asyncio.run(cache.analyze(str(path)))
+    monkeypatch.setattr(analysis_cache_module, "ANALYZER_VERSION", "2")
+    asyncio.run(cache.analyze(str(path)))
+
+    assert len(extraction.calls) == 2
+    assert [row["analyzer_version"] for row in db.rows.values()] == ["2"]
+
+
+def test_entries_bigger_than_the_cache_are_not_stored(monkeypatch, tmp_path):
+    cache, db, extraction = setup(monkeypatch, max_bytes=10)
+    path = tmp_path / "big.txt"
+    path.write_text("big")
+
+    asyncio.run(cache.analyze(str(path)))
+
+    assert db.rows == {} and cache.stores == 0
@@ -0,0 +1,63 @@
+import json
+import asyncio
+import cache
+from cache import TTLCache, CacheInvalidator, MISSING, invalidate
+
+
+class FakeRedis:
+    def __init__(self):
+        self.published = []
+
+    async def publish(self, channel, data):
+        self.published.append((channel, data))
+
+
+def test_entries_expire_after_ttl():
+    now = [0.0]
+    c = TTLCache("t", maxsize=10, ttl=5, clock=lambda: now[0])
+    c.set(1, frozenset({1, 2}))
+
+    assert c.get(1) == frozenset({1, 2})
+    now[0] = 5
+    assert c.get(1) is MISSING
+    assert c.stats()["size"] == 0
+    assert (c.hits, c.misses) == (1, 1)
+
+
+def test_least_recently_used_entry_is_evicted():
+    c = TTLCache("t", maxsize=2, ttl=60)
+    c.set("a", 1)
+    c.set("b", 2)
+    c.get("a")       # "b" is now the oldest
+    c.set("c", 3)
+
+    assert c.get("b") is MISSING
+    assert c.get("a") == 1 and c.get("c") == 3
+    stats = c.stats()
+    assert stats["evictions"] == 1
+    assert stats["hit_ratio"] == 0.75
+
+
+def test_invalidation_reaches_other_nodes_but_not_the_sender(monkeypatch):
+    redis = FakeRedis()
+    monkeypatch.setattr(cache.redis_client, "get_client", lambda: redis)
+    cache.membership_cache.set(7, frozenset({1}))
+
+    asyncio.run(invalidate(cache.membership_cache, 7))
+
+    assert cache.membership_cache.get(7) is MISSING
+    channel, data = redis.published[0]
+    assert channel == cache.INVALIDATION_CHANNEL
+
+    # Another worker still holds the old entry until the event arrives
+    other = CacheInvalidator(node_id="other-node")
+    cache.membership_cache.set(7, frozenset({1}))
+    other.apply(json.loads(data))
+    assert cache.membership_cache.get(7) is MISSING
+    assert other.received == 1
+
+    # Our own echo is ignored
+    cache.membership_cache.set(7, frozenset({1, 2}))
+    CacheInvalidator(node_id=cache.NODE_ID).apply(json.loads(data))
+    assert cache.membership_cache.get(7) == frozenset({1, 2})
+    cache.membership_cache.clear()
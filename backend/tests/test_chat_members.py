@@ -0,0 +1,21 @@
+import json
+from database import chat_member_rows, member_id
+
+
+def test_member_rows_from_participants_json():
+    participants = json.dumps([{"id": 1, "name": "Ana"}, {"id": "2"}, {"name": "guest"}, {"id": "bot"}, "3"])
+    created_by = json.dumps({"id": "2", "name": "Ben"})
+
+    assert chat_member_rows(10, participants, created_by) == [(10, 1, "member"), (10, 2, "owner")]
+
+
+def test_bad_json_yields_no_rows_instead_of_failing_startup():
+    assert chat_member_rows(10, "not json", None) == []
+    assert chat_member_rows(10, json.dumps({"id": 1}), None) == []
+    assert chat_member_rows(10, json.dumps([{"id": 1}]), "not json") == [(10, 1, "member")]
+
+
+def test_member_id_only_accepts_numeric_ids():
+    assert member_id({"id": "7"}) == 7
+    assert member_id({"id": None}) is None
+    assert member_id("7") is None
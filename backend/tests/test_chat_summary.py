@@ -0,0 +1,64 @@
+import asyncio
+from chat_summary import SummaryCoalescer, preview
+
+
+class FakeWriter:
+    def __init__(self, fail=0):
+        self.writes = []
+        self.fail = fail
+
+    async def __call__(self, pending):
+        if self.fail:
+            self.fail -= 1
+            raise ConnectionError("connection reset")
+        self.writes.append({chat_id: dict(entry) for chat_id, entry in pending.items()})
+
+
+def test_only_the_latest_value_per_chat_is_written():
+    writer = FakeWriter()
+    summaries = SummaryCoalescer(write=writer)
+    for i in range(1, 51):
+        summaries.note(1, i, f"m{i}", f"t{i}")
+    summaries.note(2, 7, preview(None, "image"), "t")
+    # A late note for an older message doesn't roll the preview back
+    summaries.note(1, 3, "m3 again", "t3")
+
+    asyncio.run(summaries.flush())
+
+    assert writer.writes == [{
+        1: {"message_id": 50, "preview": "m50", "at": "t50", "count": 51},
+        2: {"message_id": 7, "preview": "Sent a image", "at": "t", "count": 1},
+    }]
+    stats = summaries.stats()
+    assert (stats["notes"], stats["rows_written"], stats["pending"]) == (52, 2, 0)
+
+
+def test_failed_flush_is_retried_with_newer_notes_merged_in():
+    writer = FakeWriter(fail=1)
+    summaries = SummaryCoalescer(write=writer)
+    summaries.note(1, 1, "a", "t1")
+
+    asyncio.run(summaries.flush())
+    summaries.note(1, 2, "b", "t2")
+    asyncio.run(summaries.flush())
+
+    assert summaries.errors == 1
+    assert writer.writes == [{1: {"message_id": 2, "preview": "b", "at": "t2", "count": 2}}]
+
+
+def test_discard_drops_pending_notes_for_a_cleared_chat():
+    writer = FakeWriter()
+    summaries = SummaryCoalescer(write=writer)
+    summaries.note(1, 1, "a", "t1")
+    summaries.discard(1)
+
+    asyncio.run(summaries.flush())
+
+    assert writer.writes == []
+
+
+def test_empty_text_message_still_has_a_preview():
+    # None would be stored as NULL, which /chats reads as "no summary yet"
+    assert preview("", "text") == ""
+    assert preview(None, "text") == ""
+    assert preview("hi", "text") == "hi"
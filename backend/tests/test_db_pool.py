@@ -0,0 +1,149 @@
+import threading
+import pytest
+import psycopg2
+import psycopg2.extensions
+from database import ConnectionPool, PoolTimeout
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, query, params=None):
+        if self.conn.broken:
+            raise Exception("server closed the connection unexpectedly")
+
+    def fetchone(self):
+        return (1,)
+
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = 0
+        self.broken = False
+        self.status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        self.rollbacks = 0
+        self.autocommit = False
+
+    def cursor(self, cursor_factory=None):
+        return FakeCursor(self)
+
+    def get_transaction_status(self):
+        return self.status
+
+    def rollback(self):
+        self.rollbacks += 1
+        self.status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def commit(self):
+        self.status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        self.closed = 1
+
+
+def make_pool(max_size=2, timeout=0.2, healthcheck_interval=30):
+    pool = ConnectionPool("fake://", min_size=1, max_size=max_size,
+                          acquire_timeout=timeout, healthcheck_interval=healthcheck_interval)
+    pool.created = []
+
+    def connect():
+        conn = FakeConnection()
+        pool.created.append(conn)
+        return conn
+
+    pool._connect = connect
+    return pool
+
+
+def test_close_returns_connection_for_reuse():
+    pool = make_pool()
+    conn = pool.acquire()
+    conn.close()
+    conn2 = pool.acquire()
+    assert len(pool.created) == 1
+    assert pool.stats()["in_use"] == 1
+    conn2.close()
+    assert pool.stats()["in_use"] == 0
+    assert pool.stats()["idle"] == 1
+
+
+def test_acquire_times_out_when_exhausted():
+    pool = make_pool(max_size=1, timeout=0.05)
+    conn = pool.acquire()
+    with pytest.raises(PoolTimeout):
+        pool.acquire()
+    assert pool.stats()["timeouts"] == 1
+    conn.close()
+
+
+def test_waiter_gets_released_connection():
+    pool = make_pool(max_size=1, timeout=2)
+    conn = pool.acquire()
+    got = []
+
+    def waiter():
+        c = pool.acquire()
+        got.append(c)
+        c.close()
+
+    t = threading.Thread(target=waiter)
+    t.start()
+    conn.close()
+    t.join(1)
+    assert len(got) == 1
+    assert len(pool.created) == 1
+
+
+def test_open_transaction_rolled_back_on_release():
+    pool = make_pool()
+    conn = pool.acquire()
+    conn._conn.status = psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+    raw = conn._conn
+    conn.close()
+    assert raw.rollbacks == 1
+
+
+def test_unhealthy_connection_replaced():
+    pool = make_pool(healthcheck_interval=0)
+    conn = pool.acquire()
+    raw = conn._conn
+    conn.close()
+    raw.broken = True
+    conn = pool.acquire()
+    assert conn._conn is not raw
+    assert pool.stats()["discarded"] == 1
+    assert pool.stats()["size"] == 1
+    conn.close()
+
+
+def test_failed_fill_gives_back_every_reserved_slot():
+    pool = make_pool(max_size=5)
+    pool.min_size = 3
+
+    def refuse():
+        raise psycopg2.OperationalError("could not connect")
+
+    pool._connect = refuse
+    with pytest.raises(psycopg2.OperationalError):
+        pool.fill()
+    assert pool.stats()["size"] == 0
+
+    # Once the database is reachable again the pool fills all the way
+    pool._connect = FakeConnection
+    pool.fill()
+    assert pool.stats()["size"] == 3 and pool.stats()["idle"] == 3
+
+
+def test_attributes_set_on_a_pooled_connection_reach_the_real_one():
+    pool = make_pool()
+    conn = pool.acquire()
+    conn.autocommit = True
+    raw = pool.created[0]
+    assert raw.autocommit is True
+
+    conn.close()
+    # Handed back in the default transactional mode
+    assert raw.autocommit is False
+    with pytest.raises(psycopg2.InterfaceError):
+        conn.autocommit = True
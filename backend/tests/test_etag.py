@@ -0,0 +1,61 @@
+from fastapi import Response
+from starlette.requests import Request
+from etag import make_etag, not_modified
+
+
+def request(if_none_match=None):
+    headers = [(b"if-none-match", if_none_match.encode())] if if_none_match is not None else []
+    return Request({"type": "http", "method": "GET", "path": "/chats", "headers": headers})
+
+
+def test_make_etag_is_weak_and_depends_on_every_part():
+    etag = make_etag("chats", 1, 5)
+    assert etag.startswith('W/"') and etag.endswith('"')
+    assert make_etag("chats", 1, 5) == etag
+    assert make_etag("chats", 1, 6) != etag
+
+
+def test_no_if_none_match_stamps_the_response():
+    response = Response()
+    etag = make_etag("chats", 1)
+
+    assert not_modified(request(), response, etag) is None
+    assert response.headers["etag"] == etag
+    assert response.headers["cache-control"] == "no-cache"
+
+
+def test_matching_if_none_match_is_a_304():
+    etag = make_etag("chats", 1)
+
+    cached = not_modified(request(etag), Response(), etag)
+
+    assert cached.status_code == 304
+    assert cached.body == b""
+    assert cached.headers["etag"] == etag
+
+
+def test_strong_form_of_the_tag_matches_weakly():
+    etag = make_etag("chats", 1)
+
+    cached = not_modified(request(etag.removeprefix("W/")), Response(), etag)
+
+    assert cached.status_code == 304
+
+
+def test_star_matches_any_tag():
+    assert not_modified(request("*"), Response(), make_etag("chats", 1)).status_code == 304
+
+
+def test_tag_anywhere_in_a_list_matches():
+    etag = make_etag("chats", 1)
+    header = f'W/"stale", {etag} , "other"'
+
+    assert not_modified(request(header), Response(), etag).status_code == 304
+
+
+def test_stale_tags_get_the_full_response():
+    response = Response()
+    etag = make_etag("chats", 2)
+
+    assert not_modified(request(f'{make_etag("chats", 1)}, W/"other"'), response, etag) is None
+    assert response.headers["etag"] == etag
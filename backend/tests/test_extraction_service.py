@@ -0,0 +1,105 @@
+import time
+import signal
+import asyncio
+import extraction_service
+from extraction_service import ExtractionService, ExtractionBusy
+
+
+def spin(seconds):
+    # Pure Python, so the worker's alarm can interrupt it
+    end = time.time() + seconds
+    while time.time() < end:
+        pass
+    return "finished"
+
+
+def spin_with_alarm_blocked(seconds):
+    # Like C code that never returns to the interpreter: the alarm can't interrupt it
+    signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGALRM})
+    return spin(seconds)
+
+
+def test_documents_are_extracted_and_analyzed_in_the_pool(tmp_path):
+    path = tmp_path / "plan.txt"
+    path.write_text("What if we launch the campaign next week? It's urgent.")
+
+    async def main():
+        service = ExtractionService(workers=2)
+        try:
+            return await service.analyze(str(path)), service.stats()
+        finally:
+            await service.close()
+
+    (text, analysis), stats = asyncio.run(main())
+    assert text.startswith("What if")
+    assert analysis.is_idea and analysis.category == "Campaign" and analysis.priority == "High"
+    assert stats["completed"] == 1 and stats["pending"] == 0
+
+
+def test_a_slow_job_times_out_without_breaking_the_pool():
+    async def main():
+        service = ExtractionService(workers=1, timeout=0.5)
+        try:
+            try:
+                await service._run(spin, 30)
+                raise AssertionError("expected a timeout")
+            except TimeoutError:
+                pass
+            return await service._run(spin, 0), service.stats()
+        finally:
+            await service.close()
+
+    result, stats = asyncio.run(main())
+    assert result == "finished"
+    assert stats["timeouts"] == 1
+
+
+def test_a_job_that_ignores_the_alarm_is_killed(monkeypatch):
+    monkeypatch.setattr(extraction_service, "EXTRACT_KILL_GRACE_S", 0.5)
+
+    async def main():
+        service = ExtractionService(workers=1, timeout=0.5)
+        try:
+            try:
+                await service._run(spin_with_alarm_blocked, 30)
+                raise AssertionError("expected a timeout")
+            except TimeoutError:
+                pass
+            # The wedged worker is gone, so the next job doesn't queue behind it
+            return await service._run(spin, 0), service.stats()
+        finally:
+            await service.close()
+
+    started = time.time()
+    result, stats = asyncio.run(main())
+    assert result == "finished"
+    assert stats["timeouts"] == 1 and stats["pool_restarts"] == 1
+    assert time.time() - started < 10
+
+
+def test_requests_beyond_the_queue_limit_are_rejected():
+    service = ExtractionService(queue_max=0)
+    try:
+        asyncio.run(service.extract("missing.txt"))
+        raise AssertionError("expected ExtractionBusy")
+    except ExtractionBusy:
+        pass
+    assert service.rejected == 1 and service.pool is None
+
+
+def test_job_results_are_kept_without_redis():
+    async def work():
+        await asyncio.sleep(0)
+        return {"is_idea": True}
+
+    async def main():
+        service = ExtractionService()
+        job_id = await service.start_job(work())
+        pending = await service.get_job(job_id)
+        await asyncio.gather(*service.tasks)
+        return pending, await service.get_job(job_id), await service.get_job("nope")
+
+    pending, done, missing = asyncio.run(main())
+    assert pending == {"status": "pending"}
+    assert done == {"status": "done", "result": {"is_idea": True}}
+    assert missing is None
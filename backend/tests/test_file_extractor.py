@@ -0,0 +1,127 @@
+import pytest
+from docx import Document
+from pptx import Presentation
+from pptx.util import Inches
+from openpyxl import Workbook
+import file_extractor
+from file_extractor import extract_text
+
+
+def make_pdf(path, pages):
+    # Smallest PDF pypdf will read: one Helvetica text line per page
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>", None, "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for text in pages:
+        stream = f"BT /F1 12 Tf 72 720 Td ({text}) Tj ET".encode()
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream.decode()}\nendstream")
+        content = len(objects)
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+                       f"/Resources << /Font << /F1 3 0 R >> >> /Contents {content} 0 R >>")
+        kids.append(f"{len(objects)} 0 R")
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {len(kids)} >>"
+
+    out = b"%PDF-1.4\n"
+    offsets = []
+    for i, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += f"{i} 0 obj\n{body}\nendobj\n".encode()
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    out += "".join(f"{o:010d} 00000 n \n" for o in offsets).encode()
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    path.write_bytes(out)
+
+
+def test_docx_paragraphs_and_tables(tmp_path):
+    doc = Document()
+    doc.add_paragraph("Q3 budget deck")
+    doc.add_paragraph("Marketing spend is up.")
+    doc.add_table(rows=1, cols=2).rows[0].cells[0].text = "Total"
+    path = tmp_path / "budget.docx"
+    doc.save(path)
+
+    lines = extract_text(str(path)).split("\n")
+
+    assert lines[:2] == ["Q3 budget deck", "Marketing spend is up."]
+    assert "Total" in lines
+
+
+def test_pptx_slides_in_order(tmp_path):
+    prs = Presentation()
+    for i in range(1, 12):
+        slide = prs.slides.add_slide(prs.slide_layouts[6])
+        slide.shapes.add_textbox(Inches(1), Inches(1), Inches(4), Inches(1)).text_frame.text = f"Slide {i}"
+    path = tmp_path / "deck.pptx"
+    prs.save(path)
+
+    assert extract_text(str(path)).split("\n") == [f"Slide {i}" for i in range(1, 12)]
+
+
+def test_xlsx_rows_per_sheet(tmp_path):
+    wb = Workbook()
+    wb.active.title = "Budget"
+    wb.active.append(["Item", "Cost"])
+    wb.active.append(["Ads", 1200])
+    wb.create_sheet("Notes").append(["Approved"])
+    path = tmp_path / "budget.xlsx"
+    wb.save(path)
+
+    assert extract_text(str(path)) == "# Budget\nItem\tCost\nAds\t1200\n# Notes\nApproved"
+
+
+def test_pdf_pages(tmp_path):
+    path = tmp_path / "report.pdf"
+    make_pdf(path, ["First page", "Second page"])
+
+    assert extract_text(str(path)).split("\n") == ["First page", "Second page"]
+
+
+def test_pdf_is_read_from_the_open_file(tmp_path, monkeypatch):
+    path = tmp_path / "report.pdf"
+    make_pdf(path, ["First page"])
+    sources = []
+    original = file_extractor.PdfReader
+
+    def reader(source):
+        sources.append(source)
+        return original(source)
+
+    monkeypatch.setattr(file_extractor, "PdfReader", reader)
+
+    assert extract_text(str(path)) == "First page"
+    # A file object, not the path (which pypdf would slurp into memory), closed afterwards
+    assert hasattr(sources[0], "read") and sources[0].closed
+
+
+def test_html_skips_scripts_and_keeps_blocks(tmp_path):
+    path = tmp_path / "page.html"
+    path.write_text("<html><head><style>p {}</style><script>var x = 1;</script></head>"
+                    "<body><h1>Launch   plan</h1><p>Ship it &amp; tell <b>everyone</b>.</p></body></html>")
+
+    assert extract_text(str(path)) == "Launch plan\nShip it & tell everyone."
+
+
+def test_budget_stops_reading_early(tmp_path, monkeypatch):
+    read = []
+    original = file_extractor.iter_txt
+
+    def counting(path):
+        for block in original(path, block_size=100):
+            read.append(block)
+            yield block
+
+    monkeypatch.setitem(file_extractor.EXTRACTORS, ".txt", (counting, None))
+    path = tmp_path / "huge.txt"
+    path.write_text("x" * 100_000)
+
+    text = extract_text(str(path), max_chars=250)
+
+    assert text == "x" * 250
+    assert len(read) == 3
+
+
+@pytest.mark.parametrize("name,expected", [("photo.png", "Unsupported file format: .png"), ("missing.docx", "")])
+def test_unsupported_and_missing_files(tmp_path, name, expected):
+    if name == "photo.png":
+        (tmp_path / name).write_bytes(b"\x89PNG")
+    assert extract_text(str(tmp_path / name)) == expected
@@ -0,0 +1,37 @@
+from file_index import chunks, locate_snippets, is_extracted, MATCH_START, MATCH_END, FRAGMENT_DELIMITER
+
+
+def test_chunks_cover_the_text_and_cut_between_words():
+    text = " ".join(f"word{i}" for i in range(500))
+    parts = list(chunks(text, size=100))
+
+    assert "".join(chunk for _, chunk in parts) == text
+    for start, chunk in parts:
+        assert text[start:start + len(chunk)] == chunk
+        assert len(chunk) <= 100
+    assert all(chunk.endswith(" ") for _, chunk in parts[:-1])
+    # A single huge word still gets cut
+    assert [len(c) for _, c in chunks("x" * 250, size=100)] == [100, 100, 50]
+
+
+def test_snippet_offsets_point_into_the_whole_document():
+    document = "Intro. " * 20 + "The Q3 budget deck covers the marketing budget in detail. More text."
+    char_start = 40
+    chunk = document[char_start:]
+    headline = (
+        f"The Q3 {MATCH_START}budget{MATCH_END} deck covers the marketing {MATCH_START}budget{MATCH_END}"
+        f"{FRAGMENT_DELIMITER}not in the chunk"
+    )
+
+    found, missing = locate_snippets(chunk, char_start, headline)
+
+    assert document[found["start"]:found["end"]] == "The Q3 budget deck covers the marketing budget"
+    assert [document[s:e] for s, e in found["matches"]] == ["budget", "budget"]
+    assert missing == {"text": "not in the chunk", "start": None, "end": None, "matches": []}
+
+
+def test_extractor_errors_are_not_indexed():
+    assert is_extracted("quarterly numbers")
+    assert not is_extracted("")
+    assert not is_extracted("Unsupported file format: .png")
+    assert not is_extracted("Error: python-docx library not installed.")
@@ -0,0 +1,370 @@
+from fake_firestore import FakeFirestore
+import firestore_sync
+from firestore_sync import ChatRefs, CircuitBreaker, SyncWorker, apply_messages, message_to_firestore
+
+
+def message_row(id, chat_id, text="hi", **extra):
+    # Shaped like a RealDictCursor row: unquoted columns come back lowercase
+    row = {
+        "id": id, "chat_id": chat_id, "text": text, "sender": "1", "time": "10:00",
+        "type": "text", "fileurl": None, "filename": None, "filesize": None,
+        "ispinned": None, "callroomname": None, "callstatus": None, "isvoice": False,
+        "replyto": None, "isdeleted": False, "deleted_for": "[]", "synced": False,
+        "change_seq": 3,
+    }
+    row.update(extra)
+    return row
+
+
+def event(id, chat_id, entity_id):
+    return {"id": id, "kind": "message", "chat_id": chat_id, "entity_id": entity_id}
+
+
+def test_message_to_firestore_maps_lowercase_columns():
+    data = message_to_firestore(message_row(1, 5, ispinned=True, replyto='{"id": 9}', fileurl="/u/a.png"))
+    assert data["isPinned"] is True
+    assert data["fileUrl"] == "/u/a.png"
+    assert data["replyTo"] == {"id": 9}
+    assert "synced" not in data and "chat_id" not in data and "change_seq" not in data
+
+
+def test_apply_messages_is_idempotent_and_updates_last_message():
+    fs = FakeFirestore()
+    fs.collection("chats").document("abc").set({"id": 5})
+    rows = {1: message_row(1, 5, "first"), 2: message_row(2, 5, "second")}
+    events = [event(10, 5, 1), event(11, 5, 2)]
+
+    for _ in range(2):
+        done, synced, failed = apply_messages(fs, events, rows)
+
+    assert done == [10, 11] and synced == [1, 2] and failed == {}
+    messages = [p for p in fs.docs if p.startswith("chats/abc/messages/")]
+    assert sorted(messages) == ["chats/abc/messages/1", "chats/abc/messages/2"]
+    assert fs.docs["chats/abc"]["lastMessage"] == "second"
+
+
+def test_apply_messages_failure_is_scoped_to_its_chat():
+    fs = FakeFirestore()
+    fs.collection("chats").document("b").set({"id": 2})
+    rows = {100: message_row(100, 1), 200: message_row(200, 2)}
+
+    def resolve(chat_id):
+        if chat_id == 1:
+            raise ConnectionError("deadline exceeded")
+        return "chats/b"
+
+    done, synced, failed = apply_messages(fs, [event(1, 1, 100), event(2, 2, 200)], rows, resolve)
+
+    assert done == [2]
+    assert synced == [200]
+    assert list(failed) == [1]
+
+
+def test_apply_messages_batches_writes(monkeypatch):
+    monkeypatch.setattr(firestore_sync, "FIRESTORE_BATCH_LIMIT", 8)
+    fs = FakeFirestore()
+    paths = {}
+    for chat_id in (1, 2, 3):
+        fs.collection("chats").document(f"c{chat_id}").set({"id": chat_id})
+        paths[chat_id] = f"chats/c{chat_id}"
+    fs.calls = 0
+
+    rows, events = {}, []
+    for i in range(9):
+        chat_id = i % 3 + 1
+        rows[i] = message_row(i, chat_id, f"m{i}")
+        events.append(event(100 + i, chat_id, i))
+
+    done, synced, failed = apply_messages(fs, events, rows, paths.get)
+
+    # Each chat is 3 sets + 1 lastMessage update: two chats per batch of 8, no other calls
+    assert failed == {}
+    assert sorted(synced) == list(range(9))
+    assert fs.calls == fs.commits == 2
+    assert fs.docs["chats/c1"]["lastMessage"] == "m6"
+
+
+def test_chat_refs_queries_firestore_once_per_chat():
+    fs = FakeFirestore()
+    fs.collection("chats").document("legacy-id").set({"id": 7})
+    refs = ChatRefs(fs)
+    fs.calls = 0
+
+    assert refs.resolve(7) == "chats/legacy-id"
+    assert refs.resolve(7) == "chats/legacy-id"
+    assert fs.calls == 1
+    assert refs.discovered == {7: "chats/legacy-id"}
+    assert (refs.hits, refs.misses) == (1, 1)
+
+
+def test_chat_refs_remember_chats_without_a_doc_for_a_while():
+    fs = FakeFirestore()
+    now = [0.0]
+    refs = ChatRefs(fs, no_doc_ttl=600, clock=lambda: now[0])
+
+    assert refs.resolve(8) is None
+    now[0] += 599
+    assert refs.resolve(8) is None
+    assert fs.calls == 1
+    assert refs.discovered == {8: None}
+
+    # Past the TTL the chat may have gained a doc; look again
+    fs.collection("chats").document("late").set({"id": 8})
+    now[0] += 2
+    assert refs.resolve(8) == "chats/late"
+    assert fs.calls == 3  # query, the set() above, query
+
+
+def test_circuit_breaker_opens_and_half_opens():
+    now = [0.0]
+    breaker = CircuitBreaker(threshold=2, cooldown=10, clock=lambda: now[0])
+
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open" and not breaker.allow()
+
+    now[0] = 10
+    assert breaker.allow() and breaker.state == "half_open"
+    # A failed trial re-opens straight away
+    breaker.record_failure()
+    assert not breaker.allow()
+
+    now[0] = 20
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == "closed" and breaker.trips == 2
+
+
+class FakeCursor:
+    def __init__(self, rows):
+        self.rows = rows
+        self.result = []
+
+    def execute(self, query, params=None):
+        if "FROM messages" in query:
+            self.result = [self.rows[i] for i in params[0] if i in self.rows]
+        else:
+            self.result = []
+
+    def fetchall(self):
+        return self.result
+
+
+def make_worker(fs):
+    worker = SyncWorker()
+    worker.fs_db = fs
+    worker.chat_refs = ChatRefs(fs)
+    return worker
+
+
+def test_worker_applies_mixed_events_in_outbox_order():
+    fs = FakeFirestore()
+    fs.collection("chats").document("a").set({"id": 1})
+    fs.collection("chats").document("a").collection("messages").document("old").set({"id": 5, "text": "x"})
+    rows = {5: message_row(5, 1, "edited"), 6: message_row(6, 1, "after clear")}
+    events = [
+        {"id": 1, "kind": "message_update", "chat_id": 1, "entity_id": 5, "payload": None},
+        {"id": 2, "kind": "clear_chat", "chat_id": 1, "entity_id": None, "payload": '{"timestamp": "t"}'},
+        {"id": 3, "kind": "message", "chat_id": 1, "entity_id": 6, "payload": None},
+        {"id": 4, "kind": "idea", "chat_id": None, "entity_id": None, "payload": '{"id": 9, "title": "t"}'},
+    ]
+
+    done, synced, failed = make_worker(fs)._apply(FakeCursor(rows), events)
+
+    assert failed == {} and sorted(done) == [1, 2, 3, 4]
+    # The edit landed on the legacy doc, the clear removed it, and only the later message remains
+    assert [p for p in fs.docs if "/messages/" in p] == ["chats/a/messages/6"]
+    assert fs.docs["chats/a"]["lastMessage"] == "after clear"
+    assert fs.docs["ideas/9"] == {"id": 9, "title": "t"}
+
+
+def test_worker_holds_back_later_events_of_a_failed_chat():
+    fs = FakeFirestore()
+    fs.collection("chats").document("a").set({"id": 1})
+    worker = make_worker(fs)
+
+    def broken(chat_id):
+        raise ConnectionError("unavailable")
+
+    worker.chat_refs.resolve = broken
+    events = [
+        {"id": 1, "kind": "message", "chat_id": 1, "entity_id": 5, "payload": None},
+        {"id": 2, "kind": "delete_chat", "chat_id": 1, "entity_id": None, "payload": None},
+    ]
+    done, synced, failed = worker._apply(FakeCursor({5: message_row(5, 1)}), events)
+
+    # The delete neither ran nor counted as a failure; it waits behind event 1
+    assert done == [] and list(failed) == [1]
+    assert "chats/a" in fs.docs
+
+
+class FakeOutboxDb:
+    """
+    Just enough of Postgres for SyncWorker._drain_batch: sync_outbox, chats,
+    firestore_chat_refs (FK to chats) and messages. Writes apply on commit.
+    """
+
+    def __init__(self, events, chats=(), messages=None):
+        self.outbox = {e["id"]: dict(e, attempts=0, dead=False) for e in events}
+        self.chats = set(chats)
+        self.refs = {}
+        self.messages = messages or {}
+        self.staged = []
+        self.result = []
+        self.fail_commits = 0
+
+    # connection
+    def cursor(self, *args, **kwargs):
+        return self
+
+    def commit(self):
+        staged, self.staged = self.staged, []
+        if self.fail_commits:
+            self.fail_commits -= 1
+            raise ConnectionError("connection lost during commit")
+        for apply in staged:
+            apply()
+
+    def rollback(self):
+        self.staged = []
+
+    def close(self):
+        pass
+
+    # cursor
+    def execute(self, query, params=None):
+        self.result = []
+        if "FROM sync_outbox o" in query:
+            due = [e for _, e in sorted(self.outbox.items()) if not e["dead"]]
+            self.result = due[:params[0]]
+        elif "FROM firestore_chat_refs" in query:
+            self.result = [{"chat_id": c, "doc_path": p, "age": 0} for c, p in self.refs.items() if c in params[0]]
+        elif "FROM messages" in query:
+            self.result = [self.messages[i] for i in params[0] if i in self.messages]
+        elif "INSERT INTO firestore_chat_refs" in query:
+            for chat_id, path in zip(*params):
+                if chat_id in self.chats:
+                    self.staged.append(lambda c=chat_id, p=path: self.refs.__setitem__(c, p))
+                elif "WHERE EXISTS" not in query:
+                    raise ValueError("violates foreign key constraint firestore_chat_refs_chat_id_fkey")
+        elif "UPDATE messages SET synced = TRUE" in query:
+            self.staged.append(lambda ids=list(params[0]): [self.messages[i].update(synced=True) for i in ids])
+        elif "DELETE FROM sync_outbox" in query:
+            self.staged.append(lambda ids=list(params[0]): [self.outbox.pop(i, None) for i in ids])
+        elif "attempts = attempts + 1" in query:
+            error, _, _, max_attempts, event_id = params
+
+            def fail(e=self.outbox[event_id]):
+                e["attempts"] += 1
+                e["dead"] = e["attempts"] >= max_attempts
+                e["last_error"] = error
+            self.staged.append(fail)
+        elif "UPDATE sync_outbox SET last_error" in query:
+            error, ids = params
+            self.staged.append(lambda: [self.outbox[i].update(last_error=error) for i in ids])
+
+    def fetchall(self):
+        return self.result
+
+
+def drain_worker(monkeypatch, fs, db):
+    monkeypatch.setattr(firestore_sync, "get_db_connection", lambda: db)
+    monkeypatch.setattr(firestore_sync, "get_db_cursor", lambda conn: conn.cursor())
+    return make_worker(fs)
+
+
+def test_message_event_for_a_chat_deleted_in_postgres(monkeypatch):
+    fs = FakeFirestore()
+    fs.collection("chats").document("a").set({"id": 1})
+    fs.collection("chats").document("b").set({"id": 2})
+    # Chat 1 is gone from Postgres (messages cascaded); its delete_chat event is a batch behind
+    db = FakeOutboxDb(
+        [event(1, 1, 5), event(2, 2, 6)],
+        chats={2},
+        messages={6: message_row(6, 2)},
+    )
+    worker = drain_worker(monkeypatch, fs, db)
+
+    worker._drain_batch()
+    db.outbox[3] = {"id": 3, "kind": "delete_chat", "chat_id": 1, "entity_id": None,
+                    "payload": None, "attempts": 0, "dead": False}
+    worker._drain_batch()
+
+    assert db.outbox == {}
+    # Only the chat that still exists got its Firestore path saved
+    assert db.refs == {2: "chats/b"}
+    assert "chats/a" not in fs.docs and "chats/b/messages/6" in fs.docs
+
+
+def test_failed_batch_forgets_chat_refs_it_discovered(monkeypatch):
+    fs = FakeFirestore()
+    fs.collection("chats").document("b").set({"id": 2})
+    db = FakeOutboxDb([event(1, 2, 6)], chats={2}, messages={6: message_row(6, 2)})
+    db.fail_commits = 1
+    worker = drain_worker(monkeypatch, fs, db)
+
+    try:
+        worker._drain_batch()
+        raise AssertionError("expected the commit to fail")
+    except ConnectionError:
+        pass
+    assert worker.chat_refs.discovered == {} and 2 not in worker.chat_refs.cache
+
+    worker._drain_batch()
+    assert db.refs == {2: "chats/b"} and db.outbox == {}
+
+
+def test_a_long_outage_replays_the_backlog_instead_of_parking_it(monkeypatch):
+    fs = FakeFirestore()
+    fs.collection("chats").document("b").set({"id": 2})
+    db = FakeOutboxDb([event(i, 2, i) for i in range(1, 4)], chats={2},
+                      messages={i: message_row(i, 2) for i in range(1, 4)})
+    worker = drain_worker(monkeypatch, fs, db)
+    now = [0.0]
+    worker.breaker = CircuitBreaker(threshold=5, cooldown=30, clock=lambda: now[0])
+
+    def down(chat_id):
+        raise ConnectionError("firestore unavailable")
+
+    worker.chat_refs.resolve = down
+    # Three hours of downtime, polled every minute: far past SYNC_MAX_ATTEMPTS retries
+    for _ in range(180):
+        now[0] += 60
+        if worker.breaker.allow():
+            worker._drain_batch()
+
+    assert worker.breaker.state == "open"
+    # Only the failures before the breaker tripped counted against the events
+    assert all(not e["dead"] and e["attempts"] < 5 for e in db.outbox.values())
+    assert all(e["last_error"] == "firestore unavailable" for e in db.outbox.values())
+
+    del worker.chat_refs.resolve  # Firestore is back
+    now[0] += 60
+    assert worker.breaker.allow()
+    worker._drain_batch()
+
+    assert db.outbox == {} and worker.breaker.state == "closed"
+    assert sorted(p for p in fs.docs if "/messages/" in p) == [f"chats/b/messages/{i}" for i in range(1, 4)]
+
+
+def test_chats_without_a_doc_are_looked_up_once_across_batches_and_restarts(monkeypatch):
+    fs = FakeFirestore()
+    db = FakeOutboxDb([event(1, 3, 7)], chats={3}, messages={7: message_row(7, 3)})
+    worker = drain_worker(monkeypatch, fs, db)
+
+    worker._drain_batch()
+    db.outbox[2] = dict(event(2, 3, 8), attempts=0, dead=False)
+    db.messages[8] = message_row(8, 3)
+    worker._drain_batch()
+
+    assert fs.calls == 1
+    assert db.refs == {3: None} and db.outbox == {}
+    # Nothing to mirror them to, so the next leader's backfill must not queue them again
+    assert db.messages[7]["synced"] and db.messages[8]["synced"]
+
+    # A new leader reads the negative result back instead of querying Firestore
+    db.outbox[3] = dict(event(3, 3, 9), attempts=0, dead=False)
+    db.messages[9] = message_row(9, 3)
+    drain_worker(monkeypatch, fs, db)._drain_batch()
+    assert fs.calls == 1 and db.outbox == {}
@@ -0,0 +1,271 @@
+import os
+import fcntl
+import multiprocessing
+import pytest
+import id_generator
+from id_generator import (
+    IdGenerator, ID_EPOCH, MAX_SEQUENCE, MAX_WORKER_ID, NoFreeWorkerId, ClockMovedBackwards,
+    claim_worker_id, timestamp_ms,
+)
+
+WORKERS = 8
+IDS_PER_WORKER = 20000
+
+
+class FakeLockConnection:
+    """
+    Stands in for a Postgres session: pg_try_advisory_lock(a, b) is a non-blocking
+    flock on <lock_dir>/a-b, held until the connection closes or the process exits.
+    The pg_locks query sees this session's locks; drop() is the server going away.
+    """
+
+    def __init__(self, lock_dir):
+        self.lock_dir = lock_dir
+        self.held = []
+        self.keys = set()
+        self.result = None
+        self.autocommit = False
+        self.dropped = False
+
+    def cursor(self):
+        return self
+
+    def execute(self, query, args):
+        if self.dropped:
+            raise ConnectionError("server closed the connection unexpectedly")
+        if "FROM pg_locks" in query:
+            self.result = (int(args in self.keys),)
+            return
+        assert query == "SELECT pg_try_advisory_lock(%s, %s)"
+        fd = os.open(os.path.join(self.lock_dir, "%s-%s" % args), os.O_CREAT | os.O_RDWR)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            self.result = (False,)
+            return
+        self.held.append(fd)
+        self.keys.add(tuple(args))
+        self.result = (True,)
+
+    def fetchone(self):
+        return self.result
+
+    def close(self):
+        for fd in self.held:
+            os.close(fd)
+        self.held = []
+        self.keys = set()
+
+    def drop(self):
+        self.close()
+        self.dropped = True
+
+
+def generate(lock_dir, claimed, results):
+    worker_id = claim_worker_id(connect=lambda: FakeLockConnection(lock_dir))
+    # Every process holds its id before any of them generates
+    claimed.wait()
+    gen = IdGenerator(worker_id=worker_id)
+    results.put((worker_id, [gen.next_id() for _ in range(IDS_PER_WORKER)]))
+
+
+@pytest.fixture
+def no_lease(monkeypatch):
+    monkeypatch.delenv("WORKER_ID", raising=False)
+    monkeypatch.setattr(id_generator, "_lease", None)
+    yield
+    id_generator.release_worker_id()
+
+
+def test_ids_are_unique_across_processes(tmp_path, monkeypatch):
+    monkeypatch.delenv("WORKER_ID", raising=False)
+    ctx = multiprocessing.get_context("spawn")
+    claimed, queue = ctx.Barrier(WORKERS), ctx.Queue()
+    processes = [ctx.Process(target=generate, args=(str(tmp_path), claimed, queue)) for _ in range(WORKERS)]
+    for p in processes:
+        p.start()
+    results = [queue.get(timeout=60) for _ in processes]
+    for p in processes:
+        p.join()
+
+    assert sorted(worker_id for worker_id, _ in results) == list(range(WORKERS))
+    results = [ids for _, ids in results]
+    all_ids = [i for ids in results for i in ids]
+    assert len(set(all_ids)) == WORKERS * IDS_PER_WORKER
+    for ids in results:
+        assert ids == sorted(ids) and len(set(ids)) == len(ids)
+    # Fits a JavaScript number exactly
+    assert max(all_ids) < 2 ** 53
+
+
+def test_sequence_overflow_moves_to_the_next_millisecond():
+    calls = [0]
+
+    def clock():
+        calls[0] += 1
+        return ID_EPOCH + 1000 + calls[0] // 100
+
+    gen = IdGenerator(worker_id=3, clock=clock)
+    ids = [gen.next_id() for _ in range(MAX_SEQUENCE + 2)]
+
+    assert len(set(ids)) == len(ids) and ids == sorted(ids)
+    assert gen.sequence_waits == 1
+    assert timestamp_ms(ids[-1]) > timestamp_ms(ids[0])
+
+
+def test_claim_takes_the_lowest_free_id_and_keeps_it(tmp_path, no_lease):
+    others = FakeLockConnection(str(tmp_path))
+    for worker_id in (0, 1, 3):
+        others.execute("SELECT pg_try_advisory_lock(%s, %s)", (id_generator.WORKER_LOCK_NAMESPACE, worker_id))
+    connections = []
+
+    def connect():
+        connections.append(FakeLockConnection(str(tmp_path)))
+        return connections[-1]
+
+    assert claim_worker_id(connect=connect) == 2
+    # The same process asking again keeps its lease instead of taking a second id
+    assert claim_worker_id(connect=connect) == 2
+    assert len(connections) == 1 and connections[0].autocommit
+    assert connections[0].held
+
+    id_generator.release_worker_id()
+    assert not connections[0].held
+    others.close()
+
+
+def test_claim_fails_loudly_when_every_id_is_taken(tmp_path, no_lease):
+    others = FakeLockConnection(str(tmp_path))
+    for worker_id in range(MAX_WORKER_ID + 1):
+        others.execute("SELECT pg_try_advisory_lock(%s, %s)", (id_generator.WORKER_LOCK_NAMESPACE, worker_id))
+    connections = []
+
+    def connect():
+        connections.append(FakeLockConnection(str(tmp_path)))
+        return connections[-1]
+
+    with pytest.raises(NoFreeWorkerId):
+        claim_worker_id(connect=connect)
+    assert id_generator._lease is None and not connections[0].held
+    others.close()
+
+
+def test_worker_id_env_skips_the_database(monkeypatch):
+    monkeypatch.setenv("WORKER_ID", "9")
+
+    assert claim_worker_id(connect=lambda: pytest.fail("connected")) == 9
+
+
+def test_clock_going_backwards_never_repeats_an_id():
+    now = [ID_EPOCH + 5000]
+    gen = IdGenerator(worker_id=1, clock=lambda: now[0])
+    first = gen.next_id()
+    now[0] -= 1000
+    second = gen.next_id()
+
+    assert second > first
+    assert gen.clock_regressions == 1
+
+
+def test_new_ids_sort_after_legacy_timestamp_ids():
+    legacy = 1767225600000  # 2026-01-01 as a bare ms timestamp
+    gen = IdGenerator(worker_id=0, clock=lambda: legacy)
+    new = gen.next_id()
+
+    assert new > legacy
+    assert timestamp_ms(new) == legacy
+    assert timestamp_ms(legacy) == legacy
+
+
+def test_clock_behind_with_the_millisecond_used_up_raises_instead_of_waiting():
+    now = [ID_EPOCH + 5000]
+    gen = IdGenerator(worker_id=1, clock=lambda: now[0])
+    ids = [gen.next_id()]
+    now[0] -= 1000
+    ids += [gen.next_id() for _ in range(MAX_SEQUENCE)]
+
+    with pytest.raises(ClockMovedBackwards):
+        gen.next_id()
+    with pytest.raises(ClockMovedBackwards):
+        gen.next_id()
+
+    # Once the clock passes the last id's millisecond, ids carry on from there
+    now[0] += 1001
+    ids.append(gen.next_id())
+    assert len(set(ids)) == len(ids) == MAX_SEQUENCE + 2 and ids == sorted(ids)
+
+
+def lease_in(lock_dir, check_interval=5):
+    now = [0.0]
+    connections = []
+
+    def connect():
+        connections.append(FakeLockConnection(lock_dir))
+        return connections[-1]
+
+    return id_generator.WorkerLease(connect, check_interval=check_interval, clock=lambda: now[0]), now, connections
+
+
+def take(lock_dir, *worker_ids):
+    other = FakeLockConnection(lock_dir)
+    for worker_id in worker_ids:
+        other.execute("SELECT pg_try_advisory_lock(%s, %s)", (id_generator.WORKER_LOCK_NAMESPACE, worker_id))
+    return other
+
+
+def test_lease_takes_its_id_back_after_the_connection_drops(tmp_path):
+    lease, now, connections = lease_in(str(tmp_path))
+    assert lease.acquire() == 0
+    gen = IdGenerator()
+    gen.configure(0, lease=lease)
+
+    now[0] += 5
+    assert lease.check() and lease.losses == 0
+    connections[0].drop()
+    now[0] += 5
+    assert lease.check()
+
+    assert lease.losses == 1 and lease.worker_id == 0 and len(connections) == 2
+    assert (gen.next_id() >> 6) & MAX_WORKER_ID == 0
+    lease.release()
+
+
+def test_lease_moves_to_a_free_id_when_its_old_one_was_taken(tmp_path):
+    lease, now, connections = lease_in(str(tmp_path))
+    lease.acquire()
+    gen = IdGenerator()
+    gen.configure(0, lease=lease)
+
+    connections[0].drop()
+    # A new process grabs worker id 0 while our lock is gone
+    newcomer = take(str(tmp_path), 0)
+    assert lease.check()
+
+    assert lease.worker_id == 1
+    assert (gen.next_id() >> 6) & MAX_WORKER_ID == 1
+    lease.release()
+    newcomer.close()
+
+
+def test_ids_are_refused_while_the_lease_is_lost(tmp_path):
+    lease, now, connections = lease_in(str(tmp_path))
+    lease.acquire()
+    gen = IdGenerator(clock=lambda: ID_EPOCH + 1000 + int(now[0] * 1000))
+    gen.configure(0, lease=lease)
+    gen.next_id()
+
+    connections[0].drop()
+    everyone_else = take(str(tmp_path), *range(MAX_WORKER_ID + 1))
+    now[0] += 5
+    assert not lease.check()
+    # Still inside the grace period of the last good check
+    gen.next_id()
+    now[0] += 6
+    with pytest.raises(id_generator.WorkerIdLost):
+        gen.next_id()
+
+    everyone_else.close()
+    assert lease.check()
+    gen.next_id()
+    lease.release()
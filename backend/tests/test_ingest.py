@@ -0,0 +1,126 @@
+import asyncio
+from contextlib import asynccontextmanager
+import ingest as ingest_module
+from ingest import MessageIngest, write_messages
+
+
+class FakeWriter:
+    def __init__(self, bad_ids=()):
+        self.batches = []
+        self.bad_ids = set(bad_ids)
+        self.committed = []
+
+    async def __call__(self, messages):
+        self.batches.append([m["id"] for m in messages])
+        await asyncio.sleep(0)
+        if self.bad_ids & {m["id"] for m in messages}:
+            raise ValueError("duplicate key")
+        self.committed.extend(m["id"] for m in messages)
+        rows = [{"id": m["id"], "chat_id": m["chat_id"], "text": m["text"], "type": m["type"]} for m in messages]
+        return [(row, False) for row in rows], {}
+
+
+def message(id, chat_id=1):
+    return {"id": id, "chat_id": chat_id, "text": f"m{id}", "type": "text"}
+
+
+def run(writer, ids, **kwargs):
+    async def main():
+        ingest = MessageIngest(write=writer, **kwargs)
+        await ingest.start()
+        results = await asyncio.gather(*(ingest.submit(message(i)) for i in ids), return_exceptions=True)
+        await ingest.close()
+        return ingest, results
+    return asyncio.run(main())
+
+
+def test_frames_in_one_window_share_a_transaction():
+    writer = FakeWriter()
+    ingest, results = run(writer, range(10), window_ms=50, max_batch=4)
+
+    assert writer.batches == [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]]
+    # Every sender gets its own row back, after its batch committed
+    assert [row["id"] for row, duplicate in results] == list(range(10))
+    stats = ingest.stats()
+    assert (stats["batches"], stats["messages"], stats["max_batch_size"]) == (3, 10, 4)
+    assert stats["batch_sizes"] == {"1": 0, "2-4": 3, "5-16": 0, "17-64": 0, "65+": 0}
+
+
+def test_a_bad_frame_only_fails_its_own_sender():
+    writer = FakeWriter(bad_ids={2})
+    ingest, results = run(writer, range(4), window_ms=50, max_batch=10)
+
+    assert isinstance(results[2], ValueError)
+    assert [r[0]["id"] for i, r in enumerate(results) if i != 2] == [0, 1, 3]
+    assert writer.committed == [0, 1, 3]
+    assert ingest.fallbacks == 1 and ingest.errors == 1
+
+
+def test_submit_before_start_writes_directly():
+    writer = FakeWriter()
+    row, duplicate = asyncio.run(MessageIngest(write=writer).submit(message(7)))
+
+    assert row["id"] == 7 and not duplicate
+    assert writer.batches == [[7]]
+
+
+class FakeConn:
+    """Just enough of asyncpg for write_messages: a messages table with the client_msg_id index."""
+
+    def __init__(self):
+        self.messages = {}
+        self.change_seq = {1: 10}
+        self.outbox = []
+
+    async def fetch(self, query, *args):
+        if query is ingest_module.EXISTING_SQL:
+            keys = set(zip(*args))
+            return [m for m in self.messages.values() if (m["sender"], m["client_msg_id"]) in keys]
+        rows = []
+        for values in zip(*args):
+            row = dict(zip(ingest_module.COLUMNS, values))
+            key = (row["sender"], row["client_msg_id"])
+            if row["client_msg_id"] is not None and any(
+                (m["sender"], m["client_msg_id"]) == key for m in self.messages.values()
+            ):
+                continue  # ON CONFLICT DO NOTHING
+            self.messages[row["id"]] = row
+            rows.append(row)
+        return rows
+
+    async def fetchval(self, query, count, chat_id):
+        self.change_seq[chat_id] += count
+        return self.change_seq[chat_id]
+
+    async def execute(self, query, *args):
+        if args:
+            self.outbox.extend(zip(*args[1:]))
+
+
+class FakeDb:
+    def __init__(self):
+        self.conn = FakeConn()
+
+    @asynccontextmanager
+    async def transaction(self):
+        yield self.conn
+
+
+def client_message(id, client_msg_id):
+    return {"id": id, "chat_id": 1, "text": "hi", "sender": "5", "type": "text", "client_msg_id": client_msg_id}
+
+
+def test_retried_frames_are_stored_once(monkeypatch):
+    db = FakeDb()
+    monkeypatch.setattr(ingest_module, "async_db", db)
+
+    first, seqs = asyncio.run(write_messages([client_message(100, "a"), client_message(101, "a"), client_message(102, None)]))
+    # After a reconnect the client resends "a" (new server id) along with a new frame
+    retry, _ = asyncio.run(write_messages([client_message(200, "a"), client_message(201, "b")]))
+
+    assert [(row["id"], dup) for row, dup in first] == [(100, False), (100, True), (102, False)]
+    assert [(row["id"], dup) for row, dup in retry] == [(100, True), (201, False)]
+    assert sorted(db.conn.messages) == [100, 102, 201]
+    assert [entity_id for _, entity_id in db.conn.outbox] == [100, 102, 201]
+    # Only stored messages move the chat's change_seq
+    assert seqs == {1: (12, 2)}
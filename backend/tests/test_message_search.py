@@ -0,0 +1,88 @@
+import pytest
+from id_generator import ID_EPOCH, TIMESTAMP_SHIFT
+from message_search import encode_search_cursor, decode_search_cursor, build_search_query, search_page
+
+JAN_2026 = 1767225600000
+
+
+def snowflake(ms, worker=0, seq=0):
+    return ((ms - ID_EPOCH) << TIMESTAMP_SHIFT) | (worker << 6) | seq
+
+
+def test_cursor_round_trips():
+    # ts_rank_cd values are reals; repr keeps every digit
+    for rank, id in [(0.1, 5), (0.0607927, snowflake(JAN_2026, 3, 7)), (1e-20, 1)]:
+        assert decode_search_cursor(encode_search_cursor(rank, id)) == (rank, id)
+
+
+@pytest.mark.parametrize("cursor", ["", "abc", "0.1", "0.1:2:3", "x:5", "0.1:y", "nan:5", "inf:5", None])
+def test_malformed_cursors_are_rejected(cursor):
+    with pytest.raises(ValueError):
+        decode_search_cursor(cursor)
+
+
+def test_plain_query_has_no_optional_filters():
+    sql, args = build_search_query("launch", 20)
+
+    assert args == ["launch", 21]
+    assert "m.search_vector @@ query" in sql
+    assert "m.chat_id =" not in sql and "m.sender =" not in sql and "m.id" not in sql
+    assert "WHERE (rank, id) <" not in sql
+    assert "LIMIT $2" in sql
+
+
+def test_chat_and_sender_filters_are_bound_parameters():
+    sql, args = build_search_query("launch", 20, chat_id=7, sender="ana'; --")
+
+    assert args == ["launch", 7, "ana'; --", 21]
+    assert "m.chat_id = $2" in sql
+    assert "m.sender = $3" in sql
+    assert "ana" not in sql
+
+
+def test_user_filter_limits_to_member_chats_and_hides_deleted_for_me():
+    sql, args = build_search_query("launch", 20, user_id=42)
+
+    assert args == ["launch", 42, 21]
+    assert "SELECT chat_id FROM chat_members WHERE user_id = $2" in sql
+    assert "jsonb_build_array($2::bigint)" in sql
+
+
+def test_cursor_adds_keyset_condition_after_filters():
+    cursor = encode_search_cursor(0.25, 900)
+    sql, args = build_search_query("launch", 20, chat_id=7, cursor=cursor)
+
+    assert args == ["launch", 7, 0.25, 900, 21]
+    assert "WHERE (rank, id) < ($3::real, $4)" in sql
+    assert sql.count("ORDER BY rank DESC, id DESC") == 2
+
+
+def test_bad_cursor_fails_before_querying():
+    with pytest.raises(ValueError):
+        build_search_query("launch", 20, cursor="garbage")
+
+
+def test_pages_follow_rank_then_id():
+    # What the query returns, best first: ties on rank are broken by newer id first
+    ranked = [{"rank": r, "id": i} for r, i in [(0.9, 3), (0.5, 8), (0.5, 6), (0.5, 2), (0.1, 9)]]
+
+    def fetch(cursor, limit):
+        after = decode_search_cursor(cursor) if cursor else None
+        rows = [r for r in ranked if after is None or (r["rank"], r["id"]) < after]
+        return rows[:limit + 1]
+
+    seen, cursor = [], None
+    while True:
+        page, cursor, has_more = search_page(fetch(cursor, 2), 2)
+        seen.extend(r["id"] for r in page)
+        if not has_more:
+            assert cursor is None
+            break
+        assert cursor == encode_search_cursor(page[-1]["rank"], page[-1]["id"])
+
+    assert seen == [3, 8, 6, 2, 9]
+
+
+def test_last_page_has_no_cursor():
+    page, cursor, has_more = search_page([{"rank": 0.5, "id": 1}], 2)
+    assert (len(page), cursor, has_more) == (1, None, False)
@@ -0,0 +1,90 @@
+import asyncio
+import recent_messages as rm
+from recent_messages import RecentMessages, hidden_for
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.ops = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    def __getattr__(self, name):
+        def queue(*args, **kwargs):
+            self.ops.append((name, args, kwargs))
+        return queue
+
+    async def execute(self):
+        return [getattr(self.redis, name)(*args, **kwargs) for name, args, kwargs in self.ops]
+
+
+class FakeRedis:
+    """Just the sorted set / hash commands the fill and read paths use."""
+
+    def __init__(self):
+        self.data = {}
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+    def zadd(self, key, mapping):
+        self.data.setdefault(key, {}).update(mapping)
+
+    def zrange(self, key, start, end):
+        members = self.data.get(key, {})
+        return sorted(members, key=members.get)
+
+    def hset(self, key, mapping):
+        self.data.setdefault(key, {}).update({k: str(v) for k, v in mapping.items()})
+
+    def hgetall(self, key):
+        return dict(self.data.get(key, {}))
+
+    def expire(self, key, ttl):
+        pass
+
+
+def use_redis(monkeypatch, redis):
+    monkeypatch.setattr(rm.redis_client, "get_client", lambda: redis)
+
+
+def test_fill_then_read_at_the_same_seq(monkeypatch):
+    use_redis(monkeypatch, FakeRedis())
+    cache = RecentMessages(size=10)
+    messages = [{"id": 3, "text": "c"}, {"id": 1, "text": "a"}, {"id": 2, "text": "b"}]
+
+    asyncio.run(cache.fill(5, seq=7, messages=messages, complete=True))
+
+    cached, complete = asyncio.run(cache.read(5, 7))
+    assert [m["id"] for m in cached] == [1, 2, 3]
+    assert complete
+    # Any write we didn't mirror moves change_seq on, and the entry stops being used
+    assert asyncio.run(cache.read(5, 8)) is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_read_without_redis_is_a_no_op(monkeypatch):
+    use_redis(monkeypatch, None)
+    cache = RecentMessages()
+
+    assert not cache.enabled()
+    assert asyncio.run(cache.read(5, 1)) is None
+    asyncio.run(cache.push(5, 2, [{"id": 1}]))
+    assert cache.stats()["errors"] == 0
+
+
+def test_hidden_for_matches_numeric_and_string_ids():
+    assert hidden_for({"deleted_for": "[4]"}, 4)
+    assert hidden_for({"deleted_for": '["4"]'}, 4)
+    assert not hidden_for({"deleted_for": "[5]"}, 4)
+    assert not hidden_for({"deleted_for": None}, 4)
+    assert not hidden_for({"deleted_for": "not json"}, 4)
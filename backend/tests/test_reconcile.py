@@ -0,0 +1,128 @@
+from fake_firestore import FakeFirestore
+from firestore_sync import message_to_firestore
+from reconcile import reconcile_chat, postgres_tree, firestore_tree
+
+SPAN = 10  # ids 0-9 are bucket 0, 10-19 bucket 1, ...
+
+
+def row(id, text="hi", pinned=False):
+    return {"id": id, "chat_id": 1, "text": text, "sender": "1", "time": "10:00", "type": "text",
+            "ispinned": pinned, "isdeleted": False, "replyto": None, "synced": True}
+
+
+def seed(fs, rows):
+    messages = fs.collection("chats").document("c1").collection("messages")
+    for r in rows:
+        messages.document(str(r["id"])).set(message_to_firestore(r))
+
+
+def test_identical_sides_are_in_sync():
+    fs = FakeFirestore()
+    rows = [row(i) for i in range(30)]
+    seed(fs, rows)
+
+    report = reconcile_chat(fs, "chats/c1", rows, repair=True, span=SPAN)
+
+    assert report["in_sync"]
+    assert report["writes"] == 0
+
+
+def test_seeded_divergence_repairs_only_drifted_buckets():
+    fs = FakeFirestore()
+    rows = [row(i) for i in range(40)]
+    seed(fs, rows)
+    messages = fs.collection("chats").document("c1").collection("messages")
+
+    messages.document("3").delete()                                         # bucket 0: missing
+    messages.document("15").update({"isPinned": True})                      # bucket 1: changed
+    messages.document("ghost").set({"id": 45, "text": "not in postgres"})   # bucket 4: extra
+    messages.document("legacy-dup").set(message_to_firestore(row(5)))       # bucket 0: duplicate
+    # buckets 2 and 3 untouched
+
+    report = reconcile_chat(fs, "chats/c1", rows, repair=False, span=SPAN)
+    assert not report["in_sync"]
+    assert report["drifted_buckets"] == [0, 1, 4]
+    assert (report["missing"], report["changed"], report["extra"]) == ([3], [15], [45])
+    assert report["duplicates"] == [5]
+    assert report["writes"] == 0 and report["synced_ids"] == []
+
+    fs.calls = 0
+    report = reconcile_chat(fs, "chats/c1", rows, repair=True, span=SPAN)
+    # 1 read of the chat's messages + 1 batch commit; only 4 docs touched
+    assert fs.calls == 2
+    assert report["writes"] == 4
+    assert sorted(report["synced_ids"]) == [3, 15]
+
+    fs_tree, refs, _ = firestore_tree(fs.document("chats/c1"), SPAN)
+    assert fs_tree.root == postgres_tree(rows, SPAN).root
+    assert all(len(r) == 1 for r in refs.values())
+
+
+def test_writes_that_land_after_the_snapshot_are_not_undone():
+    fs = FakeFirestore()
+    snapshot = [row(i) for i in range(10)]
+    # After the Postgres read: 4 is edited and 7 is added, and both sync to Firestore
+    current = {r["id"]: r for r in snapshot}
+    current[4] = row(4, "edited")
+    current[7] = row(7)
+    snapshot = [r for r in snapshot if r["id"] != 7]
+    seed(fs, current.values())
+
+    report = reconcile_chat(fs, "chats/c1", snapshot, repair=True, span=SPAN,
+                            refresh=lambda ids: {i: current[i] for i in ids if i in current})
+
+    assert (report["missing"], report["changed"], report["extra"]) == ([], [], [])
+    assert report["writes"] == 0
+    assert fs.docs["chats/c1/messages/4"]["text"] == "edited" and "chats/c1/messages/7" in fs.docs
+
+
+def test_stored_bucket_hashes_skip_unchanged_buckets():
+    fs = FakeFirestore()
+    rows = [row(i) for i in range(40)]
+    seed(fs, rows)
+    first = reconcile_chat(fs, "chats/c1", rows, span=SPAN)
+    known = first["verified"]
+    assert sorted(known) == [0, 1, 2, 3]
+
+    # Nothing moved in Postgres: no Firestore reads at all
+    fs.calls = 0
+    report = reconcile_chat(fs, "chats/c1", rows, span=SPAN, known=known)
+    assert report["in_sync"] and report["checked_buckets"] == 0 and fs.calls == 0
+
+    # A Postgres change the sync missed: only its bucket is read and repaired
+    rows[25] = row(25, "edited")
+    fs.calls = 0
+    report = reconcile_chat(fs, "chats/c1", rows, repair=True, span=SPAN, known=known)
+    assert report["checked_buckets"] == 1 and report["changed"] == [25]
+    assert fs.calls == 2  # one range query + one commit
+    assert report["verified"] == {}  # re-checked next run
+
+
+def test_bucket_id_ranges_cover_legacy_and_snowflake_ids():
+    from id_generator import IdGenerator
+    from reconcile import bucket_of, bucket_id_ranges
+
+    legacy = 1767225600000
+    snowflake = IdGenerator(worker_id=5, clock=lambda: legacy + 1234).next_id()
+    for message_id in (legacy, snowflake, 42):
+        ranges = bucket_id_ranges(bucket_of(message_id))
+        assert any(low <= message_id < high for low, high in ranges)
+        # Neighbouring buckets don't claim it
+        for other in (bucket_of(message_id) - 1, bucket_of(message_id) + 1):
+            assert not any(low <= message_id < high for low, high in bucket_id_ranges(other))
+
+
+def test_only_one_background_reconcile_runs_at_a_time(monkeypatch):
+    import reconcile as reconcile_module
+    from reconcile import ReconcileRun
+
+    monkeypatch.setattr(reconcile_module, "reconcile",
+                        lambda fs_db, **kwargs: {"chats": 3, "drifted": [2], "repaired": kwargs["repair"]})
+    run = ReconcileRun()
+
+    assert run.start() and not run.start()
+    assert run.state["status"] == "running"
+    run.run(None, repair=True)
+
+    assert run.state["status"] == "done" and run.state["drifted"] == [2]
+    assert run.start()
@@ -0,0 +1,408 @@
+import asyncio
+import json
+import pytest
+import websocket_manager
+from websocket_manager import ConnectionManager
+
+
+class FakePubSub:
+    def __init__(self, broker):
+        self.broker = broker
+        self.channels = set()
+        self.queue = asyncio.Queue()
+        broker.pubsubs.append(self)
+
+    async def subscribe(self, *channels):
+        self.broker.commands.append(("subscribe",) + channels)
+        self.channels.update(channels)
+
+    async def unsubscribe(self, *channels):
+        self.broker.commands.append(("unsubscribe",) + channels)
+        self.channels.difference_update(channels)
+
+    async def get_message(self, ignore_subscribe_messages=False, timeout=0.0):
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    async def aclose(self):
+        pass
+
+
+class FakeRedis:
+    def __init__(self):
+        self.pubsubs = []
+        self.commands = []
+
+    def pubsub(self):
+        return FakePubSub(self)
+
+    async def publish(self, channel, data):
+        for pubsub in self.pubsubs:
+            if channel in pubsub.channels:
+                pubsub.queue.put_nowait({"type": "message", "channel": channel, "data": data})
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.sent = []
+        self.raw = []
+
+    async def accept(self):
+        pass
+
+    async def send_json(self, data):
+        self.sent.append(data)
+
+    async def send_text(self, data):
+        self.raw.append(data)
+        self.sent.append(json.loads(data))
+
+    async def close(self, code=1000):
+        self.close_code = code
+
+
+class StuckWebSocket(FakeWebSocket):
+    # Never finishes a send until released
+    def __init__(self):
+        super().__init__()
+        self.gate = asyncio.Event()
+
+    async def send_text(self, data):
+        await self.gate.wait()
+        self.sent.append(json.loads(data))
+
+
+@pytest.fixture
+def broker(monkeypatch):
+    broker = FakeRedis()
+    monkeypatch.setattr(websocket_manager.redis_client, "redis", broker)
+    return broker
+
+
+async def settle():
+    for _ in range(20):
+        await asyncio.sleep(0)
+
+
+def test_one_pubsub_and_refcounted_subscriptions(broker):
+    async def run():
+        manager = ConnectionManager()
+        a, b, c = FakeWebSocket(), FakeWebSocket(), FakeWebSocket()
+        await manager.connect(a, 1)
+        await manager.connect(b, 1)
+        await manager.connect(c, 2)
+
+        assert len(broker.pubsubs) == 1
+        assert broker.commands == [("subscribe", "chat:1"), ("subscribe", "chat:2")]
+
+        await manager.disconnect(a, 1)
+        assert ("unsubscribe", "chat:1") not in broker.commands
+        await manager.disconnect(b, 1)
+        assert broker.commands[-1] == ("unsubscribe", "chat:1")
+        assert manager.stats()["subscribed_channels"] == 1
+        await manager.close()
+
+    asyncio.run(run())
+
+
+def test_broadcast_routes_to_local_sockets_of_that_chat(broker):
+    async def run():
+        manager = ConnectionManager()
+        a, b = FakeWebSocket(), FakeWebSocket()
+        await manager.connect(a, 1)
+        await manager.connect(b, 2)
+
+        await manager.broadcast({"id": 7, "text": "hi"}, 1)
+        await settle()
+
+        assert a.sent == [{"id": 7, "text": "hi"}]
+        assert b.sent == []
+        await manager.close()
+
+    asyncio.run(run())
+
+
+def test_payload_encoded_once_for_all_sockets(broker):
+    async def run():
+        manager = ConnectionManager()
+        sockets = [FakeWebSocket() for _ in range(3)]
+        for ws in sockets:
+            await manager.connect(ws, 1)
+
+        await manager.broadcast({"id": 8, "text": "héllo"}, 1)
+        await settle()
+
+        # Every socket was handed the very string that came off Redis
+        first = sockets[0].raw[0]
+        assert all(ws.raw[0] is first for ws in sockets)
+        assert first == '{"id":8,"text":"héllo"}'
+        await manager.close()
+
+    asyncio.run(run())
+
+
+def test_slow_consumer_drop_oldest_does_not_block_others(broker):
+    async def run():
+        manager = ConnectionManager(max_queue=2, policy="drop_oldest")
+        slow, fast = StuckWebSocket(), FakeWebSocket()
+        await manager.connect(slow, 1)
+        await manager.connect(fast, 1)
+
+        for i in range(5):
+            await manager.broadcast({"id": i}, 1)
+        await settle()
+
+        # The fast socket got everything while the slow one was stuck
+        assert [m["id"] for m in fast.sent] == [0, 1, 2, 3, 4]
+        # id 0 is in flight; the queue kept only the newest two
+        slow.gate.set()
+        await settle()
+        assert [m["id"] for m in slow.sent] == [0, 3, 4]
+        assert manager.stats()["dropped"] == 2
+        await manager.close()
+
+    asyncio.run(run())
+
+
+def test_coalesce_replaces_queued_frame_for_same_message(broker):
+    async def run():
+        manager = ConnectionManager(max_queue=2, policy="coalesce")
+        slow = StuckWebSocket()
+        await manager.connect(slow, 1)
+
+        await manager.broadcast({"id": 1, "text": "a"}, 1)
+        await settle()
+        await manager.broadcast({"id": 2, "text": "b"}, 1)
+        await manager.broadcast({"id": 3, "text": "c"}, 1)
+        await manager.broadcast({"id": 2, "text": "b edited"}, 1)
+        await settle()
+
+        slow.gate.set()
+        await settle()
+        assert slow.sent == [{"id": 1, "text": "a"}, {"id": 2, "text": "b edited"}, {"id": 3, "text": "c"}]
+        assert manager.stats()["coalesced"] == 1
+        await manager.close()
+
+    asyncio.run(run())
+
+
+def test_disconnect_policy_evicts_and_releases_channel(broker):
+    async def run():
+        manager = ConnectionManager(max_queue=1, policy="disconnect")
+        slow = StuckWebSocket()
+        await manager.connect(slow, 1)
+
+        for i in range(3):
+            await manager.broadcast({"id": i}, 1)
+        await settle()
+
+        assert slow.close_code == 1013
+        stats = manager.stats()
+        assert stats["evictions"] == 1
+        assert stats["sockets"] == 0
+        assert broker.commands[-1] == ("unsubscribe", "chat:1")
+
+        # The handler's own disconnect afterwards is a no-op
+        await manager.disconnect(slow, 1)
+        assert manager.stats()["subscribed_channels"] == 0
+        await manager.close()
+
+    asyncio.run(run())
+
+
+def test_stuck_send_evicted_after_timeout(broker):
+    async def run():
+        manager = ConnectionManager(send_timeout=0.05)
+        stuck, ok = StuckWebSocket(), FakeWebSocket()
+        await manager.connect(stuck, 1)
+        await manager.connect(ok, 1)
+
+        await manager.broadcast({"id": 1}, 1)
+        await asyncio.sleep(0.2)
+
+        assert stuck.close_code == 1013
+        assert manager.stats()["send_timeouts"] == 1
+        assert manager.stats()["sockets"] == 1
+        assert ok.sent == [{"id": 1}]
+        await manager.close()
+
+    asyncio.run(run())
+
+
+def test_local_first_delivers_once_across_nodes(broker):
+    async def run():
+        node_a = ConnectionManager(fanout_mode="local_first", node_id="a")
+        node_b = ConnectionManager(fanout_mode="local_first", node_id="b")
+        local, remote = FakeWebSocket(), FakeWebSocket()
+        await node_a.connect(local, 1)
+        await node_b.connect(remote, 1)
+
+        await node_a.broadcast({"id": 1}, 1)
+        # Local socket is served before Redis is involved
+        assert node_a.active_connections[1][0].queue
+        await settle()
+
+        assert local.sent == [{"id": 1}]
+        assert remote.sent == [{"id": 1}]
+        assert node_a.stats()["echoes_skipped"] == 1
+        await node_a.close()
+        await node_b.close()
+
+    asyncio.run(run())
+
+
+def test_untagged_frames_from_older_nodes_still_delivered(broker):
+    async def run():
+        manager = ConnectionManager(fanout_mode="local_first", node_id="a")
+        ws = FakeWebSocket()
+        await manager.connect(ws, 1)
+
+        await broker.publish("chat:1", '{"id":5}')
+        await settle()
+
+        assert ws.sent == [{"id": 5}]
+        await manager.close()
+
+    asyncio.run(run())
+
+
+def test_redis_mode_publishes_plain_json(broker):
+    async def run():
+        manager = ConnectionManager(fanout_mode="redis", node_id="a")
+        ws = FakeWebSocket()
+        await manager.connect(ws, 1)
+        published = []
+        publish = broker.publish
+
+        async def record(channel, data):
+            published.append(data)
+            await publish(channel, data)
+
+        broker.publish = record
+        await manager.broadcast({"id": 1}, 1)
+        await settle()
+
+        # Nodes that predate tagging can still json.loads it
+        assert [json.loads(data) for data in published] == [{"id": 1}]
+        assert ws.sent == [{"id": 1}]
+        await manager.close()
+
+    asyncio.run(run())
+
+
+def test_falls_back_to_local_delivery_without_redis(monkeypatch):
+    async def run():
+        monkeypatch.setattr(websocket_manager.redis_client, "redis", None)
+        for mode in ("redis", "local_first"):
+            manager = ConnectionManager(fanout_mode=mode)
+            ws = FakeWebSocket()
+            await manager.connect(ws, 1)
+
+            await manager.broadcast({"id": 1}, 1)
+            await settle()
+
+            assert ws.sent == [{"id": 1}]
+            assert manager.stats()["local_only"] == 1
+            await manager.close()
+
+    asyncio.run(run())
+
+
+def test_send_personal_reaches_one_socket_and_is_never_coalesced(broker):
+    async def run():
+        manager = ConnectionManager(max_queue=2, policy="coalesce")
+        sender, other = StuckWebSocket(), FakeWebSocket()
+        await manager.connect(sender, 1)
+        await manager.connect(other, 1)
+
+        await manager.broadcast({"id": 1, "text": "a"}, 1)
+        await settle()
+        await manager.broadcast({"id": 7, "text": "b"}, 1)
+        await settle()
+        assert manager.send_personal({"type": "ack", "client_msg_id": "x", "id": 7}, sender, 1)
+        # Queue is full: the edit replaces the message, not the ack that shares its id
+        await manager.broadcast({"id": 7, "text": "b edited"}, 1)
+        await settle()
+
+        sender.gate.set()
+        await settle()
+        assert sender.sent == [
+            {"id": 1, "text": "a"},
+            {"id": 7, "text": "b edited"},
+            {"type": "ack", "client_msg_id": "x", "id": 7},
+        ]
+        assert all(frame.get("type") != "ack" for frame in other.sent)
+        assert not manager.send_personal({"type": "ack"}, FakeWebSocket(), 1)
+        await manager.close()
+
+    asyncio.run(run())
+
+
+def test_acks_are_never_dropped_for_room(broker):
+    async def run():
+        manager = ConnectionManager(max_queue=2, policy="drop_oldest")
+        sender = StuckWebSocket()
+        await manager.connect(sender, 1)
+
+        await manager.broadcast({"id": 0}, 1)
+        await settle()
+        assert manager.send_personal({"type": "ack", "client_msg_id": "x", "id": 0}, sender, 1)
+        for i in range(1, 4):
+            await manager.broadcast({"id": i}, 1)
+        await settle()
+        # The nack pushes out the last broadcast; with only acks queued, the next
+        # broadcast is the one shed, while a further ack still gets in
+        assert manager.send_personal({"type": "nack", "client_msg_id": "y"}, sender, 1)
+        await manager.broadcast({"id": 4}, 1)
+        assert manager.send_personal({"type": "ack", "client_msg_id": "z", "id": 5}, sender, 1)
+        await settle()
+
+        sender.gate.set()
+        await settle()
+        assert sender.sent == [
+            {"id": 0},
+            {"type": "ack", "client_msg_id": "x", "id": 0},
+            {"type": "nack", "client_msg_id": "y"},
+            {"type": "ack", "client_msg_id": "z", "id": 5},
+        ]
+        assert manager.stats()["dropped"] == 4
+        await manager.close()
+
+    asyncio.run(run())
+
+
+def test_coalesce_key_is_worked_out_once_per_frame(broker, monkeypatch):
+    calls = []
+    original = websocket_manager.coalesce_key
+
+    def counting(payload):
+        calls.append(payload)
+        return original(payload)
+
+    monkeypatch.setattr(websocket_manager, "coalesce_key", counting)
+
+    async def run():
+        manager = ConnectionManager(max_queue=2, policy="coalesce")
+        sockets = [StuckWebSocket() for _ in range(3)]
+        for ws in sockets:
+            await manager.connect(ws, 1)
+
+        await manager.broadcast({"id": 0, "text": "0"}, 1)
+        await settle()
+        # Two messages edited back and forth while every socket is stuck on the first
+        for i in range(1, 10):
+            await manager.broadcast({"id": 1 + i % 2, "text": str(i)}, 1)
+            await settle()
+
+        # One decode per frame off Redis, however many sockets or overflows
+        assert len(calls) == 10
+        assert manager.stats()["coalesced"] == 3 * 7
+        for ws in sockets:
+            ws.gate.set()
+        await settle()
+        assert sockets[0].sent == [{"id": 0, "text": "0"}, {"id": 2, "text": "9"}, {"id": 1, "text": "8"}]
+        await manager.close()
+
+    asyncio.run(run())
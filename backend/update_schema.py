@@ -36,6 +36,8 @@ def update_schema():
     add_column("chats", "isPrivate", "BOOLEAN")
     add_column("chats", "createdBy", "TEXT")
     add_column("chats", "synced", "BOOLEAN DEFAULT FALSE")
+    add_column("chats", "change_seq", "BIGINT NOT NULL DEFAULT 0")
+    add_column("chats", "cleared_seq", "BIGINT NOT NULL DEFAULT 0")
     
     # MESSAGES TABLE
     # Expected: id... isPinned, callRoomName, callStatus, isVoice, replyTo, isDeleted, deleted_for, synced
@@ -47,6 +49,7 @@ def update_schema():
     add_column("messages", "isDeleted", "BOOLEAN DEFAULT FALSE")
     add_column("messages", "deleted_for", "TEXT DEFAULT '[]'")
     add_column("messages", "synced", "BOOLEAN DEFAULT FALSE")
+    add_column("messages", "change_seq", "BIGINT NOT NULL DEFAULT 0")
     
     # IDEAS TABLE
     add_column("ideas", "is_analyzed", "BOOLEAN DEFAULT FALSE")
@@ -1,71 +1,402 @@
 from fastapi import WebSocket
 from typing import List, Dict
+from collections import deque
+import os
 import json
+import uuid
+import socket
 import asyncio
 from redis_client import redis_client
 
+CHANNEL_PREFIX = "chat:"
+
+# Outbound backpressure settings
+WS_SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "256"))
+# What to do when a socket's queue is full: drop_oldest | coalesce | disconnect
+WS_SLOW_CONSUMER_POLICY = os.getenv("WS_SLOW_CONSUMER_POLICY", "drop_oldest")
+# A single send taking longer than this marks the client as dead
+WS_SEND_TIMEOUT = float(os.getenv("WS_SEND_TIMEOUT", "10"))
+
+POLICIES = ("drop_oldest", "coalesce", "disconnect")
+
+# redis: every message makes the round trip through Redis, including to sockets on this node
+# local_first: deliver to this node's sockets immediately, Redis only carries it to other nodes.
+#              Its frames are tagged with the node id, which older nodes can't read, so
+#              switch to it only once every node runs this version.
+WS_FANOUT_MODE = os.getenv("WS_FANOUT_MODE", "redis")
+# Identifies this process in published frames so it can skip its own echo
+NODE_ID = os.getenv("NODE_ID") or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+
+def chat_channel(chat_id: int) -> str:
+    return f"{CHANNEL_PREFIX}{chat_id}"
+
+def encode(message: dict) -> str:
+    # Same compact form Starlette's send_json produces
+    return json.dumps(message, separators=(",", ":"), ensure_ascii=False)
+
+def tag(node_id: str, payload: str) -> str:
+    # Wire format on Redis in local_first mode: "<origin node>|<json>"
+    return f"{node_id}|{payload}"
+
+def untag(data: str):
+    # Returns (origin, payload). Untagged frames (plain JSON) come from redis-mode or older nodes.
+    if data.startswith("{"):
+        return None, data
+    origin, _, payload = data.partition("|")
+    return origin, payload
+
+def message_coalesce_key(data):
+    # Later frames for the same message (edits, pins, deletes) supersede earlier ones
+    if not isinstance(data, dict):
+        return None
+    if data.get("type") == "participant_update":
+        return "participant_update"
+    if data.get("type") in ("ack", "nack"):
+        # Carries the message id too, but must not replace the message itself
+        return None
+    return data.get("id")
+
+def coalesce_key(payload: str):
+    # For frames that arrive already encoded (from Redis)
+    try:
+        return message_coalesce_key(json.loads(payload))
+    except ValueError:
+        return None
+
+class ClientConnection:
+    """
+    A socket plus its bounded outbound queue. A dedicated writer task drains the
+    queue, so a slow client only ever delays itself.
+
+    Queued frames are (encoded JSON string, droppable, coalesce key). The string is
+    written as-is with send_text.
+
+    Acks and nacks go to this socket only and are never dropped. A full queue sheds
+    broadcast frames, which the client can refetch, but not the ack it waits on
+    before it stops retrying a send.
+
+    The manager's sweep catches stuck sends (see sending_since); there is no
+    per-frame timer. The manager works out the coalesce key once per frame before
+    fanning out, so an overflow only compares keys.
+    """
+
+    def __init__(self, websocket: WebSocket, chat_id: int, manager, max_queue: int, policy: str):
+        self.websocket = websocket
+        self.chat_id = chat_id
+        self.manager = manager
+        self.max_queue = max(max_queue, 1)
+        self.policy = policy if policy in POLICIES else "drop_oldest"
+        self.queue = deque()
+        self.ready = asyncio.Event()
+        self.closed = False
+        # loop.time() when the in-flight send started, None when idle
+        self.sending_since = None
+        self.writer_task = asyncio.create_task(self._writer())
+
+    def enqueue(self, payload: str, droppable: bool = True, key=None) -> bool:
+        if self.closed:
+            return False
+
+        stats = self.manager.counters
+        if len(self.queue) >= self.max_queue:
+            if self.policy == "disconnect":
+                self.manager.evict(self, reason="queue full")
+                return False
+
+            if self.policy == "coalesce" and droppable and key is not None:
+                for i, (_, queued_droppable, queued_key) in enumerate(self.queue):
+                    if queued_droppable and queued_key == key:
+                        self.queue[i] = (payload, True, key)
+                        stats["coalesced"] += 1
+                        return True
+
+            # drop_oldest, or coalesce with nothing to merge into
+            oldest = next((i for i, (_, queued_droppable, _) in enumerate(self.queue) if queued_droppable), None)
+            if oldest is not None:
+                del self.queue[oldest]
+                stats["dropped"] += 1
+            elif droppable:
+                # Nothing but acks queued; shed the new frame instead
+                stats["dropped"] += 1
+                return False
+            # else an ack over a queue of acks: let it run over the limit
+
+        self.queue.append((payload, droppable, key))
+        stats["enqueued"] += 1
+        stats["max_queue_depth"] = max(stats["max_queue_depth"], len(self.queue))
+        self.ready.set()
+        return True
+
+    async def _writer(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                await self.ready.wait()
+                while self.queue:
+                    payload, _, _ = self.queue.popleft()
+                    self.sending_since = loop.time()
+                    try:
+                        await self.websocket.send_text(payload)
+                        self.sending_since = None
+                    except Exception as e:
+                        print(f"WS: Error sending message: {e}")
+                        self.manager.counters["send_errors"] += 1
+                        self.manager.evict(self, reason="send error")
+                        return
+                self.ready.clear()
+        except asyncio.CancelledError:
+            pass
+
+    async def close(self, code: int = None):
+        self.closed = True
+        self.queue.clear()
+        if self.writer_task is not asyncio.current_task():
+            self.writer_task.cancel()
+        if code is not None:
+            try:
+                await self.websocket.close(code=code)
+            except Exception:
+                pass
+
 class ConnectionManager:
-    def __init__(self):
-        # Store active connections: chat_id -> List[WebSocket]
-        self.active_connections: Dict[int, List[WebSocket]] = {}
-        # Keep track of redis listener tasks: chat_id -> Task
-        self.redis_tasks: Dict[int, asyncio.Task] = {}
+    """
+    Routes chat messages between Redis and the WebSockets connected to this process.
+
+    One shared pubsub connection and one listener task serve every chat on the worker.
+    A chat's channel is subscribed when its first local socket connects and
+    unsubscribed when its last one leaves.
+
+    In local_first mode broadcast() writes to this node's sockets before publishing,
+    and the listener drops frames tagged with our own node id.
+    """
+
+    def __init__(self, max_queue: int = WS_SEND_QUEUE_SIZE, policy: str = WS_SLOW_CONSUMER_POLICY,
+                 send_timeout: float = WS_SEND_TIMEOUT, fanout_mode: str = WS_FANOUT_MODE,
+                 node_id: str = NODE_ID):
+        # Routing table: chat_id -> List[ClientConnection]
+        self.active_connections: Dict[int, List[ClientConnection]] = {}
+        # Reference counts for subscribed channels: chat_id -> local sockets
+        self.channel_refs: Dict[int, int] = {}
+        self.pubsub = None
+        self.listener_task: asyncio.Task = None
+        # Keeps SUBSCRIBE/UNSUBSCRIBE for the same chat from interleaving
+        self._sub_lock = asyncio.Lock()
+
+        self.max_queue = max_queue
+        self.policy = policy
+        self.send_timeout = send_timeout
+        self.sweeper_task: asyncio.Task = None
+        self.fanout_mode = fanout_mode
+        self.node_id = node_id
+        self.counters = {
+            "enqueued": 0,
+            "dropped": 0,
+            "coalesced": 0,
+            "evictions": 0,
+            "send_errors": 0,
+            "send_timeouts": 0,
+            "max_queue_depth": 0,
+            "published": 0,
+            "publish_errors": 0,
+            "local_only": 0,
+            "echoes_skipped": 0,
+        }
 
     async def connect(self, websocket: WebSocket, chat_id: int):
         await websocket.accept()
-        if chat_id not in self.active_connections:
-            self.active_connections[chat_id] = []
-            # Start Redis Listener for this chat if first user
-            self.redis_tasks[chat_id] = asyncio.create_task(self.subscribe_to_chat(chat_id))
-            
-        self.active_connections[chat_id].append(websocket)
+        client = ClientConnection(websocket, chat_id, self, self.max_queue, self.policy)
+        self.active_connections.setdefault(chat_id, []).append(client)
+        if self.sweeper_task is None or self.sweeper_task.done():
+            self.sweeper_task = asyncio.create_task(self._sweep())
+        await self._retain(chat_id)
         print(f"WS: Client connected to chat {chat_id}. Total: {len(self.active_connections[chat_id])}")
 
-    def disconnect(self, websocket: WebSocket, chat_id: int):
-        if chat_id in self.active_connections:
-            if websocket in self.active_connections[chat_id]:
-                self.active_connections[chat_id].remove(websocket)
-                print(f"WS: Client disconnected from chat {chat_id}. Total: {len(self.active_connections[chat_id])}")
-            
-            if not self.active_connections[chat_id]:
-                del self.active_connections[chat_id]
-                # Allow task to be cancelled or cleanup if needed
-                if chat_id in self.redis_tasks:
-                    self.redis_tasks[chat_id].cancel()
-                    del self.redis_tasks[chat_id]
-
-    async def subscribe_to_chat(self, chat_id: int):
-        redis = redis_client.get_client()
-        if not redis:
-            print("Redis client not initialized")
+    def _remove(self, websocket: WebSocket, chat_id: int):
+        connections = self.active_connections.get(chat_id, [])
+        for client in connections:
+            if client.websocket is websocket:
+                connections.remove(client)
+                if not connections:
+                    del self.active_connections[chat_id]
+                return client
+        return None
+
+    async def disconnect(self, websocket: WebSocket, chat_id: int):
+        client = self._remove(websocket, chat_id)
+        if client is None:
+            # Already evicted (its reference was released then)
             return
 
-        pubsub = redis.pubsub()
-        await pubsub.subscribe(f"chat:{chat_id}")
-        
-        try:
-            async for message in pubsub.listen():
-                if message["type"] == "message":
-                    data = json.loads(message["data"])
-                    # Send to all local connections for this chat
-                    if chat_id in self.active_connections:
-                        for connection in self.active_connections[chat_id]:
-                            try:
-                                await connection.send_json(data)
-                            except Exception as e:
-                                print(f"WS: Error sending message: {e}")
-        except asyncio.CancelledError:
-            pass
-        except Exception as e:
-            print(f"Redis Subscribe Error chat {chat_id}: {e}")
-        finally:
-            await pubsub.unsubscribe(f"chat:{chat_id}")
-            await pubsub.close()
+        await client.close()
+        print(f"WS: Client disconnected from chat {chat_id}. Total: {len(self.active_connections.get(chat_id, []))}")
+        await self._release(chat_id)
+
+    def evict(self, client: ClientConnection, reason: str):
+        if self._remove(client.websocket, client.chat_id) is None:
+            return
+        self.counters["evictions"] += 1
+        print(f"WS: Evicting slow consumer from chat {client.chat_id} ({reason})")
+
+        async def cleanup():
+            # 1013 = "try again later"; the client's reconnect logic takes it from here
+            await client.close(code=1013)
+            await self._release(client.chat_id)
+
+        asyncio.create_task(cleanup())
+
+    async def _sweep(self):
+        # Evicts clients whose current send has been stuck longer than send_timeout
+        loop = asyncio.get_running_loop()
+        interval = min(1.0, self.send_timeout / 2)
+        while True:
+            await asyncio.sleep(interval)
+            now = loop.time()
+            for connections in list(self.active_connections.values()):
+                for client in list(connections):
+                    started = client.sending_since
+                    if started is not None and now - started > self.send_timeout:
+                        self.counters["send_timeouts"] += 1
+                        self.evict(client, reason="send timeout")
+
+    async def _retain(self, chat_id: int):
+        async with self._sub_lock:
+            self.channel_refs[chat_id] = self.channel_refs.get(chat_id, 0) + 1
+            if self.channel_refs[chat_id] > 1:
+                return
+
+            redis = redis_client.get_client()
+            if not redis:
+                print("Redis client not initialized")
+                return
+
+            if self.pubsub is None:
+                self.pubsub = redis.pubsub()
+            try:
+                await self.pubsub.subscribe(chat_channel(chat_id))
+            except Exception as e:
+                print(f"Redis Subscribe Error chat {chat_id}: {e}")
+                return
+
+            # The listener can only start once the pubsub has a connection
+            if self.listener_task is None or self.listener_task.done():
+                self.listener_task = asyncio.create_task(self._listen())
+
+    async def _release(self, chat_id: int):
+        async with self._sub_lock:
+            refs = self.channel_refs.get(chat_id, 0) - 1
+            if refs > 0:
+                self.channel_refs[chat_id] = refs
+                return
+
+            self.channel_refs.pop(chat_id, None)
+            if self.pubsub is not None:
+                try:
+                    await self.pubsub.unsubscribe(chat_channel(chat_id))
+                except Exception as e:
+                    print(f"Redis Unsubscribe Error chat {chat_id}: {e}")
+
+    async def _listen(self):
+        while True:
+            try:
+                message = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                if message is None or message["type"] != "message":
+                    continue
+
+                channel = message["channel"]
+                try:
+                    chat_id = int(channel[len(CHANNEL_PREFIX):])
+                except ValueError:
+                    continue
+                origin, payload = untag(message["data"])
+                if origin == self.node_id and self.fanout_mode == "local_first":
+                    # Already delivered locally when it was broadcast
+                    self.counters["echoes_skipped"] += 1
+                    continue
+                # Forward the published string untouched; every socket gets the same object
+                self._dispatch(chat_id, payload)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # redis-py reconnects and re-subscribes on the next read; don't spin
+                print(f"Redis Listener Error: {e}")
+                await asyncio.sleep(1)
+
+    def _dispatch(self, chat_id: int, payload: str, message: dict = None):
+        # Hand off to each local connection's queue; never awaits a client
+        clients = self.active_connections.get(chat_id)
+        if not clients:
+            return
+        key = None
+        if self.policy == "coalesce":
+            # Once per frame, not per socket; only Redis frames need decoding for it
+            key = message_coalesce_key(message) if message is not None else coalesce_key(payload)
+        for client in list(clients):
+            client.enqueue(payload, key=key)
+
+    def send_personal(self, message: dict, websocket: WebSocket, chat_id: int) -> bool:
+        # One socket only (acks), through its queue so it can't interleave with the
+        # writer's sends, but never dropped to make room
+        for client in self.active_connections.get(chat_id, []):
+            if client.websocket is websocket:
+                return client.enqueue(encode(message), droppable=False)
+        return False
 
     async def broadcast(self, message: dict, chat_id: int):
-        # Instead of local loop, Publish to Redis
+        # Encoded once here; subscribers pass these bytes straight to the sockets
+        payload = encode(message)
+        local_first = self.fanout_mode == "local_first"
+        if local_first:
+            self._dispatch(chat_id, payload, message)
+
         redis = redis_client.get_client()
         if redis:
-            await redis.publish(f"chat:{chat_id}", json.dumps(message))
+            try:
+                # Only local_first needs the origin; plain JSON stays readable by every node
+                await redis.publish(chat_channel(chat_id), tag(self.node_id, payload) if local_first else payload)
+                self.counters["published"] += 1
+                return
+            except Exception as e:
+                print(f"Redis Publish Error chat {chat_id}: {e}")
+                self.counters["publish_errors"] += 1
         else:
-            print("Redis not connected, skipping publish")
+            print("Redis not connected, delivering to local sockets only")
+
+        # Redis is down: other nodes miss this one, but our own sockets still get it
+        self.counters["local_only"] += 1
+        if not local_first:
+            self._dispatch(chat_id, payload, message)
+
+    async def close(self):
+        for task in (self.listener_task, self.sweeper_task):
+            if task:
+                task.cancel()
+                try:
+                    await task
+                except (asyncio.CancelledError, Exception):
+                    pass
+        self.listener_task = None
+        self.sweeper_task = None
+        for connections in list(self.active_connections.values()):
+            for client in connections:
+                await client.close()
+        self.active_connections.clear()
+        if self.pubsub is not None:
+            await self.pubsub.aclose()
+            self.pubsub = None
+        self.channel_refs.clear()
+
+    def stats(self):
+        clients = [c for connections in self.active_connections.values() for c in connections]
+        depths = [len(c.queue) for c in clients]
+        return {
+            "chats": len(self.active_connections),
+            "sockets": len(clients),
+            "subscribed_channels": len(self.channel_refs),
+            "node_id": self.node_id,
+            "fanout_mode": self.fanout_mode,
+            "policy": self.policy,
+            "queue_limit": self.max_queue,
+            "queue_depth_total": sum(depths),
+            "queue_depth_max": max(depths, default=0),
+            **self.counters,
+        }